@@ -0,0 +1,152 @@
+"""
+Offline benchmarks of route extraction.
+
+Builds synthetic rail networks of increasing size, or uses a given
+GeoJSON file, and measures:
+
+ - graph: building the endpoint index of the ways (build_graph)
+ - traverse: following the ways from a start point (traverse_graph)
+ - network: building the weighted network of find_route.py
+ - nearest: projecting the traversed points onto the network (EdgeIndex)
+ - find_route: A* between the ends of the network, projected onto its edges
+ - simplify: Douglas-Peucker of the traversed route at 5 m
+
+Synthetic networks are a chain of ways in shuffled order, with as many
+unconnected ways scattered around it, so that traversal never has to
+ask which way to take. Results are written as JSON, for comparing runs.
+
+Run with `python benchmark_route.py [--geojson <file> --start lon,lat] [--output results.json]`.
+"""
+
+import argparse
+import builtins
+import contextlib
+import io
+import json
+import platform
+import random
+import sys
+import time
+from datetime import datetime, timezone
+from clean_route import build_graph, traverse_graph, load_geojson
+from find_route import build_network, EdgeIndex, find_route, parse_point
+from simplify_route import douglas_peucker
+
+NETWORK_SIZES = [1000, 2000, 5000, 10000]
+POINTS_PER_WAY = 10
+
+def measure(function, repeat):
+    """
+    The best wall time in seconds of the given number of runs, and the
+    result of the last run.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        value = function()
+        best = min(best, time.perf_counter() - started)
+    return best, value
+
+def result(name, parameters, count, seconds):
+    return {"name": name, "parameters": parameters, "records": count, "seconds": seconds,
+            "rate": count / seconds if seconds > 0 else None}
+
+def synthetic_features(ways, seed=0):
+    """
+    GeoJSON features of a chain of ways starting at [17.0, 59.0], plus
+    as many unconnected ways, in random order.
+    """
+    rng = random.Random(seed)
+    features = []
+    point = [17.0, 59.0]
+    for i in range(ways):
+        coordinates = [point]
+        for _ in range(POINTS_PER_WAY - 1):
+            point = [round(point[0] + rng.uniform(0, 2e-4), 7), round(point[1] + rng.uniform(-1e-4, 1e-4), 7)]
+            coordinates.append(point)
+        # Ways are stored in either direction
+        if rng.random() < 0.5:
+            coordinates = coordinates[::-1]
+        features.append({'type': 'Feature', 'id': f"way/{i}", 'geometry': {'type': 'LineString', 'coordinates': coordinates}})
+    for i in range(ways):
+        x, y = rng.uniform(17.0, 18.0), rng.uniform(58.0, 58.9)
+        coordinates = [[x + j * 1e-4, y] for j in range(POINTS_PER_WAY)]
+        features.append({'type': 'Feature', 'id': f"noise/{i}", 'geometry': {'type': 'LineString', 'coordinates': coordinates}})
+    rng.shuffle(features)
+    return features
+
+def quiet_traverse(graph, start_point):
+    """
+    traverse_graph without prompts: stop at dead ends and take the
+    first way at forks.
+    """
+    answers = lambda prompt: "n" if "(y/n)" in prompt else "0"
+    original = builtins.input
+    builtins.input = answers
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            return traverse_graph(graph, start_point)
+    finally:
+        builtins.input = original
+
+def benchmark_network(features, start_point, parameters, repeat):
+    results = []
+    ways = sum(1 for feature in features if feature['geometry']['type'] == 'LineString')
+    seconds, graph = measure(lambda: build_graph(features), repeat)
+    results.append(result("graph", parameters, ways, seconds))
+
+    seconds, path = measure(lambda: quiet_traverse(graph, start_point), repeat)
+    results.append(result("traverse", {**parameters, "points": len(path)}, len(path), seconds))
+
+    seconds, (nodes, adjacency) = measure(lambda: build_network(graph), repeat)
+    results.append(result("network", {**parameters, "nodes": len(nodes)}, ways, seconds))
+
+    points = path[::max(1, len(path) // 100)]
+    seconds, index = measure(lambda: EdgeIndex(adjacency), repeat)
+    lookup, _ = measure(lambda: [index.nearest(point) for point in points], repeat)
+    results.append(result("nearest", {**parameters, "edges": len(index.edges), "points": len(points)}, len(points), seconds + lookup))
+
+    seconds, route = measure(lambda: find_route(nodes, adjacency, [path[0], path[-1]], index), repeat)
+    results.append(result("find_route", {**parameters, "points": len(route)}, len(route), seconds))
+
+    seconds, kept = measure(lambda: douglas_peucker(path, 5), repeat)
+    results.append(result("simplify", {**parameters, "points": len(path), "kept": len(kept)}, len(path), seconds))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark route extraction offline.")
+    parser.add_argument("--geojson", help="rail network GeoJSON to use instead of synthetic networks")
+    parser.add_argument("--start", type=parse_point, help="start point of the traversal as longitude,latitude (with --geojson)")
+    parser.add_argument("--sizes", type=int, nargs="+", default=NETWORK_SIZES, help="synthetic chain lengths in ways")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per benchmark, the best is reported (default 3)")
+    parser.add_argument("--output", help="write the results to this file instead of stdout")
+    args = parser.parse_args()
+
+    results = []
+    if args.geojson:
+        if args.start is None:
+            parser.error("--start is required with --geojson")
+        features = load_geojson(args.geojson)['features']
+        results += benchmark_network(features, args.start, {"geojson": args.geojson}, args.repeat)
+        fixture = {"geojson": args.geojson, "start": args.start}
+    else:
+        for size in args.sizes:
+            results += benchmark_network(synthetic_features(size), [17.0, 59.0], {"ways": size}, args.repeat)
+        fixture = {"sizes": args.sizes, "pointsPerWay": POINTS_PER_WAY}
+
+    report = {
+        "suite": "route",
+        "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "fixture": fixture,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+if __name__ == "__main__":
+    main()
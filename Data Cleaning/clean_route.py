@@ -1,25 +1,91 @@
 import json
+import os
 import sys
+from simplify_route import write_levels
+
+# Endpoints closer than this (in degrees, about a centimetre) are joined
+SNAP_TOLERANCE = 1e-7
 
 def load_geojson(filename):
     with open(filename, 'r') as file:
         data = json.load(file)
     return data
 
-def find_starting_lines(features, start_point):
-    starting_lines = []
+def endpoint_key(point, tolerance):
+    return (round(point[0] / tolerance), round(point[1] / tolerance))
+
+def build_graph(features, tolerance=SNAP_TOLERANCE):
+    """
+    Build an adjacency graph of the ways, indexed by their endpoints
+    rounded to the snapping tolerance (in degrees).
+    """
+    ways = []
+    endpoints = {}
     for feature in features:
+        if feature['geometry']['type'] != 'LineString':
+            continue
         coordinates = feature['geometry']['coordinates']
-        if coordinates[0] == start_point or coordinates[-1] == start_point:
-            starting_lines.append(feature)
-    return starting_lines
+        index = len(ways)
+        ways.append({'id': feature.get('id'), 'coordinates': coordinates})
+        for point in (coordinates[0], coordinates[-1]):
+            key = endpoint_key(point, tolerance)
+            if index not in endpoints.setdefault(key, []):
+                endpoints[key].append(index)
+    return {'tolerance': tolerance, 'ways': ways, 'endpoints': endpoints}
+
+def load_graph(filename, tolerance=SNAP_TOLERANCE):
+    """
+    Load the graph of a GeoJSON file, from the cache next to it if it
+    was built from the same file with the same tolerance.
+    """
+    stat = os.stat(filename)
+    source = [stat.st_size, stat.st_mtime, tolerance]
+    cache = f"{filename}.graph.json"
+    if os.path.exists(cache):
+        with open(cache, 'r') as file:
+            cached = json.load(file)
+        if cached['source'] == source:
+            endpoints = {tuple(map(int, key.split(','))): ways for key, ways in cached['endpoints'].items()}
+            return {'tolerance': tolerance, 'ways': cached['ways'], 'endpoints': endpoints}
+    graph = build_graph(load_geojson(filename)['features'], tolerance)
+    with open(cache, 'w') as file:
+        json.dump({
+            'source': source,
+            'ways': graph['ways'],
+            'endpoints': {f"{x},{y}": ways for (x, y), ways in graph['endpoints'].items()},
+        }, file)
+    return graph
+
+def is_close(a, b, tolerance):
+    return abs(a[0] - b[0]) <= tolerance and abs(a[1] - b[1]) <= tolerance
+
+def find_starting_lines(graph, start_point, used=()):
+    """
+    Return the indices of all unused ways with an endpoint within the
+    snapping tolerance of the point.
+    """
+    tolerance = graph['tolerance']
+    x, y = endpoint_key(start_point, tolerance)
+    starting_lines = []
+    # Neighbouring keys too, points within tolerance may round apart
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            for index in graph['endpoints'].get((x + dx, y + dy), ()):
+                if index in used or index in starting_lines:
+                    continue
+                coordinates = graph['ways'][index]['coordinates']
+                if is_close(coordinates[0], start_point, tolerance) or is_close(coordinates[-1], start_point, tolerance):
+                    starting_lines.append(index)
+    return sorted(starting_lines)
 
-def traverse_graph(features, start_point):
+def traverse_graph(graph, start_point):
     path = [start_point]
     current_point = start_point
+    # Used ways, to avoid cycles
+    used = set()
 
     while True:
-        possible_lines = find_starting_lines(features, current_point)
+        possible_lines = find_starting_lines(graph, current_point, used)
 
         if not possible_lines:
             print("No more lines to traverse from:", current_point)
@@ -37,21 +103,20 @@ def traverse_graph(features, start_point):
         if len(possible_lines) > 1:
             print("Multiple lines found. Choose one:")
             for i, line in enumerate(possible_lines):
-                print(f"{i}: {line['id']}")
+                print(f"{i}: {graph['ways'][line]['id']}")
             answer = input("Enter the number of the chosen line (enter to abort): ")
             if answer == "":
                 break
             choice = int(answer)
         
         chosen_line = possible_lines[choice]
-        coordinates = chosen_line['geometry']['coordinates']
-        if coordinates[-1] == current_point:
-            coordinates.reverse()
-        path = path + coordinates[1:]
+        coordinates = graph['ways'][chosen_line]['coordinates']
+        if not is_close(coordinates[0], current_point, graph['tolerance']):
+            coordinates = coordinates[::-1]
+        path.extend(coordinates[1:])
         next_point = coordinates[-1]
         
-        # Remove the used feature to avoid cycles
-        features.remove(chosen_line)
+        used.add(chosen_line)
         
         current_point = next_point
 
@@ -67,17 +132,18 @@ def main():
         sys.exit(1)
     
     filename = sys.argv[1]
-    geojson_data = load_geojson(filename)
-    features = geojson_data['features']
+    graph = load_graph(filename)
     
     lon = float(input("Enter starting longitude: "))
     lat = float(input("Enter starting latitude: "))
     start_point = [lon, lat]
     
-    path = traverse_graph(features, start_point)
+    path = traverse_graph(graph, start_point)
     print("Traversal complete.")
     location = input("Save to file (default is ./cleaned-route.json): ")
-    writeToFile(path, location if location != "" else "cleaned-route.json")
+    location = location if location != "" else "cleaned-route.json"
+    writeToFile(path, location)
+    write_levels(path, location)
 
 if __name__ == "__main__":
     main()
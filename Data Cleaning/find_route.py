@@ -0,0 +1,257 @@
+"""
+Non-interactive route extraction between coordinates.
+
+Builds a weighted rail network from the GeoJSON ways (split wherever
+ways share a vertex, with geodesic edge lengths) and finds the
+shortest route with A*, optionally through via-points, writing the
+same route files (and levels of detail) as clean_route.py.
+
+Run a single route with
+`python find_route.py raw.geojson --from 18.0558889,59.331247 --to 17.6466,59.8585 --via 17.9290,59.6497 --out route-CstU-arlanda.json`
+or many with `python find_route.py raw.geojson --batch routes.json`,
+where routes.json is a list of {"from": [lon, lat], "to": [lon, lat],
+"via": [[lon, lat], ...], "out": "route-....json"}.
+"""
+
+import argparse
+import heapq
+import itertools
+import json
+import math
+import sys
+from collections import ChainMap
+import numpy as np
+from clean_route import load_graph, endpoint_key, writeToFile
+from simplify_route import write_levels
+
+def distance(a, b):
+    """
+    Great-circle distance in metres between two [lon, lat] points.
+    """
+    lon1, lat1, lon2, lat2 = map(math.radians, (a[0], a[1], b[0], b[1]))
+    h = math.sin((lat2 - lat1) / 2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2)**2
+    return 2 * 6371000 * math.asin(math.sqrt(h))
+
+def snap(point, tolerance, canonical):
+    """
+    The node key of a point, joining it with an already seen key next
+    to its own if they round apart.
+    """
+    key = endpoint_key(point, tolerance)
+    if key not in canonical:
+        canonical[key] = key
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                neighbour = (key[0] + dx, key[1] + dy)
+                if neighbour != key and canonical.get(neighbour) == neighbour:
+                    canonical[key] = neighbour
+    return canonical[key]
+
+def build_network(graph):
+    """
+    Build the weighted network of a clean_route graph. Nodes are
+    snapped vertex keys, and every way is split into edges at the
+    vertices it shares with other ways, so junctions in the middle of
+    a way are connected too. Returns (nodes, adjacency) where nodes
+    maps a key to its coordinate and adjacency maps a key to a list of
+    (neighbour, length, coordinates) edges.
+    """
+    tolerance = graph['tolerance']
+    ways = [way['coordinates'] for way in graph['ways']]
+    canonical = {}
+    # Count in how many ways every vertex appears
+    occurrences = {}
+    for coordinates in ways:
+        for key in {snap(point, tolerance, canonical) for point in coordinates}:
+            occurrences[key] = occurrences.get(key, 0) + 1
+
+    nodes = {}
+    adjacency = {}
+    for coordinates in ways:
+        start = 0
+        for i in range(1, len(coordinates)):
+            key = snap(coordinates[i], tolerance, canonical)
+            if i != len(coordinates) - 1 and occurrences[key] < 2:
+                continue
+            segment = coordinates[start:i + 1]
+            a = snap(segment[0], tolerance, canonical)
+            b = key
+            nodes.setdefault(a, segment[0])
+            nodes.setdefault(b, segment[-1])
+            length = sum(distance(segment[j], segment[j + 1]) for j in range(len(segment) - 1))
+            adjacency.setdefault(a, []).append((b, length, segment))
+            adjacency.setdefault(b, []).append((a, length, segment[::-1]))
+            start = i
+    return nodes, adjacency
+
+class EdgeIndex:
+    """
+    The straight pieces of every edge as arrays, built once so that
+    snapping many points (e.g. a batch of routes) onto the network is
+    vectorised.
+    """
+
+    def __init__(self, adjacency):
+        # Every edge is stored in both directions, keep one of them
+        self.edges = [(a, b, segment) for a in adjacency for b, _, segment in adjacency[a] if a <= b]
+        pieces = [(e, j) for e, (_, _, segment) in enumerate(self.edges) for j in range(len(segment) - 1)]
+        self.edge = np.array([e for e, _ in pieces], dtype=int)
+        self.piece = np.array([j for _, j in pieces], dtype=int)
+        start = np.array([self.edges[e][2][j][:2] for e, j in pieces], dtype=float).reshape(-1, 2)
+        end = np.array([self.edges[e][2][j + 1][:2] for e, j in pieces], dtype=float).reshape(-1, 2)
+        self.lon, self.lat = start[:, 0], start[:, 1]
+        self.dlon, self.dlat = end[:, 0] - self.lon, end[:, 1] - self.lat
+
+    def nearest(self, point):
+        """
+        The edge closest to the point as (edge, piece, fraction along the
+        piece, projected point), measured in a plane around the point.
+        """
+        scale = math.cos(math.radians(point[1]))
+        x, y = (self.lon - point[0]) * scale, self.lat - point[1]
+        dx, dy = self.dlon * scale, self.dlat
+        length = dx * dx + dy * dy
+        t = np.clip(-(x * dx + y * dy) / np.where(length > 0, length, 1), 0, 1)
+        i = int(np.argmin((x + t * dx)**2 + (y + t * dy)**2))
+        projected = [float(self.lon[i] + t[i] * self.dlon[i]), float(self.lat[i] + t[i] * self.dlat[i])]
+        return int(self.edge[i]), int(self.piece[i]), float(t[i]), projected
+
+class SplitNetwork:
+    """
+    The network with extra nodes where points were projected onto its
+    edges, layered over nodes and adjacency instead of copying them.
+    """
+
+    def __init__(self, nodes, adjacency, index):
+        self.nodes = ChainMap({}, nodes)
+        self.adjacency = adjacency
+        self.index = index
+        self.splits = {}
+        self.extra = {}
+
+    def get(self, node, default=()):
+        extra = self.extra.get(node)
+        if extra is None:
+            return self.adjacency.get(node, default)
+        return self.adjacency.get(node, []) + extra
+
+    def add(self, key, point):
+        """
+        Split the edge nearest to the point at its projection, as a
+        new node with the given key.
+        """
+        edge, piece, t, projected = self.index.nearest(point)
+        self.nodes[key] = projected
+        self.splits.setdefault(edge, []).append((piece, t, key, projected))
+        self.extra = {}
+        for edge, splits in self.splits.items():
+            a, b, segment = self.index.edges[edge]
+            # Chain the split points of an edge in order along it
+            previous, coordinates, vertex = a, [segment[0]], 1
+            for piece, _, key, projected in sorted(splits):
+                coordinates += segment[vertex:piece + 1]
+                vertex = max(vertex, piece + 1)
+                coordinates.append(projected)
+                self.link(previous, key, coordinates)
+                previous, coordinates = key, [projected]
+            self.link(previous, b, coordinates + segment[vertex:])
+
+    def link(self, a, b, segment):
+        length = sum(distance(segment[i], segment[i + 1]) for i in range(len(segment) - 1))
+        self.extra.setdefault(a, []).append((b, length, segment))
+        self.extra.setdefault(b, []).append((a, length, segment[::-1]))
+
+def shortest_path(nodes, adjacency, source, target):
+    """
+    A* from source to target node, with the great-circle distance as
+    heuristic. Returns the route's coordinates, or None if the nodes
+    aren't connected.
+    """
+    goal = nodes[target]
+    best = {source: 0.0}
+    previous = {}
+    # The counter breaks ties, so that node keys are never compared
+    order = itertools.count()
+    queue = [(distance(nodes[source], goal), 0.0, next(order), source)]
+    while queue:
+        _, cost, _, node = heapq.heappop(queue)
+        if node == target:
+            break
+        if cost > best[node]:
+            continue
+        for neighbour, length, segment in adjacency.get(node, ()):
+            candidate = cost + length
+            if candidate < best.get(neighbour, math.inf):
+                best[neighbour] = candidate
+                previous[neighbour] = (node, segment)
+                heapq.heappush(queue, (candidate + distance(nodes[neighbour], goal), candidate, next(order), neighbour))
+    if target not in best:
+        return None
+    segments = []
+    node = target
+    while node != source:
+        node, segment = previous[node]
+        segments.append(segment)
+    path = [nodes[source]]
+    for segment in reversed(segments):
+        path.extend(segment[1:])
+    return path
+
+def find_route(nodes, adjacency, points, index=None):
+    """
+    Find the route through the given points in order, each projected
+    onto the nearest edge of the network (using the EdgeIndex if given).
+    """
+    if index is None:
+        index = EdgeIndex(adjacency)
+    network = SplitNetwork(nodes, adjacency, index)
+    keys = [('point', i) for i in range(len(points))]
+    for key, point in zip(keys, points):
+        network.add(key, point)
+    path = [network.nodes[keys[0]]]
+    for source, target in zip(keys, keys[1:]):
+        leg = shortest_path(network.nodes, network, source, target)
+        if leg is None:
+            raise ValueError(f"No route between {network.nodes[source]} and {network.nodes[target]}")
+        path.extend(leg[1:])
+    return path
+
+def parse_point(text):
+    lon, lat = map(float, text.split(','))
+    return [lon, lat]
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract routes between coordinates from a rail network GeoJSON.")
+    parser.add_argument("filename", help="raw GeoJSON of the rail network")
+    parser.add_argument("--from", dest="start", type=parse_point, help="start as longitude,latitude")
+    parser.add_argument("--to", dest="end", type=parse_point, help="end as longitude,latitude")
+    parser.add_argument("--via", type=parse_point, action="append", default=[], help="via-point as longitude,latitude (repeatable)")
+    parser.add_argument("--out", default="cleaned-route.json", help="route file to write")
+    parser.add_argument("--batch", help="JSON file with a list of routes to extract")
+    args = parser.parse_args()
+
+    if args.batch:
+        with open(args.batch, 'r') as file:
+            routes = json.load(file)
+    elif args.start and args.end:
+        routes = [{'from': args.start, 'to': args.end, 'via': args.via, 'out': args.out}]
+    else:
+        parser.print_usage()
+        sys.exit(1)
+
+    nodes, adjacency = build_network(load_graph(args.filename))
+    index = EdgeIndex(adjacency)
+    for route in routes:
+        points = [route['from'], *route.get('via', []), route['to']]
+        try:
+            path = find_route(nodes, adjacency, points, index)
+        except ValueError as e:
+            print(f"Skipping {route['out']}: {e}")
+            continue
+        writeToFile(path, route['out'])
+        write_levels(path, route['out'])
+        length = sum(distance(path[i], path[i + 1]) for i in range(len(path) - 1))
+        print(f"Wrote {route['out']} ({len(path)} points, {length/1000:.1f} km)")
+
+if __name__ == "__main__":
+    main()
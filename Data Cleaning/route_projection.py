@@ -0,0 +1,146 @@
+"""
+Linear referencing of positions onto a cleaned route.
+
+A RouteIndex precomputes the route's segments in SWEREF 99 TM metres
+(see sweref99), their cumulative lengths and a grid of which segments
+lie near each cell, so that millions of positions can be projected to
+"distance along route" in one vectorized pass.
+
+Run with `python route_projection.py <route.json> <database> [output.npz]`
+to project all positions of a collector database onto a route, with
+`--tolerance <metres>` to use a simplified level of detail of the route.
+"""
+
+import argparse
+import sqlite3
+import numpy as np
+from simplify_route import load_route
+from sweref99 import to_sweref99tm
+
+class RouteIndex:
+    """
+    Projects WGS84 points onto a route given as a list of [lon, lat]
+    points. Points further than `max_offset` metres from the route get
+    NaN as distance.
+    """
+
+    def __init__(self, path, max_offset=500.0):
+        path = np.asarray(path, dtype=np.float64)
+        points = self.to_metres(path[:, 0], path[:, 1])
+        self.starts = points[:-1]
+        self.directions = points[1:] - points[:-1]
+        self.lengths = np.hypot(self.directions[:, 0], self.directions[:, 1])
+        self.cumulative = np.concatenate(([0.0], np.cumsum(self.lengths)))
+        self.length = self.cumulative[-1]
+        self.max_offset = max_offset
+        # Avoid division by zero for repeated vertices
+        self.squared_lengths = np.maximum(self.lengths**2, 1e-12)
+
+        # Every segment is listed in all cells its bounding box, widened
+        # by max_offset, overlaps
+        self.cell_size = max_offset
+        low = np.floor((np.minimum(points[:-1], points[1:]) - max_offset) / self.cell_size).astype(np.int64)
+        high = np.floor((np.maximum(points[:-1], points[1:]) + max_offset) / self.cell_size).astype(np.int64)
+        cells = {}
+        for segment in range(len(self.lengths)):
+            for x in range(low[segment, 0], high[segment, 0] + 1):
+                for y in range(low[segment, 1], high[segment, 1] + 1):
+                    cells.setdefault((x, y), []).append(segment)
+        self.cells = {cell: np.array(segments) for cell, segments in cells.items()}
+
+    @classmethod
+    def from_file(cls, location, tolerance=None, **kwargs):
+        """
+        Index a route file, at full resolution or at a simplified
+        level of detail (see simplify_route.load_route).
+        """
+        return cls(load_route(location, tolerance), **kwargs)
+
+    def to_metres(self, lons, lats):
+        return np.column_stack(to_sweref99tm(lons, lats))
+
+    def project(self, lons, lats, block=4096):
+        """
+        Project points onto the route. Returns the distance along the
+        route and the perpendicular offset, both in metres, as arrays
+        with NaN for points not within max_offset of the route.
+        """
+        points = self.to_metres(lons, lats)
+        distances = np.full(len(points), np.nan)
+        offsets = np.full(len(points), np.nan)
+        if len(points) == 0:
+            return distances, offsets
+        keys = np.floor(points / self.cell_size).astype(np.int64)
+        unique_keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+        order = np.argsort(inverse.ravel(), kind="stable")
+        bounds = np.searchsorted(inverse.ravel()[order], np.arange(len(unique_keys) + 1))
+        for cell_number, key in enumerate(unique_keys):
+            segments = self.cells.get((int(key[0]), int(key[1])))
+            if segments is None:
+                continue
+            members = order[bounds[cell_number]:bounds[cell_number + 1]]
+            for first in range(0, len(members), block):
+                indices = members[first:first + block]
+                self.project_onto(points[indices], segments, indices, distances, offsets)
+        return distances, offsets
+
+    def project_onto(self, points, segments, indices, distances, offsets):
+        """
+        Project points onto the closest of the candidate segments and
+        store the results at the given indices.
+        """
+        starts = self.starts[segments]
+        directions = self.directions[segments]
+        relative = points[:, None, :] - starts[None, :, :]
+        t = np.clip(np.einsum("psk,sk->ps", relative, directions) / self.squared_lengths[segments], 0, 1)
+        difference = relative - t[:, :, None] * directions[None, :, :]
+        squared = np.einsum("psk,psk->ps", difference, difference)
+        closest = np.argmin(squared, axis=1)
+        rows = np.arange(len(points))
+        offset = np.sqrt(squared[rows, closest])
+        within = offset <= self.max_offset
+        chosen = segments[closest]
+        distances[indices[within]] = (self.cumulative[chosen] + t[rows, closest] * self.lengths[chosen])[within]
+        offsets[indices[within]] = offset[within]
+
+def project_database(database_path, index, chunk_size=1000000):
+    """
+    Project every position of a collector database onto the route,
+    reading it in chunks. Returns arrays of the rowid, train, journey,
+    measured time, distance along route and offset of each position.
+    """
+    conn = sqlite3.connect(database_path)
+    cursor = conn.execute("""SELECT rowid, operationalTrainNumber, journeyNumber, measuredTime, WGS84_1, WGS84_2
+                          FROM timestamps""")
+    parts = []
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        columns = np.array(rows, dtype=np.float64)
+        distances, offsets = index.project(columns[:, 4], columns[:, 5])
+        parts.append((columns[:, 0].astype(np.int64), columns[:, 1].astype(np.int64), columns[:, 2].astype(np.int64),
+                      columns[:, 3], distances, offsets))
+    conn.close()
+    names = ("rowid", "operationalTrainNumber", "journeyNumber", "measuredTime", "distance", "offset")
+    if not parts:
+        return {name: np.empty(0) for name in names}
+    return {name: np.concatenate([part[i] for part in parts]) for i, name in enumerate(names)}
+
+def main():
+    parser = argparse.ArgumentParser(description="Project collected positions onto a route.")
+    parser.add_argument("route", help="route file, e.g. route-CstU-arlanda.json")
+    parser.add_argument("database", help="collector database")
+    parser.add_argument("output", nargs="?", default="projection.npz", help="output file (default projection.npz)")
+    parser.add_argument("--tolerance", type=float, help="use the route simplified to this many metres")
+    args = parser.parse_args()
+    index = RouteIndex.from_file(args.route, args.tolerance)
+    result = project_database(args.database, index)
+    matched = np.count_nonzero(~np.isnan(result["distance"]))
+    print(f"Projected {matched} of {len(result['distance'])} positions onto a {index.length/1000:.1f} km route")
+    location = args.output
+    np.savez(location, **result)
+    print(f"Saved to {location}")
+
+if __name__ == "__main__":
+    main()
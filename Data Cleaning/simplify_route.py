@@ -0,0 +1,112 @@
+"""
+Route polyline simplification and multi-resolution storage.
+
+Routes are simplified with Douglas-Peucker in SWEREF 99 TM metres (see
+sweref99), so every vertex of the full route lies within the tolerance
+of the simplified one. The levels of detail are stored next to the
+full-resolution route as `<route>.lod.json`, leaving the route file
+itself unchanged.
+
+Run with `python simplify_route.py <route.json> [tolerances in metres...]`.
+"""
+
+import json
+import os
+import sys
+import numpy as np
+from sweref99 import to_sweref99tm
+
+DEFAULT_TOLERANCES = [1, 5, 25, 100]
+
+def to_metres(path):
+    """
+    Project [lon, lat] points to SWEREF 99 TM metres.
+    """
+    path = np.asarray(path, dtype=np.float64).reshape(-1, 2)
+    return np.column_stack(to_sweref99tm(path[:, 0], path[:, 1]))
+
+def douglas_peucker(path, tolerance):
+    """
+    Return the indices of the vertices kept when simplifying the path
+    with the given tolerance in metres.
+    """
+    points = to_metres(path)
+    if len(points) < 3:
+        return np.arange(len(points))
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start = points[first]
+        direction = points[last] - start
+        inner = points[first + 1:last] - start
+        squared_length = direction @ direction
+        if squared_length == 0:
+            distances = np.hypot(inner[:, 0], inner[:, 1])
+        else:
+            # Distance to the segment, not the infinite line
+            t = np.clip(inner @ direction / squared_length, 0, 1)
+            difference = inner - t[:, None] * direction
+            distances = np.hypot(difference[:, 0], difference[:, 1])
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            split = first + 1 + farthest
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return np.flatnonzero(keep)
+
+def simplify(path, tolerance):
+    return [path[i] for i in douglas_peucker(path, tolerance)]
+
+def levels_location(location):
+    return f"{os.path.splitext(location)[0]}.lod.json"
+
+def write_levels(path, location, tolerances=DEFAULT_TOLERANCES):
+    """
+    Write the simplified levels of detail of a route stored at the
+    given location.
+    """
+    levels = {str(tolerance): simplify(path, tolerance) for tolerance in tolerances}
+    with open(levels_location(location), 'w') as file:
+        json.dump({'points': len(path), 'levels': levels}, file)
+    return levels
+
+def load_route(location, tolerance=None):
+    """
+    Load a route, at full resolution or at the coarsest stored level
+    of detail whose tolerance (in metres) is at most the given one.
+    Levels are computed on the fly if none are stored.
+    """
+    with open(location, 'r') as file:
+        path = json.load(file)
+    if not tolerance:
+        return path
+    if os.path.exists(levels_location(location)):
+        with open(levels_location(location), 'r') as file:
+            levels = json.load(file)['levels']
+        usable = [float(level) for level in levels if float(level) <= tolerance]
+        if usable:
+            best = max(usable)
+            return next(points for level, points in levels.items() if float(level) == best)
+        return path
+    return simplify(path, tolerance)
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: python simplify_route.py <route.json> [tolerances in metres...]")
+        sys.exit(1)
+    location = sys.argv[1]
+    tolerances = [float(tolerance) for tolerance in sys.argv[2:]] or DEFAULT_TOLERANCES
+    with open(location, 'r') as file:
+        path = json.load(file)
+    levels = write_levels(path, location, tolerances)
+    for tolerance, points in levels.items():
+        print(f"{tolerance} m: {len(points)} of {len(path)} points")
+    print(f"Saved to {levels_location(location)}")
+
+if __name__ == "__main__":
+    main()
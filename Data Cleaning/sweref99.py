@@ -0,0 +1,59 @@
+"""
+Projection of WGS84 coordinates to SWEREF 99 TM (EPSG:3006).
+
+SWEREF 99 TM is the transverse Mercator projection of the Swedish
+national grid, with a scale error below 0.1 % all over Sweden, so
+lengths and offsets can be measured in plain metres however long the
+route. Uses Lantmäteriet's Gauss-Krüger formulas on the GRS 80
+ellipsoid (WGS84 and SWEREF 99 differ by far less than a metre).
+
+Run with `python sweref99.py <lon> <lat>` to print the grid coordinates
+of a point.
+"""
+
+import sys
+import numpy as np
+
+AXIS = 6378137.0
+FLATTENING = 1 / 298.257222101
+CENTRAL_MERIDIAN = 15.0
+SCALE = 0.9996
+FALSE_EASTING = 500000.0
+
+E2 = FLATTENING * (2 - FLATTENING)
+N = FLATTENING / (2 - FLATTENING)
+ROOF = AXIS / (1 + N) * (1 + N**2 / 4 + N**4 / 64)
+# Conformal latitude series
+A = E2
+B = (5 * E2**2 - E2**3) / 6
+C = (104 * E2**3 - 45 * E2**4) / 120
+D = 1237 * E2**4 / 1260
+# Series of the transverse Mercator, in multiples of 2, 4, 6 and 8
+BETA = [
+    N / 2 - 2 * N**2 / 3 + 5 * N**3 / 16 + 41 * N**4 / 180,
+    13 * N**2 / 48 - 3 * N**3 / 5 + 557 * N**4 / 1440,
+    61 * N**3 / 240 - 103 * N**4 / 140,
+    49561 * N**4 / 161280,
+]
+
+def to_sweref99tm(lons, lats):
+    """
+    The easting and northing in metres of WGS84 longitudes and
+    latitudes in degrees, as arrays.
+    """
+    lat = np.radians(np.asarray(lats, dtype=np.float64))
+    lon = np.radians(np.asarray(lons, dtype=np.float64) - CENTRAL_MERIDIAN)
+    sin2 = np.sin(lat)**2
+    conformal = lat - np.sin(lat) * np.cos(lat) * (A + sin2 * (B + sin2 * (C + sin2 * D)))
+    xi = np.arctan2(np.tan(conformal), np.cos(lon))
+    eta = np.arctanh(np.cos(conformal) * np.sin(lon))
+    northing = xi.copy()
+    easting = eta.copy()
+    for j, beta in enumerate(BETA, 1):
+        northing += beta * np.sin(2 * j * xi) * np.cosh(2 * j * eta)
+        easting += beta * np.cos(2 * j * xi) * np.sinh(2 * j * eta)
+    return SCALE * ROOF * easting + FALSE_EASTING, SCALE * ROOF * northing
+
+if __name__ == "__main__":
+    easting, northing = to_sweref99tm(float(sys.argv[1]), float(sys.argv[2]))
+    print(f"E {float(easting):.3f} N {float(northing):.3f}")
@@ -0,0 +1,151 @@
+"""
+Asyncio polling engine for TrainPosition data.
+
+Fetching, decoding and storing run as separate pipeline stages
+connected by bounded queues, so that network latency and disk
+latency overlap and the polling cadence is kept even when a single
+response or commit is slow.
+"""
+
+import asyncio
+import json
+import traceback
+from typing import Callable, List, Optional, Tuple
+import requests
+from utils import log
+import trafikverket
+import metrics
+from metrics import timer
+
+# Marks the end of the stream between stages
+STOP = None
+
+def logException(stage: str, e: Exception) -> None:
+    """
+    Log an exception of a stage like the synchronous collector does.
+    The stage carries on with its next item.
+    """
+    log(f"Exception in {stage}...")
+    log(f"---- Reason:\n{e}")
+    log(f"---- Traceback:\n{traceback.format_exc()}")
+
+async def fetchStage(buildRequest: Callable[[int], str], out: asyncio.Queue,
+                     interval: float, record: Callable[[str], None], polls: Optional[int], changeID: int = 0) -> None:
+    """
+    Long-poll TrainPosition with the changeid semantics of the
+    synchronous collector, starting from `changeID` if resuming, and
+    hand each batch of entries with its changeid to the decode stage.
+    A new request is started every `interval` seconds (or as soon as
+    the previous one returns, if it took longer).
+    """
+    lastChangeID = changeID
+    text = ""
+    loop = asyncio.get_running_loop()
+    while polls is None or polls > 0:
+        started = loop.time()
+        try:
+            with timer("build"):
+                req = buildRequest(lastChangeID)
+            with timer("http"):
+                resp = await asyncio.to_thread(trafikverket.post, req, retries=0)
+            text = resp.text
+            resp.raise_for_status()
+            record(text)
+            with timer("parse"):
+                data = json.loads(text)["RESPONSE"]["RESULT"][0]
+            metrics.observeChangeID(int(data["INFO"]["LASTCHANGEID"]))
+            if lastChangeID == 0:
+                # Skip first pass, ignore potential junk data
+                lastChangeID = int(data["INFO"]["LASTCHANGEID"])
+            else:
+                await out.put((data["TrainPosition"], int(data["INFO"]["LASTCHANGEID"])))
+                metrics.observeRecords(len(data["TrainPosition"]))
+                metrics.setQueueDepth("decode", out.qsize())
+                lastChangeID = int(data["INFO"]["LASTCHANGEID"])
+                if polls is not None:
+                    polls -= 1
+        except requests.exceptions.Timeout:
+            log("---- fetchStage Timed out")
+        except ConnectionResetError:
+            log("ConnectionResetError (Irrelevant)")
+        except Exception as e:
+            logException("fetchStage", e)
+            log(f"---- Received text:\n{text}")
+        metrics.maybeLogSummary()
+        await asyncio.sleep(max(0, interval - (loop.time() - started)))
+    await out.put(STOP)
+
+async def decodeStage(decodeEntries: Callable[[List[dict]], List[Tuple]], inp: asyncio.Queue, out: asyncio.Queue) -> None:
+    """
+    Decode each batch of entries into (row, routes) pairs. A batch
+    that fails to decode is logged and dropped: the fetch stage has
+    already polled past its changeid, and retrying would fail the same
+    way, so its positions are counted as lost.
+    """
+    while True:
+        item = await inp.get()
+        metrics.setQueueDepth("decode", inp.qsize())
+        if item is STOP:
+            await out.put(STOP)
+            return
+        entries, changeID = item
+        try:
+            with timer("decode"):
+                decoded = decodeEntries(entries)
+        except Exception as e:
+            logException("decodeStage", e)
+            log(f"---- Dropped {len(entries)} positions up to changeid {changeID}")
+            metrics.addCount("dropped_positions_total", len(entries))
+            continue
+        await out.put((decoded, changeID))
+        metrics.setQueueDepth("store", out.qsize())
+
+async def storeStage(store, inp: asyncio.Queue, progress: Callable[[int], None]) -> None:
+    """
+    Queue each decoded batch on the position store and flush it off
+    the event loop, one transaction per database and batch, along
+    with its changeid. The rows of a failed flush stay queued on the
+    store and are written with the next batch.
+    """
+    processedRequests = 0
+    while True:
+        item = await inp.get()
+        metrics.setQueueDepth("store", inp.qsize())
+        if item is STOP:
+            try:
+                await asyncio.to_thread(store.flush)
+            except Exception as e:
+                logException("storeStage", e)
+            return
+        batch, changeID = item
+        try:
+            with timer("filter"):
+                for row, routes in batch:
+                    store.add(row, routes)
+            await asyncio.to_thread(store.flush, changeID)
+        except Exception as e:
+            logException("storeStage", e)
+            continue
+        if len(batch) != 0:
+            processedRequests += 1
+            if processedRequests % 100 == 0:
+                progress(processedRequests)
+
+async def runPipeline(buildRequest: Callable[[int], str], decodeEntries: Callable[[List[dict]], List[Tuple]],
+                      store, interval: float = 1, queueSize: int = 8,
+                      record: Callable[[str], None] = lambda text: None,
+                      progress: Callable[[int], None] = lambda processedRequests: None, polls: Optional[int] = None,
+                      changeID: int = 0) -> None:
+    """
+    Run the fetch, decode and store stages concurrently, from the
+    given changeid if resuming. Runs forever unless `polls` limits the
+    number of stored responses.
+    """
+    log("Starting asynchronous pollPositions...")
+    decodeQueue = asyncio.Queue(maxsize=queueSize)
+    storeQueue = asyncio.Queue(maxsize=queueSize)
+    await asyncio.gather(
+        fetchStage(buildRequest, decodeQueue, interval, record, polls, changeID),
+        decodeStage(decodeEntries, decodeQueue, storeQueue),
+        storeStage(store, storeQueue, progress),
+    )
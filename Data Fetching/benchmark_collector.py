@@ -0,0 +1,241 @@
+"""
+Offline benchmarks of the collection pipeline.
+
+Runs TrainPosition payloads, either synthetic or recorded with
+`python data_collector.py --record <file>`, through the collector and
+measures:
+
+ - decode: records/s through decodePositions
+ - routing: records/s through InclusionIndex.routeBatch
+ - process: records/s through decodeEntries (decoding, journeys and routing)
+ - storage: records/s queued and flushed to a RouteStore and a SharedStore
+ - request: time to build and render the request versus fleet size
+ - replay: records/s through the async pipeline against stub_server.py
+
+Results are written as JSON, for comparing runs. Nothing is sent to the
+real API.
+
+Run with `python benchmark_collector.py [--recording <file>] [--output results.json]`.
+"""
+
+import argparse
+import asyncio
+import json
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Callable, List
+import utils
+import trafikverket
+import data_collector
+from database import RouteStore, SharedStore
+from position_decoder import decodePositions
+from position_query import PositionQuery, COMPRESSIONS
+from stub_server import loadRecording, startStubServer
+
+FLEET_SIZES = [10, 100, 1000, 5000]
+# Synthetic routes: a box and a polygon overlapping it
+INCLUSIONS = ["17.5 59.2, 18.0 60.0", "17.8 59.3, 18.5 59.3, 18.5 60.0, 17.8 60.0"]
+
+def measure(function: Callable[[], None], repeat: int) -> float:
+    """
+    The best wall time in seconds of the given number of runs.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+def result(name: str, parameters: dict, records: int, seconds: float) -> dict:
+    return {"name": name, "parameters": parameters, "records": records, "seconds": seconds,
+            "rate": records / seconds if seconds > 0 else None}
+
+def syntheticBatches(fleetSize: int, batches: int, batchSize: int, seed: int = 0) -> List[List[dict]]:
+    """
+    TrainPosition entries of trains moving around within the synthetic
+    routes, batchSize per response.
+    """
+    rng = random.Random(seed)
+    positions = {train: [rng.uniform(17.5, 18.5), rng.uniform(59.2, 60.0)] for train in range(1, fleetSize + 1)}
+    start = datetime(2025, 3, 1, 10, tzinfo=timezone.utc)
+    result = []
+    for i in range(batches):
+        entries = []
+        for j in range(batchSize):
+            train = rng.randint(1, fleetSize)
+            position = positions[train]
+            position[0] += rng.uniform(-0.001, 0.001)
+            position[1] += rng.uniform(-0.001, 0.001)
+            timestamp = (start + timedelta(seconds=i, milliseconds=j)).isoformat(timespec="milliseconds")
+            entries.append({
+                "Train": {"OperationalTrainNumber": str(train)},
+                "ModifiedTime": timestamp,
+                "TimeStamp": timestamp,
+                "Position": {
+                    "SWEREF99TM": f"POINT ({int(position[0] * 38000)} {int(position[1] * 111000)})",
+                    "WGS84": f"POINT ({position[0]:.6f} {position[1]:.6f})",
+                },
+                "Bearing": rng.randint(0, 359),
+                "Speed": rng.randint(0, 200),
+            })
+        result.append(entries)
+    return result
+
+def recordedBatches(location: str) -> List[List[dict]]:
+    """
+    The TrainPosition entries of every recorded response but the
+    first, which the collector skips.
+    """
+    bodies = loadRecording(location)
+    return [json.loads(body)["RESPONSE"]["RESULT"][0]["TrainPosition"] for body in bodies[1:]]
+
+def fleet(batches: List[List[dict]]) -> List[List[int]]:
+    """
+    Split the trains of the payloads into two overlapping routes.
+    """
+    trains = sorted({int(entry["Train"]["OperationalTrainNumber"]) for batch in batches for entry in batch})
+    return [trains[:len(trains) * 2 // 3], trains[len(trains) // 3:]]
+
+def setup(directory: str, trains: List[List[int]], inclusions: List[str], shared: bool) -> None:
+    """
+    Set up the collector state as data_collector.setupCollection does,
+    storing into the given directory.
+    """
+    data_collector.DATA_FOLDER_DIR = directory
+    data_collector.SHARED_STORE = shared
+    data_collector.trainMap = {}
+    data_collector.trainInclusions = inclusions
+    data_collector.setupCollection([["A", "B"], ["C", "D"]], trains)
+
+def benchmarkPipeline(batches: List[List[dict]], inclusions: List[str], repeat: int) -> List[dict]:
+    records = sum(len(batch) for batch in batches)
+    trains = fleet(batches)
+    results = []
+    parameters = {"batches": len(batches), "trains": len(set(trains[0]) | set(trains[1]))}
+
+    seconds = measure(lambda: [decodePositions(batch) for batch in batches], repeat)
+    results.append(result("decode", parameters, records, seconds))
+
+    directory = tempfile.mkdtemp()
+    try:
+        setup(directory, trains, inclusions, False)
+        decoded = [decodePositions(batch) for batch in batches]
+        index = data_collector.inclusionIndex
+        seconds = measure(lambda: [index.routeBatch(batch.trains, batch.WGS84_1, batch.WGS84_2) for batch in decoded], repeat)
+        results.append(result("routing", parameters, records, seconds))
+
+        seconds = measure(lambda: [data_collector.decodeEntries(batch) for batch in batches], repeat)
+        results.append(result("process", parameters, records, seconds))
+        rows = [data_collector.decodeEntries(batch) for batch in batches]
+        data_collector.store.close()
+    finally:
+        shutil.rmtree(directory)
+
+    for shared in (False, True):
+        def store():
+            location = tempfile.mkdtemp()
+            try:
+                positions = SharedStore(f"{location}/db.sqlite3", ["A_B", "C_D"]) if shared \
+                    else RouteStore([f"{location}/db_A_B.sqlite3", f"{location}/db_C_D.sqlite3"])
+                for batch in rows:
+                    for row, routes in batch:
+                        positions.add(row, routes)
+                    positions.flush()
+                positions.close()
+            finally:
+                shutil.rmtree(location)
+        seconds = measure(store, repeat)
+        results.append(result("storage", {**parameters, "store": "shared" if shared else "route"}, records, seconds))
+    return results
+
+def benchmarkRequest(repeat: int) -> List[dict]:
+    results = []
+    for fleetSize in FLEET_SIZES:
+        # Train numbers spread over three times the fleet size, partly consecutive
+        trains = sorted(random.Random(fleetSize).sample(range(1, fleetSize * 3), fleetSize))
+        routes = [trains[:fleetSize // 2], trains[fleetSize // 2:]]
+        for compression in COMPRESSIONS:
+            def build():
+                query = PositionQuery(compression)
+                query.update(routes, INCLUSIONS)
+                query.render(1)
+            seconds = measure(build, repeat)
+            query = PositionQuery(compression)
+            query.update(routes, INCLUSIONS)
+            parameters = {"trains": fleetSize, "compression": compression, "bytes": len(query.render(1).encode("utf-8"))}
+            results.append(result("request", parameters, 1, seconds))
+            seconds = measure(lambda: query.render(1), repeat)
+            results.append(result("render", parameters, 1, seconds))
+    return results
+
+def benchmarkReplay(batches: List[List[dict]], inclusions: List[str]) -> List[dict]:
+    """
+    Poll the payloads from a local stub server through the async
+    pipeline, without waiting between polls.
+    """
+    bodies = [json.dumps({"RESPONSE": {"RESULT": [{"TrainPosition": batch, "INFO": {"LASTCHANGEID": str(i + 1)}}]}})
+              for i, batch in enumerate([[]] + batches)]
+    server = startStubServer(bodies)
+    trafikverket.TRAFIKVERKET_URL = f"http://127.0.0.1:{server.server_address[1]}"
+    directory = tempfile.mkdtemp()
+    try:
+        trains = fleet(batches)
+        setup(directory, trains, inclusions, False)
+        started = time.perf_counter()
+        asyncio.run(data_collector.runPipeline(data_collector.positionQuery.render, data_collector.decodeEntries,
+                                               data_collector.store, interval=0, polls=len(batches)))
+        seconds = time.perf_counter() - started
+        data_collector.store.close()
+    finally:
+        shutil.rmtree(directory)
+        server.shutdown()
+    records = sum(len(batch) for batch in batches)
+    return [result("replay", {"batches": len(batches)}, records, seconds)]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the collection pipeline offline.")
+    parser.add_argument("--recording", help="recorded responses (data_collector.py --record) instead of synthetic ones")
+    parser.add_argument("--trains", type=int, default=500, help="synthetic fleet size (default 500)")
+    parser.add_argument("--batches", type=int, default=200, help="synthetic responses (default 200)")
+    parser.add_argument("--batch-size", dest="batchSize", type=int, default=200, help="positions per synthetic response (default 200)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per benchmark, the best is reported (default 3)")
+    parser.add_argument("--output", help="write the results to this file instead of stdout")
+    args = parser.parse_args()
+    utils.LOGGING = False
+    utils.PRINTING = False
+
+    if args.recording:
+        batches = recordedBatches(args.recording)
+        # Recorded positions are outside the synthetic routes
+        inclusions = ["", ""]
+        fixture = {"recording": args.recording}
+    else:
+        batches = syntheticBatches(args.trains, args.batches, args.batchSize)
+        inclusions = INCLUSIONS
+        fixture = {"trains": args.trains, "batches": args.batches, "batchSize": args.batchSize}
+
+    results = benchmarkPipeline(batches, inclusions, args.repeat)
+    results += benchmarkRequest(args.repeat)
+    results += benchmarkReplay(batches, inclusions)
+    report = {
+        "suite": "collector",
+        "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "fixture": fixture,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""
+Collector checkpoints, stored alongside the positions.
+
+Every database keeps a collectorState table with the routes it
+collects (stations, inclusion zone and tracked trains) and the
+LASTCHANGEID its positions are complete up to. The changeid is written
+in the same transaction as the positions of its response, as is the
+journey state (see journeys), so a restarted collector continues from
+exactly what was stored, without refetching the trains
+(`python data_collector.py --resume`).
+"""
+
+import json
+import os
+import sqlite3
+from typing import List
+
+UPSERT_STATE = """INSERT INTO collectorState VALUES (?, ?)
+                ON CONFLICT (key) DO UPDATE SET value = excluded.value"""
+
+def createCollectorState(conn: sqlite3.Connection) -> None:
+    conn.execute("""CREATE TABLE IF NOT EXISTS collectorState (
+                key TEXT PRIMARY KEY,
+                value TEXT
+                )""")
+
+def saveRoutes(conn: sqlite3.Connection, routes: List[dict]) -> None:
+    """
+    Save the routes collected into the database, as dicts of their
+    stations, inclusion zone and trains.
+    """
+    with conn:
+        writeRoutes(conn, routes)
+
+def writeRoutes(conn: sqlite3.Connection, routes: List[dict]) -> None:
+    """
+    Like saveRoutes, within the transaction of a flush.
+    """
+    conn.execute(UPSERT_STATE, ("routes", json.dumps(routes)))
+
+def saveChangeID(conn: sqlite3.Connection, changeID: int) -> None:
+    """
+    Save the changeid the positions are complete up to. Call within
+    the transaction writing them.
+    """
+    conn.execute(UPSERT_STATE, ("lastChangeID", str(changeID)))
+
+def loadState(conn: sqlite3.Connection, key: str, default=None):
+    row = conn.execute("SELECT value FROM collectorState WHERE key = ?", (key,)).fetchone()
+    return default if row is None else json.loads(row[0])
+
+def loadChangeID(conn: sqlite3.Connection) -> int:
+    return loadState(conn, "lastChangeID", 0)
+
+def findRoutes(folder: str, shared: bool) -> List[dict]:
+    """
+    The routes saved in the databases of a data folder: db_shared.sqlite3,
+    or every route database.
+    """
+    if shared:
+        names = ["db_shared.sqlite3"]
+    else:
+        names = sorted(name for name in os.listdir(folder)
+                       if name.startswith("db_") and name.endswith(".sqlite3") and name != "db_shared.sqlite3")
+    routes = []
+    for name in names:
+        routes += loadRoutes(os.path.join(folder, name))
+    return routes
+
+def loadRoutes(location: str) -> List[dict]:
+    """
+    The routes saved in a database, if it exists.
+    """
+    if not os.path.exists(location):
+        return []
+    conn = sqlite3.connect(f"file:{location}?mode=ro", uri=True)
+    try:
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'collectorState'").fetchone() is None:
+            return []
+        return loadState(conn, "routes", [])
+    finally:
+        conn.close()
@@ -0,0 +1,285 @@
+"""
+Compaction of collected positions into columnar files.
+
+Closed days of the timestamps table are converted into one directory
+per day holding one .npy file per column, sorted by train, journey and
+measured time, with one row group per journey:
+
+ - measuredTime is delta encoded in milliseconds per row group
+ - receivedTime and modifiedTime are millisecond offsets from it
+ - WGS84 coordinates are fixed-point integers (1e-7 degrees)
+ - SWEREF99TM coordinates, bearing and speed are narrow integers
+ - dwellTime is in milliseconds
+
+The files are not compressed further, so that they can be memory
+mapped by the reader.
+
+Run with `python compact_positions.py <database> <output directory>`,
+which compacts every day before today that isn't compacted yet.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict, List
+import numpy as np
+from checkpoint import UPSERT_STATE
+
+FORMAT_VERSION = 2
+WGS84_SCALE = 10**7
+GROUP_DTYPE = np.dtype([
+    ("train", np.int32),
+    ("journey", np.int32),
+    ("start", np.int64),
+    ("stop", np.int64),
+    ("baseTime", np.int64),
+])
+COLUMN_DTYPES = {
+    "measuredDelta": np.uint32,
+    "receivedOffset": np.int32,
+    "modifiedOffset": np.int32,
+    "SWEREF99TM_1": np.int32,
+    "SWEREF99TM_2": np.int32,
+    "WGS84_1": np.int32,
+    "WGS84_2": np.int32,
+    "bearing": np.int16,
+    "speed": np.int16,
+    "dwellTime": np.uint32,
+}
+
+def dayBounds(day: str) -> tuple:
+    """
+    The [start, end) unix time range of a UTC day (YYYY-MM-DD).
+    """
+    start = datetime.fromisoformat(day).replace(tzinfo=timezone.utc)
+    return start.timestamp(), (start + timedelta(days=1)).timestamp()
+
+def collectedDays(conn: sqlite3.Connection) -> List[str]:
+    """
+    All UTC days with positions in the database.
+    """
+    rows = conn.execute("""SELECT DISTINCT date(measuredTime, 'unixepoch') FROM timestamps
+                        ORDER BY 1""").fetchall()
+    return [row[0] for row in rows]
+
+def dwellColumn(conn: sqlite3.Connection) -> str:
+    """
+    The dwellTime column, or 0 for databases from before the ingest
+    filter, which have no dwell times.
+    """
+    columns = [column[1] for column in conn.execute("PRAGMA table_info(timestamps)")]
+    return "dwellTime" if "dwellTime" in columns else "0"
+
+def encodeDay(rows: List[tuple]) -> tuple:
+    """
+    Encode rows sorted by train, journey and measured time into the
+    row groups and columns of a compacted day.
+    """
+    (trains, journeys, received, modified, measured,
+     sweref1, sweref2, wgs1, wgs2, bearing, speed, dwell) = zip(*rows)
+    trains = np.array(trains, dtype=np.int64)
+    journeys = np.array(journeys, dtype=np.int64)
+    measuredMs = np.round(np.array(measured, dtype=np.float64) * 1000).astype(np.int64)
+
+    # Row groups start wherever the train or journey changes
+    changes = np.flatnonzero((np.diff(trains) != 0) | (np.diff(journeys) != 0)) + 1
+    starts = np.concatenate(([0], changes))
+    stops = np.concatenate((changes, [len(rows)]))
+    groups = np.empty(len(starts), dtype=GROUP_DTYPE)
+    groups["train"] = trains[starts]
+    groups["journey"] = journeys[starts]
+    groups["start"] = starts
+    groups["stop"] = stops
+    groups["baseTime"] = measuredMs[starts]
+
+    delta = np.diff(measuredMs, prepend=measuredMs[0])
+    delta[starts] = 0
+    columns = {
+        "measuredDelta": delta,
+        "receivedOffset": np.round(np.array(received) * 1000).astype(np.int64) - measuredMs,
+        "modifiedOffset": np.round(np.array(modified) * 1000).astype(np.int64) - measuredMs,
+        "SWEREF99TM_1": np.array(sweref1, dtype=np.float64),
+        "SWEREF99TM_2": np.array(sweref2, dtype=np.float64),
+        "WGS84_1": np.round(np.array(wgs1, dtype=np.float64) * WGS84_SCALE),
+        "WGS84_2": np.round(np.array(wgs2, dtype=np.float64) * WGS84_SCALE),
+        "bearing": np.array([-1 if b is None else b for b in bearing]),
+        "speed": np.array([-1 if s is None else s for s in speed]),
+        "dwellTime": np.round(np.array(dwell, dtype=np.float64) * 1000),
+    }
+    return groups, {name: column.astype(COLUMN_DTYPES[name]) for name, column in columns.items()}
+
+def compactDay(conn: sqlite3.Connection, day: str, directory: str) -> int:
+    """
+    Write the positions measured on the given UTC day into
+    `directory/day`, and return the number of rows.
+    """
+    start, end = dayBounds(day)
+    dwell = dwellColumn(conn)
+    rows = conn.execute(f"""SELECT operationalTrainNumber, journeyNumber, receivedTime, modifiedTime, measuredTime,
+                        SWEREF99TM_1, SWEREF99TM_2, WGS84_1, WGS84_2, bearing, speed, {dwell}
+                        FROM timestamps WHERE measuredTime >= ? AND measuredTime < ?
+                        ORDER BY operationalTrainNumber, journeyNumber, measuredTime""", (start, end)).fetchall()
+    if not rows:
+        return 0
+    groups, columns = encodeDay(rows)
+    # Write to a temporary directory first, so readers never see half a day
+    target = Path(directory) / day
+    temporary = Path(directory) / f".{day}.tmp"
+    shutil.rmtree(temporary, ignore_errors=True)
+    temporary.mkdir(parents=True)
+    np.save(temporary / "groups.npy", groups)
+    for name, column in columns.items():
+        np.save(temporary / f"{name}.npy", column)
+    with open(temporary / "meta.json", "w") as f:
+        json.dump({"version": FORMAT_VERSION, "day": day, "rows": len(rows), "groups": len(groups),
+                   "wgs84Scale": WGS84_SCALE}, f, indent=2)
+    os.replace(temporary, target)
+    return len(rows)
+
+def deleteDay(conn: sqlite3.Connection, day: str) -> None:
+    """
+    Delete the positions of a compacted day from the database, and
+    update the summaries of their journeys (see journeys) to the
+    positions left, removing journeys that have none.
+    """
+    start, end = dayBounds(day)
+    with conn:
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master")}
+        # Databases from before the journey summaries have no journeys table
+        affected = []
+        if "journeys" in tables:
+            affected = conn.execute("""SELECT DISTINCT operationalTrainNumber, journeyNumber FROM timestamps
+                                    WHERE measuredTime >= ? AND measuredTime < ?""", (start, end)).fetchall()
+        if "routePositions" in tables:
+            conn.execute("""DELETE FROM routePositions WHERE positionId IN
+                         (SELECT rowid FROM timestamps WHERE measuredTime >= ? AND measuredTime < ?)""", (start, end))
+        conn.execute("DELETE FROM timestamps WHERE measuredTime >= ? AND measuredTime < ?", (start, end))
+        if "journeys" in tables:
+            # A stationary run extends its journey to the end of its dwell time
+            conn.executemany(f"""UPDATE journeys SET (startTime, endTime, firstRow, lastRow, pointCount,
+                             minLon, minLat, maxLon, maxLat) = (
+                                 SELECT MIN(measuredTime), MAX(measuredTime + {dwellColumn(conn)}), MIN(rowid), MAX(rowid), COUNT(*),
+                                 MIN(WGS84_1), MIN(WGS84_2), MAX(WGS84_1), MAX(WGS84_2)
+                                 FROM timestamps
+                                 WHERE operationalTrainNumber = journeys.operationalTrainNumber
+                                 AND journeyNumber = journeys.journeyNumber)
+                             WHERE operationalTrainNumber = ? AND journeyNumber = ?""", affected)
+            conn.executemany("""DELETE FROM journeys WHERE operationalTrainNumber = ? AND journeyNumber = ?
+                             AND pointCount = 0""", affected)
+        if "collectorState" in tables:
+            # Tells readers caching the positions (see plot_server) that they changed
+            conn.execute(UPSERT_STATE, ("lastCompaction", json.dumps(day)))
+
+def compact(database: str, directory: str, before: str, delete: bool = False) -> None:
+    """
+    Compact every day before the given UTC day that hasn't been
+    compacted into the directory yet.
+    """
+    conn = sqlite3.connect(database)
+    for day in collectedDays(conn):
+        if day >= before or (Path(directory) / day).exists():
+            continue
+        count = compactDay(conn, day, directory)
+        print(f"Compacted {count} positions from {day}")
+        if delete:
+            deleteDay(conn, day)
+    conn.close()
+
+class CompactedDay:
+    """
+    A compacted day, with its columns memory mapped on first use.
+    """
+
+    def __init__(self, location: Path):
+        self.location = location
+        with open(location / "meta.json", "r") as f:
+            self.meta = json.load(f)
+        self.groups = np.load(location / "groups.npy")
+        self.columns: Dict[str, np.ndarray] = {}
+
+    def column(self, name: str) -> np.ndarray:
+        if name not in self.columns:
+            if name == "dwellTime" and self.meta["version"] < 2:
+                self.columns[name] = np.zeros(self.meta["rows"], dtype=COLUMN_DTYPES[name])
+            else:
+                self.columns[name] = np.load(self.location / f"{name}.npy", mmap_mode="r")
+        return self.columns[name]
+
+    def decode(self, start: int, stop: int, groupIndices: np.ndarray) -> Dict[str, np.ndarray]:
+        """
+        Decode rows [start, stop) spanning the given whole row groups.
+        """
+        groups = self.groups[groupIndices]
+        counts = groups["stop"] - groups["start"]
+        cumulative = np.cumsum(self.column("measuredDelta")[start:stop], dtype=np.int64)
+        groupOffsets = groups["baseTime"] - cumulative[groups["start"] - start]
+        measuredMs = cumulative + np.repeat(groupOffsets, counts)
+        scale = self.meta["wgs84Scale"]
+        return {
+            "operationalTrainNumber": np.repeat(groups["train"], counts),
+            "journeyNumber": np.repeat(groups["journey"], counts),
+            "measuredTime": measuredMs / 1000,
+            "receivedTime": (measuredMs + self.column("receivedOffset")[start:stop]) / 1000,
+            "modifiedTime": (measuredMs + self.column("modifiedOffset")[start:stop]) / 1000,
+            "SWEREF99TM_1": np.asarray(self.column("SWEREF99TM_1")[start:stop]),
+            "SWEREF99TM_2": np.asarray(self.column("SWEREF99TM_2")[start:stop]),
+            "WGS84_1": self.column("WGS84_1")[start:stop] / scale,
+            "WGS84_2": self.column("WGS84_2")[start:stop] / scale,
+            "bearing": np.asarray(self.column("bearing")[start:stop]),
+            "speed": np.asarray(self.column("speed")[start:stop]),
+            "dwellTime": self.column("dwellTime")[start:stop] / 1000,
+        }
+
+def openDays(directory: str) -> List[CompactedDay]:
+    return [CompactedDay(location) for location in sorted(Path(directory).iterdir())
+            if location.is_dir() and not location.name.startswith(".")]
+
+def concatenate(parts: List[Dict[str, np.ndarray]]) -> Dict[str, np.ndarray]:
+    if not parts:
+        return {}
+    return {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+
+def loadJourney(directory: str, train: int, journey: int) -> Dict[str, np.ndarray]:
+    """
+    Load all positions of a journey as NumPy arrays, one per column,
+    ordered by measured time.
+    """
+    parts = []
+    for day in openDays(directory):
+        groups = day.groups
+        matches = np.flatnonzero((groups["train"] == train) & (groups["journey"] == journey))
+        for index in matches:
+            parts.append(day.decode(int(groups["start"][index]), int(groups["stop"][index]), np.array([index])))
+    return concatenate(parts)
+
+def loadTimeRange(directory: str, start: float, end: float) -> Dict[str, np.ndarray]:
+    """
+    Load all positions measured within [start, end) as NumPy arrays,
+    one per column, grouped by day, train and journey.
+    """
+    parts = []
+    for day in openDays(directory):
+        dayStart, dayEnd = dayBounds(day.meta["day"])
+        if dayEnd <= start or dayStart >= end:
+            continue
+        decoded = day.decode(0, day.meta["rows"], np.arange(len(day.groups)))
+        keep = (decoded["measuredTime"] >= start) & (decoded["measuredTime"] < end)
+        parts.append({name: column[keep] for name, column in decoded.items()})
+    return concatenate(parts)
+
+def main():
+    parser = argparse.ArgumentParser(description="Compact closed days of collected positions into columnar files.")
+    parser.add_argument("database", help="position database, e.g. db_Cst_U.sqlite3")
+    parser.add_argument("directory", help="output directory, one subdirectory per day")
+    parser.add_argument("--before", default=datetime.now(timezone.utc).date().isoformat(),
+                        help="compact days before this UTC day (YYYY-MM-DD, default today)")
+    parser.add_argument("--delete", action="store_true", help="delete compacted positions from the database")
+    args = parser.parse_args()
+    compact(args.database, args.directory, args.before, args.delete)
+
+if __name__ == '__main__':
+    main()
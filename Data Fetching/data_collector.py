@@ -3,35 +3,71 @@ from dotenv import load_dotenv
 import requests
 import json
 from datetime import datetime
-from utils import log
+import utils
+from utils import log, Lazy
 from typing import List
 from pathlib import Path
-from get_trains import getTrains, saveTrains
+from get_trains import getTrains, saveTrains, fetchStations, loadStationActivities
 import shutil
 import time
-import sqlite3
-from geomet import wkt
+import threading
+from database import RouteStore, SharedStore
+from position_decoder import decodePositions
+from inclusion_index import InclusionIndex
+from station_catalog import loadCatalog
 import traceback
-import time
+import argparse
+import asyncio
+from async_collector import runPipeline
+import trafikverket
+from position_query import PositionQuery, COMPRESSIONS
+from journeys import JourneySegmenter
+from ingest_filter import IngestFilter, DUPLICATE, STATIONARY
+from functools import partial
+from checkpoint import findRoutes, loadRoutes
+from train_refresher import TrainRefresher, diffTrains, logChanges
+import metrics
+from metrics import timer
+from sharded_collector import Coordinator, startHeartbeat
 
 load_dotenv("../.env")
-TRAFIKVERKET_API_KEY = os.getenv("TRAFIKVERKET_API_KEY")
-TRAFIKVERKET_URL = "https://api.trafikinfo.trafikverket.se/v2/data.json"
 SJ_API_KEY = os.getenv("SJ_API_KEY")
 DATA_FOLDER_DIR = os.getenv("DATA_FOLDER_DIR")
+RECORD_FILE = ""
+RESUME = False
+ASYNC_MODE = False
+POLL_INTERVAL = 1
+FILTER_COMPRESSION = "eq"
+SHARED_STORE = False
+DEDUPE = True
+COLLAPSE_STATIONARY = False
+STATIONARY_DISTANCE = 0
+SHARDS = 1
+REFRESH_INTERVAL = 60*60
+METRICS_PORT = 0
+# Passed on to the worker processes of a sharded collection
+CONFIG_NAMES = ["DATA_FOLDER_DIR", "RECORD_FILE", "ASYNC_MODE", "POLL_INTERVAL", "FILTER_COMPRESSION",
+                "SHARED_STORE", "DEDUPE", "COLLAPSE_STATIONARY", "STATIONARY_DISTANCE", "METRICS_PORT",
+                "REFRESH_INTERVAL"]
 
 trainInclusions = []
 trainMap = {}
-receivedResponse = ""
-databases = []
-trainJourneyNumber = {}
-trainLastSeen = {}
-trainLastPositionSWEREF = {}
+trackedTrains = []
+# Guards trainMap, trackedTrains and inclusionIndex while the trains are refreshed
+trainsLock = threading.Lock()
+store = None
+positionQuery = None
+inclusionIndex = None
+segmenter = None
 
 def createDataFolder() -> None:
     """
-    Create the data directory and make sure it didn't exist before.
+    Create the data directory and make sure it didn't exist before,
+    unless resuming the collection in it.
     """
+    if RESUME:
+        Path(DATA_FOLDER_DIR).mkdir(parents=True, exist_ok=True)
+        return
     while True:
         file = Path(DATA_FOLDER_DIR)
         if file.exists():
@@ -43,25 +79,77 @@ def createDataFolder() -> None:
         file.mkdir(parents=True, exist_ok=True)
         break
 
-def fetchPositions(stations: List[List[str]]) -> None:
+def fetchPositions(stations: List[List[str]], trains: List[List[int]] = None) -> None:
     """
     Takes a list of station-lists, sets up the data directory
     and starts endlessly polling for the positional data of all
     trains moving between the station-lists, regardless of order,
-    and within the inclusion-box (if specified).
+    and within the inclusion-box (if specified). The trains are
+    fetched unless given (when resuming).
     """
     log(f"Starting data collection between stations:")
     global trainInclusions
     for locations, inclusion in zip(stations, trainInclusions):
         log(f" - {" and ".join(locations)} {f"within box {inclusion}" if inclusion != "" else ""}")
-    trains = getAllTrains(stations)
-    pollPositions(stations, trains)
+    if trains is None:
+        trains = getAllTrains(stations)
+    if SHARDS > 1:
+        config = {name: globals()[name] for name in CONFIG_NAMES}
+        config["SUMMARY_INTERVAL"] = metrics.SUMMARY_INTERVAL
+        Coordinator(runShard, stations, trains, trainInclusions, SHARDS, (config,)).run()
+    else:
+        collect(stations, trains)
+
+def collect(stations: List[List[str]], trains: List[List[int]]) -> None:
+    """
+    Poll the positions of the given trains in the configured mode.
+    """
+    if ASYNC_MODE:
+        asyncio.run(pollPositionsAsync(stations, trains))
+    else:
+        pollPositions(stations, trains)
+
+def runShard(shard: int, stations: List[List[str]], trains: List[List[int]], inclusions: List[str],
+             config: dict, heartbeats) -> None:
+    """
+    Collect the routes of one shard, in a worker process started by
+    the sharded collector. Logs to log_shard<number>.txt. Routes
+    already saved in their database, by an earlier worker that was
+    restarted or handed them over, continue with the trains saved
+    there, which the train refresh may have updated since the start.
+    """
+    global trainInclusions, RECORD_FILE
+    metrics.SUMMARY_INTERVAL = config.pop("SUMMARY_INTERVAL")
+    globals().update(config)
+    trainInclusions = inclusions
+    utils.loglocation = f"{DATA_FOLDER_DIR}/log_shard{shard}.txt"
+    utils.PRINTING = False
+    if RECORD_FILE != "":
+        RECORD_FILE = f"{RECORD_FILE}.shard{shard}"
+    if METRICS_PORT:
+        metrics.addSource(collectorGauges)
+        metrics.startMetricsServer(METRICS_PORT + shard)
+    startHeartbeat(shard, heartbeats)
+    collect(stations, savedTrains(stations, trains))
+
+def savedTrains(stations: List[List[str]], trains: List[List[int]]) -> List[List[int]]:
+    """
+    The trains saved in the database of every route (see checkpoint),
+    or the given ones for routes without a database yet.
+    """
+    result = []
+    for locations, trainList in zip(stations, trains):
+        saved = loadRoutes(f"{DATA_FOLDER_DIR}/db_{"_".join(locations)}.sqlite3")
+        result.append(saved[0]["trains"] if saved and saved[0]["stations"] == locations else trainList)
+    return result
 
 def getAllTrains(stations: List[List[str]]) -> List[List[int]]:
     """
     Get the trains (identified by OperationalTrainNumber) for all
     station-lists and save them in the corresponding data folders.
     """
+    # Fetch every station once, even if it is part of several routes
+    fetchStations([location for locations in stations for location in locations])
     result = []
     for locations in stations:
         trains = getTrains(*locations)
@@ -69,101 +157,158 @@ def getAllTrains(stations: List[List[str]]) -> List[List[int]]:
         saveTrains(f"{DATA_FOLDER_DIR}/trains_{"_".join(locations)}.txt", trains)
     return result
 
-def pollPositions(stations: List[List[str]], trains: List[List[int]]) -> None:
+def setupCollection(stations: List[List[str]], trains: List[List[int]]) -> None:
     """
-    Endlessly poll the positions of the given trains and stores it
-    to database. 
+    Create the position store, and the lookup state shared by all
+    polling modes.
     """
     # Setup SQLite databases
     log("Setting up the databases...")
-    global databases
-    for locations in stations:
-        databases.append(sqlite3.connect(f"{DATA_FOLDER_DIR}/db_{"_".join(locations)}.sqlite3"))
-        conn = databases[-1]
-        cur = conn.cursor()
-        cur.execute("""CREATE TABLE timestamps (
-                    operationalTrainNumber INTEGER,
-                    journeyNumber INTEGER,
-                    receivedTime REAL, 
-                    modifiedTime REAL, 
-                    measuredTime REAL,
-                    SWEREF99TM_1 INTEGER,
-                    SWEREF99TM_2 INTEGER,
-                    WGS84_1 REAL,
-                    WGS84_2 REAL,
-                    bearing INTEGER,
-                    speed INTEGER
-                    )""")
-        conn.commit()
+    global store
+    routeNames = ["_".join(locations) for locations in stations]
+    newFilter = partial(IngestFilter, DEDUPE, COLLAPSE_STATIONARY, STATIONARY_DISTANCE)
+    if SHARED_STORE:
+        store = SharedStore(f"{DATA_FOLDER_DIR}/db_shared.sqlite3", routeNames, newFilter)
+    else:
+        store = RouteStore([f"{DATA_FOLDER_DIR}/db_{name}.sqlite3" for name in routeNames], newFilter)
     
     # Reverse lookup data structure for train id -> route id
-    global trainMap
+    global trainMap, trackedTrains
     for id, trainList in enumerate(trains):
         for train in trainList:
             trainMap.setdefault(train, []).append(id)
-    # Pre-mark last seen timestamps
-    for trainList in trains:
+    trackedTrains = trains
+    # Continue the journey numbering persisted by the store, and pre-mark
+    # last seen timestamps of the other trains
+    global segmenter
+    segmenter = JourneySegmenter(store.trainState())
+    segmenter.track(trainMap, datetime.now().timestamp())
+    # Parse the inclusion zones and render the request filter once
+    global inclusionIndex
+    global positionQuery
+    inclusionIndex = InclusionIndex(trains, trainInclusions)
+    positionQuery = PositionQuery(FILTER_COMPRESSION)
+    positionQuery.update(trains, inclusionIndex.filterBoxes())
+    # Saved with the data, so that the collection can be resumed
+    store.saveRoutes(routeState(stations, trains))
+
+def routeState(stations: List[List[str]], trains: List[List[int]]) -> List[dict]:
+    """
+    The routes as saved in the databases (see checkpoint).
+    """
+    return [{"stations": locations, "inclusion": inclusion, "trains": trainList}
+            for locations, inclusion, trainList in zip(stations, trainInclusions, trains)]
+
+def updateTrains(stations: List[List[str]], trains: List[List[int]], removals: bool = True) -> None:
+    """
+    Track the given trains of every route from now on, without
+    stopping the polling: the lookup state and request filter are
+    replaced under trainsLock, and the routes are saved with the next
+    flush. Without removals, the given trains are only added.
+    """
+    global trainMap, trackedTrains, inclusionIndex
+    if not removals:
+        trains = [sorted(set(old) | set(new)) for old, new in zip(trackedTrains, trains)]
+    changes = diffTrains(trackedTrains, trains)
+    if not any(added or removed for added, removed in changes):
+        return
+    logChanges(stations, changes)
+    newMap = {}
+    for id, trainList in enumerate(trains):
         for train in trainList:
-            trainLastSeen[train] = datetime.now().timestamp()
+            newMap.setdefault(train, []).append(id)
+    newIndex = InclusionIndex(trains, trainInclusions)
+    with trainsLock:
+        segmenter.track(newMap, datetime.now().timestamp())
+        trainMap = newMap
+        trackedTrains = trains
+        inclusionIndex = newIndex
+        positionQuery.update(trains, newIndex.filterBoxes())
+    store.updateRoutes(routeState(stations, trains))
+
+def refreshTrains(stations: List[List[str]]) -> None:
+    """
+    Every REFRESH_INTERVAL seconds, apply the announcement changes at
+    the stations and update the tracked trains. Runs in a background
+    thread. The refresher starts from the announcements looked up at
+    startup, if this process has them (or they are cached), and the
+    first update waits an interval too; it fetches every announcement
+    at the stations, and later ones only what changed since. Trains
+    are only removed after an update that received every change.
+    """
+    refresher = TrainRefresher(stations)
+    seed = {signature: loadStationActivities(signature) for signature in refresher.signatures}
+    refresher.seed({signature: activities for signature, activities in seed.items() if activities is not None})
+    while True:
+        time.sleep(REFRESH_INTERVAL)
+        try:
+            changes = refresher.update()
+            log(f"Refreshed trains from {changes} changed announcements"
+                + ("" if refresher.complete else ", not all changes received, keeping missing trains"))
+            updateTrains(stations, refresher.trains(), removals=refresher.complete)
+        except Exception as e:
+            log("Exception in refreshTrains...")
+            log(f"---- Reason:\n{e}")
+            log(f"---- Traceback:\n{traceback.format_exc()}")
+
+def startTrainRefresh(stations: List[List[str]]) -> None:
+    if REFRESH_INTERVAL > 0:
+        threading.Thread(target=refreshTrains, args=(stations,), name="train-refresh", daemon=True).start()
+
+def recordResponse(text: str) -> None:
+    """
+    Append a raw response body to the recording file, if recording.
+    """
+    if RECORD_FILE != "":
+        with open(RECORD_FILE, "a") as f:
+            f.write(text.replace("\n", "") + "\n")
+
+def pollPositions(stations: List[List[str]], trains: List[List[int]]) -> None:
+    """
+    Endlessly poll the positions of the given trains and stores it
+    to database. 
+    """
+    setupCollection(stations, trains)
+    startTrainRefresh(stations)
     
     # Start polling
-    headers = {
-        "Content-Type": "application/xml"
-    }
     processedRequests = 0
-    lastChangeID = 0
-    global receivedResponse
-    global trainInclusions
+    lastChangeID = store.checkpoint()
     text = ""
-    log("Starting pollPositions...")
+    log("Starting pollPositions..." if lastChangeID == 0 else f"Resuming pollPositions from changeid {lastChangeID}...")
     while True:
+        obj = None
         try:
-            req = f"""
-            <REQUEST>
-                <LOGIN authenticationkey="{TRAFIKVERKET_API_KEY}"/>
-                <QUERY changeid="{lastChangeID}" objecttype="TrainPosition" namespace="järnväg.trafikinfo" schemaversion="1.1" limit="10000">
-                <FILTER>
-                    <AND>
-                        <EQ name="Status.Active" value="true" />
-                        <OR>
-                            {"\n".join([f"""
-                                <AND>
-                                    <OR>
-                                        {"\n".join([
-                                            f'<EQ name="Train.OperationalTrainNumber" value="{trainNumber}" />' for trainNumber in trainList
-                                        ])}
-                                    </OR>
-                                    {f'<WITHIN name="Position.WGS84" shape="box" value="{box}" />' if box != "" else ""} 
-                                </AND>""" for trainList, box in zip(trains, trainInclusions)
-                            ])}
-                        </OR>
-                    </AND>
-                </FILTER>
-                </QUERY>
-            </REQUEST>
-            """
-            resp = requests.post(TRAFIKVERKET_URL, data = req, headers = headers, timeout=10)
+            with timer("build"):
+                req = positionQuery.render(lastChangeID)
+            # Not retried here, the next poll continues from the same changeid
+            with timer("http"):
+                resp = trafikverket.post(req, retries=0)
             text = resp.text
-            obj = resp.json()
-            receivedResponse = json.dumps(obj, indent=2)
+            resp.raise_for_status()
+            recordResponse(text)
+            with timer("parse"):
+                obj = resp.json()
             data = obj["RESPONSE"]["RESULT"][0]
+            metrics.observeChangeID(int(data["INFO"]["LASTCHANGEID"]))
             if lastChangeID == 0:
                 # Skip first pass, ignore potential junk data
                 lastChangeID = int(data["INFO"]["LASTCHANGEID"])
                 continue
 
             # Store to database
-            for entry in data["TrainPosition"]:
-                processResponse(entry)
+            processResponse(data["TrainPosition"])
+            metrics.observeRecords(len(data["TrainPosition"]))
             if len(data["TrainPosition"]) != 0:
                 processedRequests += 1
                 if processedRequests % 100 == 0:
-                    log(f"Processed {processedRequests} requests...")
+                    logProgress(processedRequests)
 
-            # Commit database transactions and finalize
-            for conn in databases:
-                conn.commit()
+            # Flush buffered rows with their changeid, one transaction per database.
+            # The rows are queued now, so a failed flush is retried with the next
+            # response rather than by polling this one again.
             lastChangeID = int(data["INFO"]["LASTCHANGEID"])
+            store.flush(lastChangeID)
         except requests.exceptions.Timeout:
             log("---- pollPositions Timed out")
         except ConnectionResetError:
@@ -173,90 +318,167 @@ def pollPositions(stations: List[List[str]], trains: List[List[int]]) -> None:
             log(f"---- Reason:\n{e}")
             log(f"---- Traceback:\n{traceback.format_exc()}")
             log(f"---- Received text:\n{text}")
-            log(f"---- Received response:\n{receivedResponse}")
-        time.sleep(1)
+            if obj is not None:
+                # Pretty-printed by the log writer, only when something went wrong
+                log("---- Received response:\n%s", Lazy(json.dumps, obj, indent=2))
+        metrics.maybeLogSummary()
+        time.sleep(POLL_INTERVAL)
+
+async def pollPositionsAsync(stations: List[List[str]], trains: List[List[int]], polls: int = None) -> None:
+    """
+    Like pollPositions, but with fetching, decoding and storing
+    running as concurrent pipeline stages (see async_collector).
+    """
+    setupCollection(stations, trains)
+    startTrainRefresh(stations)
+    await runPipeline(positionQuery.render, decodeEntries, store, interval=POLL_INTERVAL, record=recordResponse,
+                      progress=logProgress, polls=polls, changeID=store.checkpoint())
+
+def logProgress(processedRequests: int) -> None:
+    """
+    Log the number of processed requests, the HTTP client counters
+    and the rows dropped by the ingest filter.
+    """
+    stats = trafikverket.getStats()
+    counts = store.ingestCounts()
+    log(f"Processed {processedRequests} requests... "
+        f"(mean latency {stats["meanLatency"]*1000:.0f} ms, max {stats["maxLatency"]*1000:.0f} ms, "
+        f"{stats["retries"]} retries, {stats["failures"]} failures, "
+        f"{counts[DUPLICATE]} duplicate and {counts[STATIONARY]} stationary rows dropped)")
 
-def processResponse(data):
+def collectorGauges() -> dict:
     """
-    Process the incoming data object for a train position response
-    by inserting it into the databases.
+    The HTTP client and ingest filter counters, for the metrics
+    endpoint.
+    """
+    stats = trafikverket.getStats()
+    gauges = {
+        "http_requests_total": stats["requests"],
+        "http_retries_total": stats["retries"],
+        "http_failures_total": stats["failures"],
+    }
+    if store is not None:
+        for action, count in store.ingestCounts().items():
+            gauges[f"rows_{action}_total"] = count
+    return gauges
+
+def processResponse(entries):
+    """
+    Process the entries of a train position response by queueing
+    them on the position store.
+    """
+    with timer("decode"):
+        decoded = decodeEntries(entries)
+    with timer("filter"):
+        for row, routes in decoded:
+            store.add(row, routes)
+
+def decodeEntries(entries):
+    """
+    Decode the entries of a train position response into database
+    rows, each paired with the route numbers it should be stored in.
+    Entries that couldn't be decoded are logged and skipped.
     """
     # operationalTrainNumber, journeyNumber,
     # receivedTime, modifiedTime, measuredTime, 
     # SWEREF99TM_1, SWEREF99TM_2, WGS84_1, WGS84_2, 
     # bearing, speed
-    global trainJourneyNumber
-    global trainLastSeen
-    global trainLastPositionSWEREF
-    try:
-        dbs = getDBs(data)
-        operationalTrainNumber = int(data["Train"]["OperationalTrainNumber"])
-        receivedTime = datetime.now().timestamp()
-        modifiedTime = datetime.fromisoformat(data["ModifiedTime"]).timestamp()
-        measuredTime = datetime.fromisoformat(data["TimeStamp"]).timestamp()
-        if measuredTime - trainLastSeen.get(operationalTrainNumber, 0) > 60*60:
-            trainJourneyNumber[operationalTrainNumber] = trainJourneyNumber.get(operationalTrainNumber, 0) + 1
-        journeyNumber = trainJourneyNumber.get(operationalTrainNumber, 0)
-        trainLastSeen[operationalTrainNumber] = measuredTime
+    batch = decodePositions(entries)
+    for data, e in batch.failed:
+        log("FATAL - Couldn't process data response entry:\n%s", Lazy(json.dumps, data, indent=2))
+        log(f"---- Reason:\n{e}")
+        log(f"---- Traceback:\n{"".join(traceback.format_exception(e))}")
+    receivedTime = datetime.now().timestamp()
+    metrics.observeLag(receivedTime, batch.modifiedTimes)
+    with trainsLock:
+        index, tracked = inclusionIndex, trainMap
+    routes = index.routeBatch(batch.trains, batch.WGS84_1, batch.WGS84_2)
+    decoded = []
+    for i in range(len(batch)):
+        operationalTrainNumber = batch.trains[i]
+        if operationalTrainNumber not in tracked:
+            # Only matched by a compressed filter, not tracked
+            continue
+        measuredTime = batch.measuredTimes[i]
+        journeyNumber = segmenter.assign(operationalTrainNumber, measuredTime)
 
+        SWEREF99TM = (batch.SWEREF99TM_1[i], batch.SWEREF99TM_2[i])
         # # Skip entirely if it's the 0:th journey, aka already ongoing
         # if journeyNumber == 0:
-        #     return
-        # # Skip entirely if it is the same position as before
-        # sameSWEREF = data["Position"]["SWEREF99TM"] == trainLastPositionSWEREF.get(operationalTrainNumber)
-        # if sameSWEREF:
-        #     return
-        
-        sweref = wkt.loads(data["Position"]["SWEREF99TM"])
-        SWEREF99TM_1 = sweref["coordinates"][0]
-        SWEREF99TM_2 = sweref["coordinates"][1]
-        wgs = wkt.loads(data["Position"]["WGS84"])
-        WGS84_1 = wgs["coordinates"][0]
-        WGS84_2 = wgs["coordinates"][1]
-        trainLastPositionSWEREF[operationalTrainNumber] = data["Position"]["SWEREF99TM"]
-
-        bearing = int(data.get("Bearing") or -1)
-        speed = data.get("Speed")
-
-        for db in dbs:
-            db.execute("INSERT INTO timestamps VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", 
-                        (operationalTrainNumber, journeyNumber,
-                        receivedTime, modifiedTime, measuredTime,
-                        SWEREF99TM_1, SWEREF99TM_2, WGS84_1, WGS84_2,
-                        bearing, speed))
-    except Exception as e: 
-        log(f"FATAL - Couldn't process data response entry:\n{json.dumps(data, indent=2)}")
-        log(f"---- Reason:\n{e}")
-        log(f"---- Traceback:\n{traceback.format_exc()}")
-
-def getDBs(data):
-    global trainMap
-    global databases
-    global trainInclusions
-    otn = int(data["Train"]["OperationalTrainNumber"])
-    dbs = []
-    # Check if the train is within its database's inclusion zone
-    for routeNumber in trainMap.get(otn):
-        inclusion = trainInclusions[routeNumber]
-        if inclusion == "":
-            dbs.append(databases[routeNumber].cursor())
-            continue
-        inclusionPoints = [list(map(float, a.split(" "))) for a in inclusion.split(", ")]
-        x = [p[0] for p in inclusionPoints]
-        y = [p[1] for p in inclusionPoints]
-        x.sort(), y.sort()
-        wgs = wkt.loads(data["Position"]["WGS84"])
-        WGS84_X = wgs["coordinates"][0]
-        WGS84_Y = wgs["coordinates"][1]
-        if WGS84_X > x[0] and WGS84_X < x[1] and WGS84_Y > y[0] and WGS84_Y < y[1]:
-            dbs.append(databases[routeNumber].cursor())
-    return dbs
+        #     continue
+        # Repeated and stationary positions are filtered by the store (see ingest_filter)
 
+        row = (operationalTrainNumber, journeyNumber,
+               receivedTime, batch.modifiedTimes[i], measuredTime,
+               SWEREF99TM[0], SWEREF99TM[1], batch.WGS84_1[i], batch.WGS84_2[i],
+               batch.bearings[i], batch.speeds[i])
+        decoded.append((row, routes[i]))
+    return decoded
 
 def main():
+    parser = argparse.ArgumentParser(description="Collect train positions between stations.")
+    parser.add_argument("--async", dest="asyncMode", action="store_true",
+                        help="run fetching, decoding and storing as concurrent pipeline stages")
+    parser.add_argument("--interval", type=float, default=1, help="seconds between polls (default 1)")
+    parser.add_argument("--filter", choices=COMPRESSIONS, default="eq",
+                        help="how train numbers are written in the request filter: one EQ per train (default), "
+                             "a single IN clause, or IN plus GTE/LTE ranges for long runs of consecutive numbers")
+    parser.add_argument("--shared-store", dest="sharedStore", action="store_true",
+                        help="store each position once in db_shared.sqlite3 with a route membership table, "
+                             "instead of one database per route")
+    parser.add_argument("--keep-duplicates", dest="keepDuplicates", action="store_true",
+                        help="store repeated positions with the same train and measured time")
+    parser.add_argument("--collapse-stationary", dest="collapseStationary", action="store_true",
+                        help="store only the first position of a train standing still, with the time it stood still as dwellTime")
+    parser.add_argument("--stationary-distance", dest="stationaryDistance", type=float, default=0,
+                        help="metres a train may move and still count as standing still (default 0)")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="split the routes over this many worker processes, each polling and storing its own "
+                             "routes (default 1, needs one database per route)")
+    parser.add_argument("--metrics-port", dest="metricsPort", type=int, default=0,
+                        help="serve Prometheus metrics on this local port, shard n on port + n (default off)")
+    parser.add_argument("--summary-interval", dest="summaryInterval", type=float, default=metrics.SUMMARY_INTERVAL,
+                        help="seconds between metrics summaries in the log, 0 for none (default 60)")
+    parser.add_argument("--refresh-interval", dest="refreshInterval", type=float, default=60*60,
+                        help="seconds between updates of the tracked trains from changed announcements, "
+                             "0 to track the trains found at startup only (default 3600)")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue the collection in the data folder from its checkpoint, "
+                             "with the saved routes and trains")
+    parser.add_argument("--record", default="", help="append every raw response to this file, for stub_server.py")
+    args = parser.parse_args()
+    if args.shards > 1 and args.sharedStore:
+        parser.error("--shards writes one database per route, it can't be combined with --shared-store")
+    global ASYNC_MODE, SHARDS, METRICS_PORT, POLL_INTERVAL, FILTER_COMPRESSION, SHARED_STORE, RECORD_FILE
+    global DEDUPE, COLLAPSE_STATIONARY, STATIONARY_DISTANCE, RESUME, REFRESH_INTERVAL
+    ASYNC_MODE = args.asyncMode
+    SHARED_STORE = args.sharedStore
+    FILTER_COMPRESSION = args.filter
+    POLL_INTERVAL = args.interval
+    RECORD_FILE = args.record
+    RESUME = args.resume
+    REFRESH_INTERVAL = args.refreshInterval
+    DEDUPE = not args.keepDuplicates
+    COLLAPSE_STATIONARY = args.collapseStationary
+    STATIONARY_DISTANCE = args.stationaryDistance
+    metrics.SUMMARY_INTERVAL = args.summaryInterval
+    SHARDS = args.shards
+    METRICS_PORT = args.metricsPort
+    if METRICS_PORT and SHARDS <= 1:
+        metrics.addSource(collectorGauges)
+        metrics.startMetricsServer(METRICS_PORT)
+
     createDataFolder()
     stations = []
     global trainInclusions
+    if RESUME:
+        routes = findRoutes(DATA_FOLDER_DIR, SHARED_STORE)
+        if routes:
+            log(f"Resuming the collection of {len(routes)} routes in {DATA_FOLDER_DIR}")
+            trainInclusions = [route["inclusion"] for route in routes]
+            fetchPositions([route["stations"] for route in routes], [route["trains"] for route in routes])
+            return
+        log(f"No collection to resume in {DATA_FOLDER_DIR}, starting a new one")
     i = 1
     while True:
         print(f"------ Route {i} (press Enter to finish) ------")
@@ -267,7 +489,10 @@ def main():
             if station == "":
                 if len(route) == 0:
                     break
-                box = input("Define a region (box) of interest (WGS84): ")
+                box = input("Define a region (box, or polygon of 3+ points) of interest (WGS84, 'auto' to cover the stations): ")
+                if box.strip() == "auto":
+                    box = loadCatalog().inclusionBox(route)
+                    print(f"Using box {box}")
                 trainInclusions.append(box)
                 break
             j += 1
@@ -0,0 +1,400 @@
+"""
+SQLite storage for collected train positions.
+
+Positions are either stored in one database per route (RouteStore),
+duplicating positions of trains that belong to several routes, or once
+in a single shared database with a route membership table
+(SharedStore). Both keep the journey summaries and train state of
+their database up to date (see journeys), and pass every row through an
+ingest filter (see ingest_filter) before writing it. Databases are
+reopened as they are, and flushes can checkpoint the changeid they are
+complete up to (see checkpoint).
+"""
+
+import sqlite3
+import threading
+from typing import Callable, Dict, List, Tuple
+from journeys import createJourneys, updateJourneys, loadTrainState, mergeTrainStates
+from ingest_filter import IngestFilter, DUPLICATE, STATIONARY, mergeCounts
+from metrics import timer
+from checkpoint import createCollectorState, saveRoutes, writeRoutes, saveChangeID, loadChangeID
+
+TIMESTAMP_COLUMNS = [
+    "operationalTrainNumber", "journeyNumber",
+    "receivedTime", "modifiedTime", "measuredTime",
+    "SWEREF99TM_1", "SWEREF99TM_2", "WGS84_1", "WGS84_2",
+    "bearing", "speed",
+]
+INSERT_TIMESTAMP_WITH_ID = f"INSERT INTO timestamps (rowid, {", ".join(TIMESTAMP_COLUMNS)}) VALUES (?, {", ".join("?" * len(TIMESTAMP_COLUMNS))})"
+
+def connect(location: str) -> sqlite3.Connection:
+    """
+    Connect to a position database, tuned for append-heavy ingestion.
+    """
+    # Writers may be flushed from a worker thread (see async_collector)
+    conn = sqlite3.connect(location, check_same_thread=False)
+    # page_size only takes effect before the first table is created
+    conn.execute("PRAGMA page_size = 8192")
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA cache_size = -16000")
+    return conn
+
+def createTimestamps(conn: sqlite3.Connection) -> None:
+    """
+    Create the timestamps table and its lookup index, unless they
+    exist.
+    """
+    conn.execute("""CREATE TABLE IF NOT EXISTS timestamps (
+                operationalTrainNumber INTEGER,
+                journeyNumber INTEGER,
+                receivedTime REAL,
+                modifiedTime REAL,
+                measuredTime REAL,
+                SWEREF99TM_1 INTEGER,
+                SWEREF99TM_2 INTEGER,
+                WGS84_1 REAL,
+                WGS84_2 REAL,
+                bearing INTEGER,
+                speed INTEGER,
+                dwellTime REAL DEFAULT 0
+                )""")
+    columns = [column[1] for column in conn.execute("PRAGMA table_info(timestamps)")]
+    if "dwellTime" not in columns:
+        # Databases written before stationary positions were collapsed
+        conn.execute("ALTER TABLE timestamps ADD COLUMN dwellTime REAL DEFAULT 0")
+    conn.execute("""CREATE INDEX IF NOT EXISTS timestamps_train_journey_time
+                ON timestamps (operationalTrainNumber, journeyNumber, measuredTime)""")
+
+def openDatabase(location: str) -> sqlite3.Connection:
+    """
+    Create a single route position database at the given location,
+    or reopen it (e.g. when a shard is restarted).
+    """
+    conn = connect(location)
+    createTimestamps(conn)
+    createJourneys(conn)
+    createCollectorState(conn)
+    conn.commit()
+    return conn
+
+def openSharedDatabase(location: str, routeNames: List[str]) -> sqlite3.Connection:
+    """
+    Create or reopen a position database shared by the given routes.
+    Each position is stored once in timestamps, and routePositions maps
+    routes to the rowids of their positions. Routes not in the database
+    yet are numbered after the existing ones.
+    """
+    conn = connect(location)
+    createTimestamps(conn)
+    createJourneys(conn)
+    createCollectorState(conn)
+    conn.execute("""CREATE TABLE IF NOT EXISTS routes (
+                routeNumber INTEGER PRIMARY KEY,
+                name TEXT UNIQUE
+                )""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS routePositions (
+                routeNumber INTEGER,
+                positionId INTEGER,
+                PRIMARY KEY (routeNumber, positionId)
+                ) WITHOUT ROWID""")
+    # The positions of a route with the same columns as a route database
+    conn.execute("""CREATE VIEW IF NOT EXISTS routeTimestamps AS
+                SELECT routes.name AS route, timestamps.*
+                FROM routePositions
+                JOIN routes ON routes.routeNumber = routePositions.routeNumber
+                JOIN timestamps ON timestamps.rowid = routePositions.positionId""")
+    conn.executemany("""INSERT OR IGNORE INTO routes
+                     VALUES ((SELECT COALESCE(MAX(routeNumber) + 1, 0) FROM routes), ?)""",
+                     [(name,) for name in routeNames])
+    conn.commit()
+    return conn
+
+def nextRowId(conn: sqlite3.Connection) -> int:
+    return (conn.execute("SELECT MAX(rowid) FROM timestamps").fetchone()[0] or 0) + 1
+
+def routeNumbers(conn: sqlite3.Connection, routeNames: List[str]) -> List[int]:
+    """
+    The numbers of the given routes in a shared database.
+    """
+    numbers = dict(conn.execute("SELECT name, routeNumber FROM routes").fetchall())
+    return [numbers[name] for name in routeNames]
+
+def isStored(conn: sqlite3.Connection, row: Tuple) -> bool:
+    """
+    Whether a row (prefixed with its rowid) is in the database already.
+    """
+    return conn.execute("""SELECT 1 FROM timestamps WHERE operationalTrainNumber = ?
+                        AND measuredTime = ? AND modifiedTime = ? LIMIT 1""", (row[1], row[5], row[4])).fetchone() is not None
+
+def writeDwells(conn: sqlite3.Connection, dwells: Dict[int, Tuple]) -> None:
+    """
+    Set the dwell times of rows that absorbed a stationary run, given
+    as rowid -> (dwellTime, train, journey, measuredTime).
+    """
+    conn.executemany("UPDATE timestamps SET dwellTime = ? WHERE rowid = ?",
+                     [(dwell[0], positionId) for positionId, dwell in dwells.items()])
+
+def writeTransaction(conn: sqlite3.Connection, write: Callable[[], None]) -> None:
+    """
+    Run the writes in one transaction, like `with conn:`, timing the
+    writes and the commit separately (see metrics).
+    """
+    try:
+        with timer("insert"):
+            write()
+        with timer("commit"):
+            conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+class TimestampWriter:
+    """
+    Buffers decoded position rows for one database and writes them
+    with a single executemany inside one transaction per flush.
+    """
+
+    def __init__(self, conn: sqlite3.Connection, ingestFilter: IngestFilter):
+        self.conn = conn
+        self.filter = ingestFilter
+        self.rows: List[Tuple] = []
+        self.dwells: Dict[int, Tuple] = {}
+        # Rowids are assigned here, so that journeys can refer to them
+        self.nextId = nextRowId(conn)
+        self.changeID = loadChangeID(conn)
+        self.catchingUp = False
+        # Routes to save with the next flush, set from another thread
+        self.routes = None
+        self.routesLock = threading.Lock()
+
+    def updateRoutes(self, routes: List[dict]) -> None:
+        with self.routesLock:
+            self.routes = routes
+
+    def add(self, row: Tuple) -> None:
+        """
+        Queue a row for the next flush, unless the filter drops it.
+        """
+        action, anchorId, dwellTime = self.filter.check(self.nextId, row)
+        if action == DUPLICATE:
+            return
+        if action == STATIONARY:
+            self.dwells[anchorId] = (dwellTime, row[0], row[1], row[4])
+            return
+        self.rows.append((self.nextId, *row))
+        self.nextId += 1
+
+    def flush(self, changeID: int = None) -> int:
+        """
+        Write all queued rows in one transaction, with the changeid
+        they complete the database up to if given and any updated
+        routes, and return how many were written. If the write fails,
+        the rows stay queued for the next flush.
+        """
+        rows, dwells = self.rows, self.dwells
+        self.rows, self.dwells = [], {}
+        with self.routesLock:
+            routes, self.routes = self.routes, None
+        if changeID is not None and changeID <= self.changeID:
+            # Stored before the collector was restarted
+            rows, dwells, changeID = [], {}, None
+        elif self.catchingUp:
+            # The response overlaps what was stored before the restart
+            rows = [row for row in rows if not isStored(self.conn, row)]
+        if not rows and not dwells and changeID is None and routes is None:
+            return 0
+        def write():
+            self.conn.executemany(INSERT_TIMESTAMP_WITH_ID, rows)
+            writeDwells(self.conn, dwells)
+            updateJourneys(self.conn, rows, dwells.values())
+            if changeID is not None:
+                saveChangeID(self.conn, changeID)
+            if routes is not None:
+                writeRoutes(self.conn, routes)
+        try:
+            writeTransaction(self.conn, write)
+        except BaseException:
+            self.requeue(rows, dwells, routes)
+            raise
+        self.catchingUp = False
+        if changeID is not None:
+            self.changeID = changeID
+        return len(rows)
+
+    def requeue(self, rows: List[Tuple], dwells: Dict[int, Tuple], routes: List[dict]) -> None:
+        """
+        Queue the writes of a failed flush again, for the next flush.
+        The filter has already passed them, and their rowids stay
+        assigned.
+        """
+        self.rows = rows + self.rows
+        self.dwells = {**dwells, **self.dwells}
+        with self.routesLock:
+            if self.routes is None:
+                self.routes = routes
+
+    def close(self) -> None:
+        self.flush()
+        self.conn.close()
+
+class RouteStore:
+    """
+    Stores positions in one database per route.
+    """
+
+    def __init__(self, locations: List[str], newFilter: Callable[[], IngestFilter] = IngestFilter):
+        self.writers = [TimestampWriter(openDatabase(location), newFilter()) for location in locations]
+
+    def add(self, row: Tuple, routes: List[int]) -> None:
+        """
+        Queue a row for all the given routes.
+        """
+        for routeNumber in routes:
+            self.writers[routeNumber].add(row)
+
+    def flush(self, changeID: int = None) -> int:
+        """
+        Flush all route databases, one transaction each.
+        """
+        return sum(writer.flush(changeID) for writer in self.writers)
+
+    def checkpoint(self) -> int:
+        """
+        The changeid to continue collecting from: the lowest any route
+        database is complete up to. Databases that got further before a
+        restart skip what they already stored.
+        """
+        changeID = min(writer.changeID for writer in self.writers)
+        for writer in self.writers:
+            writer.catchingUp = writer.changeID > changeID
+        return changeID
+
+    def saveRoutes(self, routes: List[dict]) -> None:
+        """
+        Save every route (see checkpoint) in its database.
+        """
+        for writer, route in zip(self.writers, routes):
+            saveRoutes(writer.conn, [route])
+
+    def updateRoutes(self, routes: List[dict]) -> None:
+        """
+        Save the routes with the next flush. Safe to call while
+        another thread is flushing.
+        """
+        for writer, route in zip(self.writers, routes):
+            writer.updateRoutes([route])
+
+    def trainState(self) -> Dict[int, Tuple[int, float]]:
+        """
+        The persisted train state, merged over all route databases.
+        """
+        return mergeTrainStates(loadTrainState(writer.conn) for writer in self.writers)
+
+    def ingestCounts(self) -> Dict[str, int]:
+        """
+        Rows kept and dropped by the ingest filters, over all route
+        databases.
+        """
+        return mergeCounts(writer.filter for writer in self.writers)
+
+    def close(self) -> None:
+        for writer in self.writers:
+            writer.close()
+
+class SharedStore:
+    """
+    Stores every position once in a shared database, no matter how
+    many routes it belongs to.
+    """
+
+    def __init__(self, location: str, routeNames: List[str], newFilter: Callable[[], IngestFilter] = IngestFilter):
+        self.conn = openSharedDatabase(location, routeNames)
+        self.routeNumbers = routeNumbers(self.conn, routeNames)
+        self.filter = newFilter()
+        self.rows: List[Tuple] = []
+        self.memberships: List[Tuple[int, int]] = []
+        self.dwells: Dict[int, Tuple] = {}
+        self.nextId = nextRowId(self.conn)
+        self.changeID = loadChangeID(self.conn)
+        self.routes = None
+        self.routesLock = threading.Lock()
+
+    def add(self, row: Tuple, routes: List[int]) -> None:
+        """
+        Queue a row and its route memberships, unless the filter drops
+        it.
+        """
+        if not routes:
+            return
+        action, anchorId, dwellTime = self.filter.check(self.nextId, row)
+        if action == DUPLICATE:
+            return
+        if action == STATIONARY:
+            self.dwells[anchorId] = (dwellTime, row[0], row[1], row[4])
+            return
+        positionId = self.nextId
+        self.nextId += 1
+        self.rows.append((positionId, *row))
+        for routeNumber in routes:
+            self.memberships.append((self.routeNumbers[routeNumber], positionId))
+
+    def flush(self, changeID: int = None) -> int:
+        """
+        Write the queued rows and memberships in one transaction, with
+        the changeid they complete the database up to if given.
+        """
+        rows, memberships, dwells = self.rows, self.memberships, self.dwells
+        self.rows, self.memberships, self.dwells = [], [], {}
+        with self.routesLock:
+            routes, self.routes = self.routes, None
+        if changeID is not None and changeID <= self.changeID:
+            rows, memberships, dwells, changeID = [], [], {}, None
+        if not rows and not dwells and changeID is None and routes is None:
+            return 0
+        def write():
+            self.conn.executemany(INSERT_TIMESTAMP_WITH_ID, rows)
+            self.conn.executemany("INSERT INTO routePositions VALUES (?, ?)", memberships)
+            writeDwells(self.conn, dwells)
+            updateJourneys(self.conn, rows, dwells.values())
+            if changeID is not None:
+                saveChangeID(self.conn, changeID)
+            if routes is not None:
+                writeRoutes(self.conn, routes)
+        try:
+            writeTransaction(self.conn, write)
+        except BaseException:
+            # Written with the next flush instead, see TimestampWriter.requeue
+            self.rows = rows + self.rows
+            self.memberships = memberships + self.memberships
+            self.dwells = {**dwells, **self.dwells}
+            with self.routesLock:
+                if self.routes is None:
+                    self.routes = routes
+            raise
+        if changeID is not None:
+            self.changeID = changeID
+        return len(rows)
+
+    def checkpoint(self) -> int:
+        """
+        The changeid to continue collecting from.
+        """
+        return self.changeID
+
+    def saveRoutes(self, routes: List[dict]) -> None:
+        saveRoutes(self.conn, routes)
+
+    def updateRoutes(self, routes: List[dict]) -> None:
+        with self.routesLock:
+            self.routes = routes
+
+    def trainState(self) -> Dict[int, Tuple[int, float]]:
+        return loadTrainState(self.conn)
+
+    def ingestCounts(self) -> Dict[str, int]:
+        return dict(self.filter.counts)
+
+    def close(self) -> None:
+        self.flush()
+        self.conn.close()
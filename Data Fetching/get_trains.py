@@ -4,17 +4,29 @@ going between two stations.
 """
 
 import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-import requests
 from pathlib import Path
-from typing import List
+from typing import Dict, List, Optional, Set
 from utils import log
+import trafikverket
+from trafikverket import TRAFIKVERKET_API_KEY
 
 load_dotenv("../.env")
-TRAFIKVERKET_API_KEY = os.getenv("TRAFIKVERKET_API_KEY")
-TRAFIKVERKET_URL = "https://api.trafikinfo.trafikverket.se/v2/data.json"
 SJ_API_KEY = os.getenv("SJ_API_KEY")
 DATA_FOLDER_DIR = os.getenv("DATA_FOLDER_DIR")
+# Outside the data folder, which is removed when a new collection starts
+CACHE_DIR = os.getenv("CACHE_DIR") or "../Cache"
+CACHE_TTL = 6*60*60
+PAGE_SIZE = 10000
+MAX_CONCURRENT_FETCHES = 4
+
+# Announcements (ActivityId -> train) per station fetched or loaded by this process
+stationActivities: Dict[str, Dict[str, int]] = {}
+stationActivitiesLock = threading.Lock()
 
 def getTrains(*locationSignatures) -> List[int]:
     """
@@ -26,47 +38,104 @@ def getTrains(*locationSignatures) -> List[int]:
     elif len(locationSignatures) > 1:
         # Get the intersection of trains which go through all stations
         log(f"Fetching trains between {", ".join(locationSignatures)}...")
-        trains = set(getTrains(locationSignatures[0]))
+        stationTrains = fetchStations(locationSignatures)
+        trains = set(stationTrains[locationSignatures[0]])
         for i in range(1, len(locationSignatures)):
             # Intersection of common trains
-            trains = trains & set(getTrains(locationSignatures[i]))
+            trains = trains & stationTrains[locationSignatures[i]]
         trains = list(trains)
         log(f"Found {len(trains)} trains going between {", ".join(locationSignatures)}")
         return trains
     else:
         # Get all trains going to or from a singular train station.
-        locationSignature = locationSignatures[0]
-        headers = {
-            "Content-Type": "application/xml"
-        }
+        return list(getStationTrains(locationSignatures[0]))
+
+def fetchStations(locationSignatures) -> Dict[str, Set[int]]:
+    """
+    Get the trains of all given stations, fetching them concurrently.
+    """
+    unique = list(dict.fromkeys(locationSignatures))
+    with ThreadPoolExecutor(max_workers=min(MAX_CONCURRENT_FETCHES, len(unique))) as executor:
+        return dict(zip(unique, executor.map(getStationTrains, unique)))
+
+def getStationTrains(locationSignature: str) -> Set[int]:
+    """
+    Return all trains going to or from a singular train station.
+    """
+    return set(getStationActivities(locationSignature).values())
+
+def getStationActivities(locationSignature: str) -> Dict[str, int]:
+    """
+    Return the announcements of a station as ActivityId -> train,
+    from memory or the on-disk cache if fetched within CACHE_TTL,
+    fetching them otherwise.
+    """
+    activities = loadStationActivities(locationSignature)
+    if activities is None:
+        activities = fetchStationActivities(locationSignature)
+        cacheFile = Path(f"{CACHE_DIR}/announcements_{locationSignature}.json")
+        cacheFile.parent.mkdir(parents=True, exist_ok=True)
+        with open(cacheFile, "w") as f:
+            json.dump({"fetched": time.time(), "activities": activities}, f)
+        with stationActivitiesLock:
+            stationActivities[locationSignature] = activities
+    return activities
+
+def loadStationActivities(locationSignature: str) -> Optional[Dict[str, int]]:
+    """
+    The announcements of a station from memory or the on-disk cache
+    if fetched within CACHE_TTL, or None. Used by TrainRefresher to
+    start from the trains looked up at startup.
+    """
+    with stationActivitiesLock:
+        if locationSignature in stationActivities:
+            return stationActivities[locationSignature]
+    cacheFile = Path(f"{CACHE_DIR}/announcements_{locationSignature}.json")
+    if not cacheFile.exists():
+        return None
+    with open(cacheFile, "r") as f:
+        cached = json.load(f)
+    # Caches written before the announcements were kept only have trains
+    if time.time() - cached["fetched"] >= CACHE_TTL or "activities" not in cached:
+        return None
+    activities = cached["activities"]
+    log(f"Found {len(set(activities.values()))} cached trains going to or from {locationSignature}")
+    with stationActivitiesLock:
+        stationActivities[locationSignature] = activities
+    return activities
+
+def fetchStationActivities(locationSignature: str) -> Dict[str, int]:
+    """
+    Page through all announcements of a station, keeping only their
+    ActivityId and train number.
+    """
+    log(f"Fetching departures/arrivals to {locationSignature}...")
+    activities = {}
+    skip = 0
+    while True:
         req = f"""
         <REQUEST>
             <LOGIN authenticationkey="{TRAFIKVERKET_API_KEY}"/>
-            <QUERY objecttype="TrainAnnouncement" schemaversion="1.9" limit="100000" orderby="AdvertisedTimeAtLocation">
+            <QUERY objecttype="TrainAnnouncement" schemaversion="1.9" limit="{PAGE_SIZE}" skip="{skip}" orderby="AdvertisedTimeAtLocation">
             <FILTER>
                 <EQ name="LocationSignature" value="{locationSignature}" />
             </FILTER>
+            <INCLUDE>ActivityId</INCLUDE>
+            <INCLUDE>OperationalTrainNumber</INCLUDE>
             </QUERY>
         </REQUEST>
         """
-        log(f"Fetching departures/arrivals to {locationSignature}...")
-        while True:
-            try:
-                resp = requests.post(TRAFIKVERKET_URL, data = req, headers = headers)
-                break
-            except:
-                log("Retrying getTrains fetch...")
-        obj = resp.json()
-        data = obj["RESPONSE"]["RESULT"][0]["TrainAnnouncement"]
-        log(f"Interpreting {len(data)} announcements...")
-        trains = set()
+        data = trafikverket.query(req, timeout=60)["TrainAnnouncement"]
         for entry in data:
             otn = entry.get("OperationalTrainNumber")
-            if otn != None:
-                trains.add(int(otn))
-        trains = list(trains)
-        log(f"Found {len(trains)} trains going to or from {locationSignature}")
-        return trains
+            activity = entry.get("ActivityId")
+            if otn != None and activity != None:
+                activities[activity] = int(otn)
+        skip += len(data)
+        if len(data) < PAGE_SIZE:
+            break
+    log(f"Found {len(set(activities.values()))} trains going to or from {locationSignature} in {skip} announcements")
+    return activities
 
 def saveTrains(location: str, trains: List[int]) -> None:
     """
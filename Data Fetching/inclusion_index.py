@@ -0,0 +1,114 @@
+"""
+Lookup of the routes a train position belongs to.
+
+Route inclusions are parsed once into bounding boxes (or polygons) and
+indexed by train number, so routing a position is a dictionary lookup
+plus a containment test per route of that train.
+"""
+
+from typing import Dict, List, Optional, Tuple
+
+class Inclusion:
+    """
+    An inclusion zone in WGS84, given as "x1 y1, x2 y2" for a box or
+    as three or more points for a polygon. Points on the border are
+    outside, like the original box check.
+    """
+
+    def __init__(self, text: str):
+        points = [tuple(map(float, point.split())) for point in text.split(",") if point.strip() != ""]
+        if len(points) < 2:
+            raise ValueError(f"Inclusion {text} needs at least two points")
+        xs = [p[0] for p in points]
+        ys = [p[1] for p in points]
+        self.minX, self.maxX = min(xs), max(xs)
+        self.minY, self.maxY = min(ys), max(ys)
+        self.polygon = points if len(points) > 2 else None
+
+    def contains(self, x: float, y: float) -> bool:
+        if not (self.minX < x < self.maxX and self.minY < y < self.maxY):
+            return False
+        if self.polygon is None:
+            return True
+        # Ray casting
+        inside = False
+        j = len(self.polygon) - 1
+        for i in range(len(self.polygon)):
+            xi, yi = self.polygon[i]
+            xj, yj = self.polygon[j]
+            if (yi > y) != (yj > y) and x < (xj - xi) * (y - yi) / (yj - yi) + xi:
+                inside = not inside
+            j = i
+        return inside
+
+    def filterBox(self) -> str:
+        """
+        The bounding box in the format of the API's WITHIN filter.
+        """
+        return f"{self.minX} {self.minY}, {self.maxX} {self.maxY}"
+
+def parseInclusion(text: str) -> Optional[Inclusion]:
+    """
+    Parse an inclusion, where an empty string means no inclusion zone.
+    """
+    return Inclusion(text) if text.strip() != "" else None
+
+class InclusionIndex:
+    """
+    Maps a train number and WGS84 coordinate to the routes the
+    position should be stored in.
+    """
+
+    def __init__(self, trains: List[List[int]], inclusions: List[str]):
+        self.inclusions = [parseInclusion(text) for text in inclusions]
+        # train -> routes without inclusion zone, and (route, zone) pairs
+        self.unbounded: Dict[int, List[int]] = {}
+        self.bounded: Dict[int, List[Tuple[int, Inclusion]]] = {}
+        for routeNumber, trainList in enumerate(trains):
+            self.addRoute(routeNumber, trainList)
+
+    def addRoute(self, routeNumber: int, trainList: List[int]) -> None:
+        """
+        Index the given trains for a route.
+        """
+        inclusion = self.inclusions[routeNumber]
+        for train in trainList:
+            if inclusion is None:
+                self.unbounded.setdefault(train, []).append(routeNumber)
+            else:
+                self.bounded.setdefault(train, []).append((routeNumber, inclusion))
+
+    def __contains__(self, train: int) -> bool:
+        return train in self.unbounded or train in self.bounded
+
+    def routes(self, train: int, x: float, y: float) -> List[int]:
+        """
+        Return the numbers of all routes the train's position belongs to.
+        """
+        routes = list(self.unbounded.get(train, ()))
+        for routeNumber, inclusion in self.bounded.get(train, ()):
+            if inclusion.contains(x, y):
+                routes.append(routeNumber)
+        return routes
+
+    def routeBatch(self, trains: List[int], xs: List[float], ys: List[float]) -> List[List[int]]:
+        """
+        Return the routes of every position in a batch of columns.
+        """
+        unbounded = self.unbounded
+        bounded = self.bounded
+        result = []
+        for train, x, y in zip(trains, xs, ys):
+            routes = list(unbounded.get(train, ()))
+            for routeNumber, inclusion in bounded.get(train, ()):
+                if inclusion.contains(x, y):
+                    routes.append(routeNumber)
+            result.append(routes)
+        return result
+
+    def filterBoxes(self) -> List[str]:
+        """
+        The WITHIN box of every route for the request filter, or an
+        empty string for routes without inclusion zone.
+        """
+        return [inclusion.filterBox() if inclusion is not None else "" for inclusion in self.inclusions]
@@ -0,0 +1,66 @@
+"""
+Filtering of position rows before they are written.
+
+The changeid stream repeats positions, and a train parked at a station
+reports the same position for hours. Each database writer runs its rows
+through an IngestFilter, which drops exact duplicates (same train and
+measured time) and, optionally, collapses stationary runs into their
+first row, whose dwellTime is extended to the last measured time of
+the run.
+"""
+
+import math
+from typing import Dict, Optional, Tuple
+
+KEEP = "kept"
+DUPLICATE = "duplicates"
+STATIONARY = "stationary"
+
+class IngestFilter:
+    """
+    Decides, per train, whether a row is kept, dropped as a duplicate
+    or folded into the dwell time of an earlier row. Stationary means
+    within `stationaryDistance` metres (SWEREF99TM) of the first row of
+    the run, in the same journey.
+    """
+
+    def __init__(self, dedupe: bool = True, collapseStationary: bool = False, stationaryDistance: float = 0.0):
+        self.dedupe = dedupe
+        self.collapseStationary = collapseStationary
+        self.stationaryDistance = stationaryDistance
+        # train -> (journey, last measuredTime, anchor rowid, anchor measuredTime, anchor SWEREF99TM)
+        self.last: Dict[int, Tuple] = {}
+        self.counts = {KEEP: 0, DUPLICATE: 0, STATIONARY: 0}
+
+    def check(self, positionId: int, row: Tuple) -> Tuple[str, Optional[int], float]:
+        """
+        Classify a timestamps row that would get the given rowid.
+        Returns the action, and for stationary rows the rowid of the
+        run's first row and its new dwell time in seconds.
+        """
+        train, journey, measuredTime = row[0], row[1], row[4]
+        point = (row[5], row[6])
+        last = self.last.get(train)
+        if last is not None and last[0] == journey:
+            _, lastMeasured, anchorId, anchorTime, anchorPoint = last
+            if self.dedupe and measuredTime == lastMeasured:
+                self.counts[DUPLICATE] += 1
+                return DUPLICATE, None, 0.0
+            if (self.collapseStationary and measuredTime > anchorTime
+                    and math.dist(point, anchorPoint) <= self.stationaryDistance):
+                self.last[train] = (journey, measuredTime, anchorId, anchorTime, anchorPoint)
+                self.counts[STATIONARY] += 1
+                return STATIONARY, anchorId, measuredTime - anchorTime
+        self.last[train] = (journey, measuredTime, positionId, measuredTime, point)
+        self.counts[KEEP] += 1
+        return KEEP, None, 0.0
+
+def mergeCounts(filters) -> Dict[str, int]:
+    """
+    Sum the counters of several filters.
+    """
+    total = {KEEP: 0, DUPLICATE: 0, STATIONARY: 0}
+    for ingestFilter in filters:
+        for name, count in ingestFilter.counts.items():
+            total[name] += count
+    return total
@@ -0,0 +1,170 @@
+"""
+Journey segmentation of collected positions.
+
+A train starts a new journey when it hasn't been seen for JOURNEY_GAP
+seconds. The stores persist the last journey and time seen of every
+train (trainState) and a summary of every journey (journeys) in the
+same transaction as the positions, so a restarted collector continues
+the numbering and readers can look journeys up by key.
+"""
+
+import sqlite3
+from typing import Dict, Iterable, List, Tuple
+
+JOURNEY_GAP = 60*60
+
+JOURNEY_COLUMNS = [
+    "operationalTrainNumber", "journeyNumber",
+    "startTime", "endTime", "firstRow", "lastRow", "pointCount",
+    "minLon", "minLat", "maxLon", "maxLat",
+]
+UPSERT_JOURNEY = f"""INSERT INTO journeys ({", ".join(JOURNEY_COLUMNS)}, closed)
+                VALUES ({", ".join("?" * len(JOURNEY_COLUMNS))}, 0)
+                ON CONFLICT (operationalTrainNumber, journeyNumber) DO UPDATE SET
+                startTime = min(startTime, excluded.startTime),
+                endTime = max(endTime, excluded.endTime),
+                firstRow = min(firstRow, excluded.firstRow),
+                lastRow = max(lastRow, excluded.lastRow),
+                pointCount = pointCount + excluded.pointCount,
+                minLon = min(minLon, excluded.minLon),
+                minLat = min(minLat, excluded.minLat),
+                maxLon = max(maxLon, excluded.maxLon),
+                maxLat = max(maxLat, excluded.maxLat)"""
+UPSERT_TRAIN_STATE = """INSERT INTO trainState VALUES (?, ?, ?)
+                ON CONFLICT (operationalTrainNumber) DO UPDATE SET
+                journeyNumber = excluded.journeyNumber,
+                lastSeen = excluded.lastSeen"""
+
+def createJourneys(conn: sqlite3.Connection) -> None:
+    """
+    Create the journey summary and train state tables.
+    """
+    conn.execute("""CREATE TABLE IF NOT EXISTS journeys (
+                operationalTrainNumber INTEGER,
+                journeyNumber INTEGER,
+                startTime REAL,
+                endTime REAL,
+                firstRow INTEGER,
+                lastRow INTEGER,
+                pointCount INTEGER,
+                minLon REAL,
+                minLat REAL,
+                maxLon REAL,
+                maxLat REAL,
+                closed INTEGER,
+                PRIMARY KEY (operationalTrainNumber, journeyNumber)
+                ) WITHOUT ROWID""")
+    conn.execute("""CREATE INDEX IF NOT EXISTS journeys_open
+                ON journeys (endTime) WHERE closed = 0""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS trainState (
+                operationalTrainNumber INTEGER PRIMARY KEY,
+                journeyNumber INTEGER,
+                lastSeen REAL
+                )""")
+
+def updateJourneys(conn: sqlite3.Connection, rows: List[Tuple], dwells: Iterable[Tuple] = ()) -> None:
+    """
+    Fold timestamps rows, prefixed with their rowid, into the journey
+    summaries and train state, and close the journeys that ended. Rows
+    collapsed into a dwell time, given as (dwellTime, train, journey,
+    measuredTime), only extend their journey. To be called in the
+    transaction that writes the rows.
+    """
+    journeys: Dict[Tuple[int, int], list] = {}
+    state: Dict[int, Tuple[int, float]] = {}
+    for row in rows:
+        positionId, train, journey, measuredTime, lon, lat = row[0], row[1], row[2], row[5], row[8], row[9]
+        summary = journeys.get((train, journey))
+        if summary is None:
+            journeys[(train, journey)] = [measuredTime, measuredTime, positionId, positionId, 1, lon, lat, lon, lat]
+        else:
+            summary[0] = min(summary[0], measuredTime)
+            summary[1] = max(summary[1], measuredTime)
+            summary[3] = max(summary[3], positionId)
+            summary[4] += 1
+            summary[5] = min(summary[5], lon)
+            summary[6] = min(summary[6], lat)
+            summary[7] = max(summary[7], lon)
+            summary[8] = max(summary[8], lat)
+        state[train] = (journey, measuredTime)
+    extended = []
+    for _, train, journey, measuredTime in dwells:
+        extended.append((measuredTime, train, journey))
+        if train not in state or (journey, measuredTime) > state[train]:
+            state[train] = (journey, measuredTime)
+    if not state:
+        return
+    conn.executemany(UPSERT_JOURNEY, [(*key, *summary) for key, summary in journeys.items()])
+    conn.executemany("""UPDATE journeys SET endTime = max(endTime, ?)
+                     WHERE operationalTrainNumber = ? AND journeyNumber = ?""", extended)
+    conn.executemany(UPSERT_TRAIN_STATE, [(train, *value) for train, value in state.items()])
+    # A train's earlier journeys are over once it has started a new one,
+    # and any journey is over once its train has been gone for JOURNEY_GAP
+    conn.executemany("""UPDATE journeys SET closed = 1
+                     WHERE operationalTrainNumber = ? AND journeyNumber < ? AND closed = 0""",
+                     [(train, journey) for train, (journey, _) in state.items()])
+    newest = max(measuredTime for _, measuredTime in state.values())
+    conn.execute("UPDATE journeys SET closed = 1 WHERE closed = 0 AND endTime < ?", (newest - JOURNEY_GAP,))
+
+def loadTrainState(conn: sqlite3.Connection) -> Dict[int, Tuple[int, float]]:
+    """
+    The persisted (journeyNumber, lastSeen) of every train.
+    """
+    rows = conn.execute("SELECT operationalTrainNumber, journeyNumber, lastSeen FROM trainState").fetchall()
+    return {train: (journey, lastSeen) for train, journey, lastSeen in rows}
+
+def mergeTrainStates(states: Iterable[Dict[int, Tuple[int, float]]]) -> Dict[int, Tuple[int, float]]:
+    """
+    Merge the train states of several databases, keeping the latest
+    journey of every train.
+    """
+    merged: Dict[int, Tuple[int, float]] = {}
+    for state in states:
+        for train, value in state.items():
+            if train not in merged or value > merged[train]:
+                merged[train] = value
+    return merged
+
+def fetchJourneys(conn: sqlite3.Connection) -> List[Tuple]:
+    """
+    The summaries of all journeys, as tuples of JOURNEY_COLUMNS and
+    closed, ordered by train and journey.
+    """
+    return conn.execute(f"""SELECT {", ".join(JOURNEY_COLUMNS)}, closed FROM journeys
+                        ORDER BY operationalTrainNumber, journeyNumber""").fetchall()
+
+def fetchJourney(conn: sqlite3.Connection, train: int, journey: int, columns: str = "*") -> List[Tuple]:
+    """
+    All positions of a journey ordered by measured time, read through
+    the (train, journey, time) index.
+    """
+    return conn.execute(f"""SELECT {columns} FROM timestamps
+                        WHERE operationalTrainNumber = ? AND journeyNumber = ?
+                        ORDER BY measuredTime""", (train, journey)).fetchall()
+
+class JourneySegmenter:
+    """
+    Assigns journey numbers to the positions of each train, continuing
+    from a persisted train state.
+    """
+
+    def __init__(self, state: Dict[int, Tuple[int, float]]):
+        self.journeyNumbers = {train: journey for train, (journey, _) in state.items()}
+        self.lastSeen = {train: lastSeen for train, (_, lastSeen) in state.items()}
+
+    def track(self, trains: Iterable[int], now: float) -> None:
+        """
+        Mark trains without persisted state as seen now, so that a
+        journey already underway when collection starts is journey 0.
+        """
+        for train in trains:
+            self.lastSeen.setdefault(train, now)
+
+    def assign(self, train: int, measuredTime: float) -> int:
+        """
+        The journey number of a position of the given train.
+        """
+        if measuredTime - self.lastSeen.get(train, 0) > JOURNEY_GAP:
+            self.journeyNumbers[train] = self.journeyNumbers.get(train, 0) + 1
+        self.lastSeen[train] = measuredTime
+        return self.journeyNumbers.get(train, 0)
@@ -0,0 +1,230 @@
+"""
+Hot-path instrumentation of the collector.
+
+Keeps per-stage timers (request build, HTTP round-trip, JSON parse,
+decode, ingest filter, database insert and commit), a histogram of
+records per poll, the changeid lag and the pipeline queue depths.
+They are exposed as Prometheus text on a local endpoint, and
+summarised per interval in the log, to see where the poll interval
+goes under real load.
+
+Enable with `python data_collector.py --metrics-port 9100` and read
+http://localhost:9100/metrics.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List
+from utils import log
+
+STAGES = ["build", "http", "parse", "decode", "filter", "insert", "commit"]
+RECORD_BUCKETS = [0, 1, 10, 50, 100, 250, 500, 1000, 2500, 5000]
+SUMMARY_INTERVAL = 60
+
+lock = threading.Lock()
+# stage -> [count, total seconds, max seconds], since start and since the last summary
+timers = {}
+windowTimers = {}
+# Cumulative counts per bucket of RECORD_BUCKETS, plus the overflow
+recordCounts = [0] * (len(RECORD_BUCKETS) + 1)
+records = {"polls": 0, "total": 0}
+windowRecords = {"polls": 0, "total": 0, "max": 0}
+gauges = {}
+queueDepths = {}
+changeState = {"id": 0, "advanced": time.time(), "polled": 0.0}
+lastSummary = time.monotonic()
+sources = []
+
+def addTime(stage: str, seconds: float) -> None:
+    with lock:
+        for table in (timers, windowTimers):
+            entry = table.setdefault(stage, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+
+@contextmanager
+def timer(stage: str):
+    """
+    Time the enclosed block as one run of the given stage.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        addTime(stage, time.perf_counter() - started)
+
+def observeRecords(count: int) -> None:
+    """
+    Count the records of one poll.
+    """
+    bucket = 0
+    while bucket < len(RECORD_BUCKETS) and count > RECORD_BUCKETS[bucket]:
+        bucket += 1
+    with lock:
+        recordCounts[bucket] += 1
+        records["polls"] += 1
+        records["total"] += count
+        windowRecords["polls"] += 1
+        windowRecords["total"] += count
+        windowRecords["max"] = max(windowRecords["max"], count)
+
+def setGauge(name: str, value: float) -> None:
+    with lock:
+        gauges[name] = value
+
+def addCount(name: str, count: int) -> None:
+    """
+    Add to a counter, exposed like the gauges (names ending in _total).
+    """
+    with lock:
+        gauges[name] = gauges.get(name, 0) + count
+
+def setQueueDepth(queue: str, depth: int) -> None:
+    with lock:
+        queueDepths[queue] = depth
+
+def observeChangeID(changeID: int) -> None:
+    """
+    Note the LASTCHANGEID of a response, and when it last moved.
+    """
+    with lock:
+        changeState["polled"] = time.time()
+        if changeID != changeState["id"]:
+            changeState["id"] = changeID
+            changeState["advanced"] = time.time()
+
+def observeLag(receivedTime: float, modifiedTimes: List[float]) -> None:
+    """
+    Note how far behind the newest change of a response was when it
+    was received.
+    """
+    if len(modifiedTimes) != 0:
+        setGauge("changeid_lag_seconds", receivedTime - max(modifiedTimes))
+
+def snapshot() -> dict:
+    """
+    The poll counters and when the last response arrived, for health
+    checks (see sharded_collector).
+    """
+    with lock:
+        return {"polls": records["polls"], "records": records["total"], "changeID": changeState["id"],
+                "advanced": changeState["advanced"], "polled": changeState["polled"]}
+
+def addSource(source: Callable[[], Dict[str, float]]) -> None:
+    """
+    Add a function returning more gauges (name -> value) to render,
+    such as the HTTP client and ingest filter counters.
+    """
+    sources.append(source)
+
+def render() -> str:
+    """
+    All metrics in the Prometheus text format.
+    """
+    with lock:
+        stageTimes = {stage: list(entry) for stage, entry in timers.items()}
+        counts = list(recordCounts)
+        polls, total = records["polls"], records["total"]
+        values = dict(gauges)
+        depths = dict(queueDepths)
+        changeID, advanced = changeState["id"], changeState["advanced"]
+    for source in sources:
+        values.update(source())
+    lines = [
+        "# HELP collector_stage_seconds Time spent per pipeline stage.",
+        "# TYPE collector_stage_seconds summary",
+    ]
+    for stage, (count, seconds, _) in stageTimes.items():
+        lines.append(f'collector_stage_seconds_sum{{stage="{stage}"}} {seconds:.6f}')
+        lines.append(f'collector_stage_seconds_count{{stage="{stage}"}} {count}')
+    lines.append("# TYPE collector_stage_seconds_max gauge")
+    for stage, (_, _, longest) in stageTimes.items():
+        lines.append(f'collector_stage_seconds_max{{stage="{stage}"}} {longest:.6f}')
+    lines += [
+        "# HELP collector_records_per_poll Positions received per poll.",
+        "# TYPE collector_records_per_poll histogram",
+    ]
+    cumulative = 0
+    for bound, count in zip(RECORD_BUCKETS + ["+Inf"], counts):
+        cumulative += count
+        lines.append(f'collector_records_per_poll_bucket{{le="{bound}"}} {cumulative}')
+    lines.append(f"collector_records_per_poll_sum {total}")
+    lines.append(f"collector_records_per_poll_count {polls}")
+    lines += [
+        "# TYPE collector_last_change_id gauge",
+        f"collector_last_change_id {changeID}",
+        "# TYPE collector_changeid_age_seconds gauge",
+        f"collector_changeid_age_seconds {time.time() - advanced:.3f}",
+    ]
+    if depths:
+        lines.append("# TYPE collector_queue_depth gauge")
+    for queue, depth in depths.items():
+        lines.append(f'collector_queue_depth{{queue="{queue}"}} {depth}')
+    for name, value in sorted(values.items()):
+        lines.append(f"# TYPE collector_{name} {"counter" if name.endswith("_total") else "gauge"}")
+        lines.append(f"collector_{name} {value}")
+    return "\n".join(lines) + "\n"
+
+def summary() -> str:
+    """
+    Mean and max time per stage, and records per poll, since the last
+    summary. Resets the window.
+    """
+    with lock:
+        stageTimes = {stage: list(entry) for stage, entry in windowTimers.items()}
+        polls, total, most = windowRecords["polls"], windowRecords["total"], windowRecords["max"]
+        windowTimers.clear()
+        windowRecords.update(polls=0, total=0, max=0)
+        lag = gauges.get("changeid_lag_seconds")
+        depths = dict(queueDepths)
+    stages = ", ".join(f"{stage} {stageTimes[stage][1] / stageTimes[stage][0] * 1000:.1f} ms "
+                       f"(max {stageTimes[stage][2] * 1000:.0f})"
+                       for stage in STAGES if stage in stageTimes)
+    text = f"{polls} polls, {total / polls if polls else 0:.1f} records/poll (max {most})"
+    if stages:
+        text += f"; {stages}"
+    if lag is not None:
+        text += f"; changeid lag {lag:.1f} s"
+    if depths:
+        text += f"; queues {", ".join(f"{queue} {depth}" for queue, depth in depths.items())}"
+    return text
+
+def maybeLogSummary() -> None:
+    """
+    Log a summary line if SUMMARY_INTERVAL seconds have passed since
+    the last one.
+    """
+    global lastSummary
+    now = time.monotonic()
+    elapsed = now - lastSummary
+    if SUMMARY_INTERVAL <= 0 or elapsed < SUMMARY_INTERVAL:
+        return
+    lastSummary = now
+    log(f"Metrics over {elapsed:.0f} s: {summary()}")
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def startMetricsServer(port: int) -> ThreadingHTTPServer:
+    """
+    Serve the metrics on localhost in a background thread and return
+    the server.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,76 @@
+"""
+Fast decoding of TrainPosition entries into columns.
+
+Positions are always WKT points, "POINT (x y)", so they are parsed by
+slicing the string instead of going through a general WKT parser, and
+each position is decoded exactly once.
+"""
+
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+def parsePoint(text: str) -> Tuple[float, float]:
+    """
+    Parse a WKT point of the form "POINT (x y)".
+    """
+    x, y = text[text.index("(") + 1:text.rindex(")")].split()
+    return float(x), float(y)
+
+class PositionBatch:
+    """
+    A decoded TrainPosition response in columnar form, one list per
+    field. Entries that couldn't be decoded are kept in `failed`
+    together with the exception.
+    """
+
+    def __init__(self):
+        self.trains: List[int] = []
+        self.modifiedTimes: List[float] = []
+        self.measuredTimes: List[float] = []
+        self.SWEREF99TM_1: List[float] = []
+        self.SWEREF99TM_2: List[float] = []
+        self.WGS84_1: List[float] = []
+        self.WGS84_2: List[float] = []
+        self.bearings: List[int] = []
+        self.speeds: List = []
+        self.failed: List[Tuple[dict, Exception]] = []
+
+    def __len__(self):
+        return len(self.trains)
+
+def decodePositions(entries: List[dict]) -> PositionBatch:
+    """
+    Decode a list of TrainPosition entries into a PositionBatch.
+    """
+    batch = PositionBatch()
+    # Many entries in a response share the same timestamps
+    times: Dict[str, float] = {}
+    for entry in entries:
+        try:
+            train = int(entry["Train"]["OperationalTrainNumber"])
+            modified = entry["ModifiedTime"]
+            modifiedTime = times.get(modified)
+            if modifiedTime is None:
+                modifiedTime = times[modified] = datetime.fromisoformat(modified).timestamp()
+            measured = entry["TimeStamp"]
+            measuredTime = times.get(measured)
+            if measuredTime is None:
+                measuredTime = times[measured] = datetime.fromisoformat(measured).timestamp()
+            position = entry["Position"]
+            swerefX, swerefY = parsePoint(position["SWEREF99TM"])
+            wgsX, wgsY = parsePoint(position["WGS84"])
+            bearing = int(entry.get("Bearing") or -1)
+            speed = entry.get("Speed")
+        except Exception as e:
+            batch.failed.append((entry, e))
+            continue
+        batch.trains.append(train)
+        batch.modifiedTimes.append(modifiedTime)
+        batch.measuredTimes.append(measuredTime)
+        batch.SWEREF99TM_1.append(swerefX)
+        batch.SWEREF99TM_2.append(swerefY)
+        batch.WGS84_1.append(wgsX)
+        batch.WGS84_2.append(wgsY)
+        batch.bearings.append(bearing)
+        batch.speeds.append(speed)
+    return batch
@@ -1,39 +1,25 @@
-import os
-from dotenv import load_dotenv
-import requests
-
-load_dotenv("../.env")
-TRAFIKVERKET_API_KEY = os.getenv("TRAFIKVERKET_API_KEY")
-TRAFIKVERKET_URL = "https://api.trafikinfo.trafikverket.se/v2/data.json"
+from station_catalog import loadCatalog
 
 def getStations(filter):
-    headers = {
-        "Content-Type": "application/xml"
-    }
-    req = f"""
-    <REQUEST>
-        <LOGIN authenticationkey="{TRAFIKVERKET_API_KEY}"/>
-        <QUERY objecttype="TrainStation" namespace="rail.infrastructure" schemaversion="1.5" limit="10000">
-        <FILTER>
-        </FILTER>
-        </QUERY>
-    </REQUEST>
+    return loadCatalog().search(filter)
+
+def parseCoordinate(text):
+    """
+    Parse "longitude latitude", or return None if it isn't one.
     """
-    resp = requests.post(TRAFIKVERKET_URL, data = req, headers = headers)
-    obj = resp.json()
-    arr = obj["RESPONSE"]["RESULT"][0]["TrainStation"]
-    # print(json.dumps(arr, indent=2, ensure_ascii=False))
-    stations = []
-    filter = filter.lower()
-    for s in arr:
-        signature = s.get("LocationSignature")
-        locationName = s.get("OfficialLocationName")
-        if filter in signature.lower() or filter in locationName.lower():
-            stations.append((signature, locationName))
-    return stations
+    try:
+        lon, lat = map(float, text.split())
+        return lon, lat
+    except ValueError:
+        return None
 
 def main():
-    filter = input("Search for station: ")
+    filter = input("Search for station (name, code or 'longitude latitude'): ")
+    coordinate = parseCoordinate(filter)
+    if coordinate is not None:
+        for distance, (signature, locationName, _, _) in loadCatalog().nearest(*coordinate, count=5):
+            print(f"{signature} - {locationName} ({distance/1000:.1f} km)")
+        return
     stations = getStations(filter)
     for signature, locationName in stations:
         print(f"{signature} - {locationName}")
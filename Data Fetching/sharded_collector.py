@@ -0,0 +1,264 @@
+"""
+Sharded collection across worker processes.
+
+The coordinator splits the routes into shards with about as many
+trains each, and runs every shard in its own worker process. A worker
+polls only the routes of its shard, with its own changeid stream,
+request filter and route databases, so every database keeps a single
+writer. Workers send heartbeats with their poll counters, and the
+coordinator:
+
+ - logs the merged health of all shards every STATUS_INTERVAL seconds
+ - restarts workers that exit, or that stop polling or sending
+   heartbeats for STALL_TIMEOUT seconds
+ - waits RESTART_BACKOFF seconds, doubled per attempt up to
+   MAX_BACKOFF, before restarting a worker that failed before its first
+   response, as that is likely a fault of its routes (e.g. a broken
+   database) that another shard would fail on as well
+ - hands the routes of a shard whose worker fails after having polled
+   more than MAX_RESTARTS times within RESTART_WINDOW seconds over to
+   the least loaded healthy shard, once: a shard that took routes over
+   is only restarted, with backoff, so that a fault of a route can't
+   spread over all shards
+
+Used by `python data_collector.py --shards <count>`.
+"""
+
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from typing import Callable, List, Optional
+import metrics
+from utils import log
+
+HEARTBEAT_INTERVAL = 5
+STALL_TIMEOUT = 300
+STATUS_INTERVAL = 60
+MAX_RESTARTS = 3
+RESTART_WINDOW = 600
+RESTART_BACKOFF = 5
+MAX_BACKOFF = 300
+
+def assignShards(trains: List[List[int]], count: int) -> List[List[int]]:
+    """
+    Split the route numbers into at most `count` shards with about as
+    many trains each, placing the largest routes first.
+    """
+    shards = [[] for _ in range(min(count, len(trains)))]
+    loads = [0] * len(shards)
+    for routeNumber in sorted(range(len(trains)), key=lambda i: len(trains[i]), reverse=True):
+        shard = loads.index(min(loads))
+        shards[shard].append(routeNumber)
+        loads[shard] += len(trains[routeNumber])
+    return shards
+
+def startHeartbeat(shard: int, heartbeats: multiprocessing.Queue) -> None:
+    """
+    Send the poll counters of this worker to the coordinator every
+    HEARTBEAT_INTERVAL seconds, from a background thread.
+    """
+    pid = os.getpid()
+    def beat():
+        while True:
+            heartbeats.put((shard, pid, metrics.snapshot()))
+            time.sleep(HEARTBEAT_INTERVAL)
+    threading.Thread(target=beat, name="heartbeat", daemon=True).start()
+
+class Shard:
+    """
+    A group of routes polled by one worker process.
+    """
+
+    def __init__(self, number: int, routes: List[int]):
+        self.number = number
+        self.routes = routes
+        self.process = None
+        self.started = 0.0
+        self.lastHeartbeat = None
+        self.counters = None
+        # Whether the current worker has received a response
+        self.healthy = False
+        # Failures after having polled, within RESTART_WINDOW
+        self.restarts = []
+        # Consecutive failures before the first response
+        self.failedStarts = 0
+        self.restartAt = 0.0
+        # Whether routes of a failing shard were handed over to it
+        self.tookOver = False
+        self.retired = False
+
+class Coordinator:
+    """
+    Runs the shards of a collection as worker processes and keeps them
+    running. The worker is called as
+    worker(shard, stations, trains, inclusions, *workerArgs, heartbeats)
+    and must call startHeartbeat.
+    """
+
+    def __init__(self, worker: Callable, stations: List[List[str]], trains: List[List[int]],
+                 inclusions: List[str], count: int, workerArgs: tuple = ()):
+        self.worker = worker
+        self.stations = stations
+        self.trains = trains
+        self.inclusions = inclusions
+        self.workerArgs = workerArgs
+        # Workers start from a fresh interpreter, not a fork of the
+        # coordinator's threads and open databases
+        self.context = multiprocessing.get_context("spawn")
+        self.heartbeats = self.context.Queue()
+        self.shards = [Shard(number, routes) for number, routes in enumerate(assignShards(trains, count))]
+
+    def routeNames(self, shard: Shard) -> str:
+        return ", ".join("_".join(self.stations[i]) for i in shard.routes)
+
+    def load(self, shard: Shard) -> int:
+        return sum(len(self.trains[i]) for i in shard.routes)
+
+    def start(self, shard: Shard) -> None:
+        routes = shard.routes
+        args = (shard.number, [self.stations[i] for i in routes], [self.trains[i] for i in routes],
+                [self.inclusions[i] for i in routes], *self.workerArgs, self.heartbeats)
+        shard.process = self.context.Process(target=self.worker, args=args, name=f"shard-{shard.number}", daemon=True)
+        shard.process.start()
+        shard.started = time.time()
+        shard.lastHeartbeat = None
+        shard.counters = None
+        shard.healthy = False
+        log(f"Started shard {shard.number} (pid {shard.process.pid}) with {self.load(shard)} trains: {self.routeNames(shard)}")
+
+    def stop(self, shard: Shard) -> None:
+        if shard.process is None:
+            return
+        shard.process.terminate()
+        shard.process.join(10)
+        if shard.process.is_alive():
+            shard.process.kill()
+            shard.process.join()
+        shard.process = None
+
+    def receiveHeartbeats(self, timeout: float) -> None:
+        """
+        Take the heartbeats sent so far, waiting up to `timeout`
+        seconds for the first. Heartbeats of stopped workers are
+        ignored.
+        """
+        try:
+            item = self.heartbeats.get(timeout=timeout)
+            while True:
+                number, pid, counters = item
+                shard = self.shards[number]
+                if shard.process is not None and shard.process.pid == pid:
+                    shard.lastHeartbeat = time.time()
+                    shard.counters = counters
+                    if counters["polls"] > 0:
+                        shard.healthy = True
+                        shard.failedStarts = 0
+                item = self.heartbeats.get_nowait()
+        except queue.Empty:
+            pass
+
+    def failure(self, shard: Shard, now: float) -> Optional[str]:
+        """
+        Why the worker of the shard has to be restarted, if it does.
+        """
+        if shard.process.exitcode is not None:
+            return f"exited with code {shard.process.exitcode}"
+        if shard.lastHeartbeat is not None and now - shard.lastHeartbeat > STALL_TIMEOUT:
+            return f"sent no heartbeat for {now - shard.lastHeartbeat:.0f} s"
+        lastPoll = max(shard.started, shard.counters["polled"] if shard.counters else 0)
+        if now - lastPoll > STALL_TIMEOUT:
+            return f"received no response for {now - lastPoll:.0f} s"
+        return None
+
+    def recover(self, shard: Shard, reason: str, now: float) -> None:
+        """
+        Schedule the restart of a failed shard's worker, or hand its
+        routes over to the least loaded healthy shard if it keeps
+        failing after having polled. Workers failing before their first
+        response, or again and again without a shard to hand over to,
+        are restarted after a growing delay.
+        """
+        log(f"Shard {shard.number} (pid {shard.process.pid}) {reason}")
+        self.stop(shard)
+        if not shard.healthy:
+            shard.failedStarts += 1
+            delay = min(MAX_BACKOFF, RESTART_BACKOFF * 2**(shard.failedStarts - 1))
+            log(f"Shard {shard.number} failed before its first response "
+                f"({shard.failedStarts} times in a row), restarting in {delay:.0f} s")
+            shard.restartAt = now + delay
+            return
+        shard.restarts = [restart for restart in shard.restarts if now - restart < RESTART_WINDOW] + [now]
+        if len(shard.restarts) <= MAX_RESTARTS:
+            shard.restartAt = now
+            return
+        targets = [other for other in self.shards
+                   if other is not shard and not other.retired and other.healthy and other.process is not None]
+        if not shard.tookOver and targets:
+            target = min(targets, key=self.load)
+            log(f"Shard {shard.number} failed {len(shard.restarts)} times in {RESTART_WINDOW} s, "
+                f"handing {self.routeNames(shard)} over to shard {target.number}")
+            target.routes = target.routes + shard.routes
+            target.tookOver = True
+            shard.routes = []
+            shard.retired = True
+            # Restarted, as the worker's request filter and databases are fixed at start
+            self.stop(target)
+            self.start(target)
+            return
+        delay = min(MAX_BACKOFF, RESTART_BACKOFF * 2**(len(shard.restarts) - MAX_RESTARTS - 1))
+        log(f"Shard {shard.number} failed {len(shard.restarts)} times in {RESTART_WINDOW} s, restarting in {delay:.0f} s")
+        shard.restartAt = now + delay
+
+    def logStatus(self, now: float) -> None:
+        """
+        Log the merged health of all shards, and one line per shard.
+        """
+        running = [shard for shard in self.shards if not shard.retired]
+        counters = [shard.counters for shard in running if shard.counters]
+        log(f"Shards: {len(running)} running, {sum(c["polls"] for c in counters)} polls and "
+            f"{sum(c["records"] for c in counters)} records in total, "
+            f"{sum(len(shard.restarts) for shard in self.shards)} recent restarts")
+        for shard in running:
+            if shard.process is None:
+                log(f" - shard {shard.number}: restarting in {max(0, shard.restartAt - now):.0f} s, "
+                    f"{shard.failedStarts} failed starts and {len(shard.restarts)} recent restarts")
+                continue
+            if shard.counters is None:
+                log(f" - shard {shard.number} (pid {shard.process.pid}): no heartbeat yet")
+                continue
+            c = shard.counters
+            log(f" - shard {shard.number} (pid {shard.process.pid}): {c["polls"]} polls, {c["records"]} records, "
+                f"changeid {c["changeID"]} ({now - c["advanced"]:.0f} s ago), "
+                f"last response {now - max(c["polled"], shard.started):.0f} s ago, {len(shard.restarts)} recent restarts")
+
+    def run(self) -> None:
+        """
+        Start all shards and supervise them until interrupted, then
+        stop the workers.
+        """
+        log(f"Collecting {len(self.trains)} routes in {len(self.shards)} shards...")
+        lastStatus = time.time()
+        try:
+            for shard in self.shards:
+                self.start(shard)
+            while True:
+                self.receiveHeartbeats(1)
+                now = time.time()
+                for shard in self.shards:
+                    if shard.retired:
+                        continue
+                    if shard.process is None:
+                        if now >= shard.restartAt:
+                            self.start(shard)
+                        continue
+                    reason = self.failure(shard, now)
+                    if reason is not None:
+                        self.recover(shard, reason, now)
+                if now - lastStatus >= STATUS_INTERVAL:
+                    lastStatus = now
+                    self.logStatus(now)
+        finally:
+            for shard in self.shards:
+                self.stop(shard)
@@ -0,0 +1,196 @@
+"""
+Local, indexed catalog of train stations.
+
+The TrainStation catalog is cached on disk (in CACHE_DIR, see
+get_trains) and refreshed with changeid once older than CATALOG_TTL,
+so only changed stations are downloaded. Names are indexed by
+n-grams for substring search and coordinates by a grid for
+nearest-station and box queries.
+"""
+
+import json
+import math
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+from utils import log
+import trafikverket
+from trafikverket import TRAFIKVERKET_API_KEY
+from position_decoder import parsePoint
+from get_trains import CACHE_DIR
+
+CATALOG_FILE = f"{CACHE_DIR}/stations.json"
+CATALOG_TTL = 24*60*60
+NGRAM = 3
+# Grid cell size in degrees
+CELL = 0.1
+
+def fetchStations(lastChangeID: int) -> Tuple[List[dict], int]:
+    """
+    Fetch the stations changed since the given changeid (all of them
+    for 0) and return them with the new changeid.
+    """
+    req = f"""
+    <REQUEST>
+        <LOGIN authenticationkey="{TRAFIKVERKET_API_KEY}"/>
+        <QUERY objecttype="TrainStation" namespace="rail.infrastructure" schemaversion="1.5" limit="10000" changeid="{lastChangeID}">
+        <FILTER>
+        </FILTER>
+        <INCLUDE>LocationSignature</INCLUDE>
+        <INCLUDE>OfficialLocationName</INCLUDE>
+        <INCLUDE>Geometry.WGS84</INCLUDE>
+        <INCLUDE>Deleted</INCLUDE>
+        </QUERY>
+    </REQUEST>
+    """
+    data = trafikverket.query(req)
+    return data["TrainStation"], int(data["INFO"]["LASTCHANGEID"])
+
+def loadCatalog(refresh: bool = False) -> "StationCatalog":
+    """
+    Load the station catalog from disk, updating it from the API if
+    it is missing, older than CATALOG_TTL or a refresh is forced.
+    """
+    cached = {"fetched": 0, "lastChangeID": 0, "stations": {}}
+    file = Path(CATALOG_FILE)
+    if file.exists():
+        with open(file, "r") as f:
+            cached = json.load(f)
+    if refresh or time.time() - cached["fetched"] >= CATALOG_TTL:
+        log(f"Updating station catalog from changeid {cached["lastChangeID"]}...")
+        changed, lastChangeID = fetchStations(cached["lastChangeID"])
+        for station in changed:
+            signature = station.get("LocationSignature")
+            if station.get("Deleted"):
+                cached["stations"].pop(signature, None)
+            else:
+                cached["stations"][signature] = station
+        cached["fetched"] = time.time()
+        cached["lastChangeID"] = lastChangeID
+        file.parent.mkdir(parents=True, exist_ok=True)
+        with open(file, "w") as f:
+            json.dump(cached, f, ensure_ascii=False)
+        log(f"Updated {len(changed)} stations, {len(cached["stations"])} in catalog")
+    return StationCatalog(list(cached["stations"].values()))
+
+def ngrams(text: str) -> Set[str]:
+    """
+    All substrings of the text up to NGRAM characters long.
+    """
+    return {text[i:i + n] for n in range(1, NGRAM + 1) for i in range(len(text) - n + 1)}
+
+def distance(lon1: float, lat1: float, lon2: float, lat2: float) -> float:
+    """
+    Great-circle distance in metres.
+    """
+    lon1, lat1, lon2, lat2 = map(math.radians, (lon1, lat1, lon2, lat2))
+    a = math.sin((lat2 - lat1) / 2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2)**2
+    return 2 * 6371000 * math.asin(math.sqrt(a))
+
+class StationCatalog:
+    """
+    Stations as (signature, name, longitude, latitude) tuples, with a
+    name index and a spatial grid index.
+    """
+
+    def __init__(self, stations: List[dict]):
+        self.stations: List[Tuple[str, str, Optional[float], Optional[float]]] = []
+        self.bySignature: Dict[str, int] = {}
+        self.names: Dict[str, Set[int]] = {}
+        self.grid: Dict[Tuple[int, int], List[int]] = {}
+        for station in stations:
+            signature = station.get("LocationSignature")
+            name = station.get("OfficialLocationName") or ""
+            point = station.get("Geometry", {}).get("WGS84")
+            lon, lat = parsePoint(point) if point else (None, None)
+            index = len(self.stations)
+            self.stations.append((signature, name, lon, lat))
+            self.bySignature[signature.lower()] = index
+            for gram in ngrams(signature.lower()) | ngrams(name.lower()):
+                self.names.setdefault(gram, set()).add(index)
+            if lon is not None:
+                self.grid.setdefault(self.cell(lon, lat), []).append(index)
+
+    def cell(self, lon: float, lat: float) -> Tuple[int, int]:
+        return math.floor(lon / CELL), math.floor(lat / CELL)
+
+    def get(self, signature: str) -> Optional[Tuple]:
+        index = self.bySignature.get(signature.lower())
+        return self.stations[index] if index is not None else None
+
+    def search(self, query: str) -> List[Tuple[str, str]]:
+        """
+        Return (signature, name) of all stations whose signature or
+        name contains the query, case-insensitively.
+        """
+        query = query.lower()
+        if query == "":
+            candidates = range(len(self.stations))
+        elif len(query) <= NGRAM:
+            candidates = self.names.get(query, set())
+        else:
+            grams = [query[i:i + NGRAM] for i in range(len(query) - NGRAM + 1)]
+            candidates = set.intersection(*(self.names.get(gram, set()) for gram in grams))
+        result = []
+        for index in sorted(candidates):
+            signature, name, _, _ = self.stations[index]
+            if query in signature.lower() or query in name.lower():
+                result.append((signature, name))
+        return result
+
+    def nearest(self, lon: float, lat: float, count: int = 1) -> List[Tuple[float, Tuple]]:
+        """
+        Return the given number of stations closest to the coordinate
+        as (distance in metres, station) pairs, closest first.
+        """
+        if not self.grid:
+            return []
+        cx, cy = self.cell(lon, lat)
+        found = []
+        ring = 0
+        maxRing = max(max(abs(x - cx), abs(y - cy)) for x, y in self.grid)
+        while ring <= maxRing:
+            for x in range(cx - ring, cx + ring + 1):
+                for y in range(cy - ring, cy + ring + 1):
+                    if max(abs(x - cx), abs(y - cy)) != ring:
+                        continue
+                    for index in self.grid.get((x, y), ()):
+                        station = self.stations[index]
+                        found.append((distance(lon, lat, station[2], station[3]), station))
+            # Stations in further rings are at least `ring` cells away
+            found.sort(key=lambda pair: pair[0])
+            ringDistance = ring * CELL * 111000 * math.cos(math.radians(min(abs(lat) + (ring + 1) * CELL, 89)))
+            if len(found) >= count and found[count - 1][0] <= ringDistance:
+                break
+            ring += 1
+        return found[:count]
+
+    def withinBox(self, minLon: float, minLat: float, maxLon: float, maxLat: float) -> List[Tuple]:
+        """
+        Return all stations within the given WGS84 box.
+        """
+        result = []
+        minX, minY = self.cell(minLon, minLat)
+        maxX, maxY = self.cell(maxLon, maxLat)
+        for x in range(minX, maxX + 1):
+            for y in range(minY, maxY + 1):
+                for index in self.grid.get((x, y), ()):
+                    station = self.stations[index]
+                    if minLon <= station[2] <= maxLon and minLat <= station[3] <= maxLat:
+                        result.append(station)
+        return result
+
+    def inclusionBox(self, signatures: List[str], margin: float = 0.05) -> str:
+        """
+        Derive an inclusion box (as used by the collector) covering
+        the given stations, widened by the margin in degrees.
+        """
+        points = []
+        for signature in signatures:
+            station = self.get(signature)
+            if station is None or station[2] is None:
+                raise ValueError(f"No coordinates for station {signature}")
+            points.append(station[2:])
+        lons = [p[0] for p in points]
+        lats = [p[1] for p in points]
+        return f"{min(lons) - margin} {min(lats) - margin}, {max(lons) + margin} {max(lats) + margin}"
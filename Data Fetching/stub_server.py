@@ -0,0 +1,85 @@
+"""
+Local stub of the Trafikverket API which replays recorded responses.
+
+Responses are recorded with `python data_collector.py --record <file>`
+(one response body per line) and replayed in order, one per request.
+Once the recording is exhausted, empty results are returned with the
+last seen LASTCHANGEID, like an idle long-poll.
+
+Run with `python stub_server.py <recording> [port]` and point the
+collector at it with `TRAFIKVERKET_URL=http://localhost:<port>`.
+"""
+
+import json
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+
+def loadRecording(location: str) -> List[str]:
+    """
+    Read the recorded response bodies from a file.
+    """
+    with open(location, "r") as f:
+        return [line for line in f.read().split("\n") if line != ""]
+
+def idleResponse(lastChangeID: str) -> str:
+    return json.dumps({"RESPONSE": {"RESULT": [{
+        "TrainPosition": [],
+        "INFO": {"LASTCHANGEID": lastChangeID}
+    }]}})
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        server = self.server
+        with server.lock:
+            if server.position < len(server.responses):
+                body = server.responses[server.position]
+                server.position += 1
+                server.lastChangeID = json.loads(body)["RESPONSE"]["RESULT"][0]["INFO"]["LASTCHANGEID"]
+            else:
+                body = idleResponse(server.lastChangeID)
+        encoded = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    def log_message(self, format, *args):
+        pass
+
+def createStubServer(responses: List[str], port: int) -> ThreadingHTTPServer:
+    """
+    Create a replay server for the given response bodies on localhost.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), ReplayHandler)
+    server.responses = responses
+    server.position = 0
+    server.lastChangeID = "0"
+    server.lock = threading.Lock()
+    return server
+
+def startStubServer(responses: List[str], port: int = 0) -> ThreadingHTTPServer:
+    """
+    Serve the given response bodies in a background thread and return
+    the server. Use port 0 to pick a free port, the chosen one is in
+    `server.server_address[1]`.
+    """
+    server = createStubServer(responses, port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: python stub_server.py <recording> [port]")
+        sys.exit(1)
+    responses = loadRecording(sys.argv[1])
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8000
+    server = createStubServer(responses, port)
+    print(f"Replaying {len(responses)} responses on http://127.0.0.1:{port}")
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
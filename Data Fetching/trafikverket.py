@@ -0,0 +1,102 @@
+"""
+Shared HTTP client for the Trafikverket API.
+
+All requests go through one pooled keep-alive session, so long-running
+collection reuses its TLS connections instead of opening a new one per
+request. Transient network errors, rate limiting (429) and server
+errors (5xx) are retried with bounded exponential backoff, and
+latency/retry counters are kept for monitoring.
+"""
+
+import os
+import threading
+import time
+from dotenv import load_dotenv
+import requests
+from requests.adapters import HTTPAdapter
+from utils import log
+
+load_dotenv("../.env")
+TRAFIKVERKET_API_KEY = os.getenv("TRAFIKVERKET_API_KEY")
+TRAFIKVERKET_URL = os.getenv("TRAFIKVERKET_URL", "https://api.trafikinfo.trafikverket.se/v2/data.json")
+
+session = requests.Session()
+session.headers.update({
+    "Content-Type": "application/xml",
+    "Accept-Encoding": "gzip, deflate",
+})
+adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+session.mount("https://", adapter)
+session.mount("http://", adapter)
+
+statsLock = threading.Lock()
+stats = {
+    "requests": 0,
+    "retries": 0,
+    "failures": 0,
+    "latency": 0.0,
+    "maxLatency": 0.0,
+}
+
+def post(req: str, timeout: float = 10, retries: int = 5, backoff: float = 0.5, maxBackoff: float = 30) -> requests.Response:
+    """
+    Post an XML request to the API. Connection errors, timeouts and
+    429/5xx responses are retried up to `retries` times, waiting
+    `backoff` seconds doubled per attempt (at most `maxBackoff`),
+    before the last error is raised (as an HTTPError for responses).
+    Other error responses are returned, see raise_for_status.
+    """
+    attempt = 0
+    while True:
+        started = time.perf_counter()
+        try:
+            resp = session.post(TRAFIKVERKET_URL, data = req, timeout=timeout)
+            latency = time.perf_counter() - started
+            with statsLock:
+                stats["requests"] += 1
+                stats["latency"] += latency
+                stats["maxLatency"] = max(stats["maxLatency"], latency)
+            if not isRetryable(resp):
+                return resp
+            if attempt >= retries:
+                with statsLock:
+                    stats["failures"] += 1
+                resp.raise_for_status()
+            reason = f"HTTP {resp.status_code}"
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if attempt >= retries:
+                with statsLock:
+                    stats["failures"] += 1
+                raise
+            reason = type(e).__name__
+        delay = min(maxBackoff, backoff * 2**attempt)
+        with statsLock:
+            stats["retries"] += 1
+        log(f"Retrying Trafikverket request in {delay:.1f}s ({reason})...")
+        time.sleep(delay)
+        attempt += 1
+
+def isRetryable(resp: requests.Response) -> bool:
+    """
+    Whether the response is a rate limit or server error, which may
+    succeed when retried.
+    """
+    return resp.status_code == 429 or resp.status_code >= 500
+
+def query(req: str, **kwargs) -> dict:
+    """
+    Post an XML request and return the first RESULT of the response.
+    """
+    resp = post(req, **kwargs)
+    resp.raise_for_status()
+    return resp.json()["RESPONSE"]["RESULT"][0]
+
+def getStats() -> dict:
+    """
+    Return a snapshot of the request counters, including the mean
+    latency in seconds.
+    """
+    with statsLock:
+        snapshot = dict(stats)
+    snapshot["meanLatency"] = snapshot["latency"] / snapshot["requests"] if snapshot["requests"] else 0.0
+    return snapshot
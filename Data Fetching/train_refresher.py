@@ -0,0 +1,129 @@
+"""
+Incremental refresh of the tracked trains.
+
+getAllTrains looks the trains of every route up once, at startup.
+TrainRefresher instead follows the TrainAnnouncement changes at the
+route stations with changeid, keeping the announcements of every
+station by ActivityId, so a long-running collection can pick up trains
+added to (or removed from) the timetable later without refetching all
+announcements.
+
+It starts from the announcements of the startup lookup (see
+get_trains). Until a pass has received every change, trains missing
+from it may only be missing from a truncated page, so they are only
+removed after a complete pass.
+"""
+
+from typing import Dict, List, Set, Tuple
+from utils import log
+import trafikverket
+from trafikverket import TRAFIKVERKET_API_KEY
+
+PAGE_SIZE = 10000
+
+def fetchAnnouncementChanges(locationSignatures: List[str], lastChangeID: int) -> Tuple[List[dict], int]:
+    """
+    Fetch up to PAGE_SIZE announcements at the given stations changed
+    since the changeid (all of them for 0), and the new changeid.
+    """
+    stations = "".join(f'<EQ name="LocationSignature" value="{signature}" />' for signature in locationSignatures)
+    req = f"""
+    <REQUEST>
+        <LOGIN authenticationkey="{TRAFIKVERKET_API_KEY}"/>
+        <QUERY objecttype="TrainAnnouncement" schemaversion="1.9" limit="{PAGE_SIZE}" changeid="{lastChangeID}">
+        <FILTER>
+            <OR>{stations}</OR>
+        </FILTER>
+        <INCLUDE>ActivityId</INCLUDE>
+        <INCLUDE>LocationSignature</INCLUDE>
+        <INCLUDE>OperationalTrainNumber</INCLUDE>
+        <INCLUDE>Deleted</INCLUDE>
+        </QUERY>
+    </REQUEST>
+    """
+    data = trafikverket.query(req, timeout=60)
+    return data.get("TrainAnnouncement", []), int(data["INFO"]["LASTCHANGEID"])
+
+class TrainRefresher:
+    """
+    The trains of a set of routes, kept up to date from the
+    announcement changes of their stations.
+    """
+
+    def __init__(self, stations: List[List[str]]):
+        self.stations = stations
+        self.signatures = list(dict.fromkeys(location for locations in stations for location in locations))
+        # station -> ActivityId -> train
+        self.activities: Dict[str, Dict[str, int]] = {signature: {} for signature in self.signatures}
+        self.lastChangeID = 0
+        # Whether the last update received every change since the one before
+        self.complete = False
+
+    def seed(self, activities: Dict[str, Dict[str, int]]) -> None:
+        """
+        Start from already known announcements per station, e.g. from
+        get_trains.loadStationActivities.
+        """
+        for signature, announcements in activities.items():
+            if signature in self.activities:
+                self.activities[signature].update(announcements)
+
+    def update(self) -> int:
+        """
+        Apply the announcement changes since the last update (all
+        announcements on the first) and return how many there were.
+        Sets complete unless the changes couldn't all be paged through.
+        """
+        changes = 0
+        self.complete = False
+        while True:
+            entries, lastChangeID = fetchAnnouncementChanges(self.signatures, self.lastChangeID)
+            for entry in entries:
+                announcements = self.activities.get(entry.get("LocationSignature"))
+                activity = entry.get("ActivityId")
+                if announcements is None or activity is None:
+                    continue
+                train = entry.get("OperationalTrainNumber")
+                if entry.get("Deleted") or train is None:
+                    announcements.pop(activity, None)
+                else:
+                    announcements[activity] = int(train)
+            changes += len(entries)
+            advanced = lastChangeID != self.lastChangeID
+            self.lastChangeID = lastChangeID
+            # A full page means there may be more changes after it
+            if len(entries) < PAGE_SIZE:
+                self.complete = True
+                break
+            if not advanced:
+                break
+        return changes
+
+    def stationTrains(self, signature: str) -> Set[int]:
+        return set(self.activities[signature].values())
+
+    def trains(self) -> List[List[int]]:
+        """
+        The trains of every route: those announced at all of its
+        stations, like getTrains.
+        """
+        result = []
+        for locations in self.stations:
+            trains = self.stationTrains(locations[0])
+            for location in locations[1:]:
+                trains &= self.stationTrains(location)
+            result.append(sorted(trains))
+        return result
+
+def diffTrains(old: List[List[int]], new: List[List[int]]) -> List[Tuple[List[int], List[int]]]:
+    """
+    The (added, removed) trains of every route.
+    """
+    return [(sorted(set(newList) - set(oldList)), sorted(set(oldList) - set(newList)))
+            for oldList, newList in zip(old, new)]
+
+def logChanges(stations: List[List[str]], changes: List[Tuple[List[int], List[int]]]) -> None:
+    for locations, (added, removed) in zip(stations, changes):
+        if added or removed:
+            log(f"Trains between {", ".join(locations)}: {len(added)} added {added[:10]}, "
+                f"{len(removed)} removed {removed[:10]}")
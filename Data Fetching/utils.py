@@ -1,36 +1,173 @@
 """
 Utility functions for data collection.
+
+Log messages are queued and written by a background thread to a log
+file that is kept open and rotated by size, so that logging never
+waits on the disk.
 """
 
 from pathlib import Path
 from datetime import datetime, timezone
 from dotenv import load_dotenv
+import atexit
 import os
+import queue
+import threading
+import time
 
 LOGGING = True
 PRINTING = True
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUPS = 5
+LOG_QUEUE_SIZE = 10000
 
 load_dotenv("../.env")
 DATA_FOLDER_DIR = os.getenv("DATA_FOLDER_DIR")
 loglocation = f"{DATA_FOLDER_DIR}/log.txt"
 
-def log(message):
+logQueue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+writerLock = threading.Lock()
+writer = None
+dropped = 0
+
+class Lazy:
     """
-    Log and/or print the message based on the current config.
+    A log argument that is only computed when the message is written,
+    e.g. `log("Response:\\n%s", Lazy(json.dumps, obj, indent=2))`.
     """
-    if LOGGING:
-        file = Path(loglocation)
-        file.parent.mkdir(parents=True, exist_ok=True)
-        with open(loglocation, "a") as f:
-            time = getTimestamp()
-            f.write(f"[{time}]: {message}\n")
+
+    def __init__(self, function, *args, **kwargs):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+
+    def __str__(self):
+        return str(self.function(*self.args, **self.kwargs))
+
+def log(message, *args):
+    """
+    Log and/or print the message based on the current config. Given
+    args, the message is %-formatted with them, for the log file by
+    the writer thread. Never blocks: while the queue is full, messages
+    to the log file are dropped and counted.
+    """
+    global dropped
     if PRINTING:
+        message = formatMessage(message, args)
+        args = ()
         print(message)
+    if LOGGING:
+        startWriter()
+        try:
+            logQueue.put_nowait((time.time(), message, args))
+        except queue.Full:
+            with writerLock:
+                dropped += 1
+
+def formatMessage(message, args) -> str:
+    if not args:
+        return str(message)
+    try:
+        return str(message) % args
+    except (TypeError, ValueError):
+        return f"{message} {args}"
+
+def getTimestamp(created: float = None) -> str:
+    """
+    Get the current time, or the given unix time, as a string of ISO
+    8601 format.
+    """
+    now = datetime.now(timezone.utc) if created is None else datetime.fromtimestamp(created, timezone.utc)
+    formatted = now.astimezone().isoformat(timespec="milliseconds")
+    return formatted
+
+def startWriter() -> None:
+    global writer
+    if writer is not None:
+        return
+    with writerLock:
+        if writer is None:
+            writer = threading.Thread(target=writeLog, name="log-writer", daemon=True)
+            writer.start()
+            atexit.register(flushLog)
+
+def flushLog(timeout: float = 5) -> None:
+    """
+    Wait until every message logged so far is written.
+    """
+    if writer is None:
+        return
+    written = threading.Event()
+    logQueue.put(written)
+    written.wait(timeout)
+
+class LogFile:
+    """
+    The open log file, reopened if it is moved or deleted (e.g. by
+    createDataFolder) and rotated to log.txt.1, .2... by size.
+    """
+
+    def __init__(self):
+        self.file = None
+        self.location = None
+
+    def write(self, text: str) -> None:
+        if self.file is None or self.location != loglocation or os.fstat(self.file.fileno()).st_nlink == 0:
+            self.open()
+        self.file.write(text)
+        self.file.flush()
+        if self.file.tell() >= LOG_MAX_BYTES:
+            self.rotate()
+
+    def open(self) -> None:
+        if self.file is not None:
+            self.file.close()
+        self.location = loglocation
+        Path(self.location).parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(self.location, "a")
+
+    def rotate(self) -> None:
+        self.file.close()
+        for i in range(LOG_BACKUPS - 1, 0, -1):
+            if os.path.exists(f"{self.location}.{i}"):
+                os.replace(f"{self.location}.{i}", f"{self.location}.{i + 1}")
+        if LOG_BACKUPS > 0:
+            os.replace(self.location, f"{self.location}.1")
+        else:
+            os.remove(self.location)
+        self.file = None
+        self.open()
 
-def getTimestamp() -> str:
+def writeLog() -> None:
     """
-    Get the current time as a string of ISO 8601 format.
+    Write queued messages to the log file, as many at a time as are
+    queued.
     """
-    now = datetime.now(timezone.utc).astimezone()
-    formatted = now.isoformat(timespec="milliseconds")
-    return formatted
\ No newline at end of file
+    global dropped
+    logFile = LogFile()
+    while True:
+        entries = [logQueue.get()]
+        while True:
+            try:
+                entries.append(logQueue.get_nowait())
+            except queue.Empty:
+                break
+        lines = []
+        written = []
+        with writerLock:
+            if dropped:
+                lines.append(f"[{getTimestamp()}]: ({dropped} log messages dropped, the log queue was full)\n")
+                dropped = 0
+        for entry in entries:
+            if isinstance(entry, threading.Event):
+                written.append(entry)
+                continue
+            created, message, args = entry
+            lines.append(f"[{getTimestamp(created)}]: {formatMessage(message, args)}\n")
+        try:
+            if lines:
+                logFile.write("".join(lines))
+        except OSError as e:
+            print(f"Couldn't write to the log file {loglocation}: {e}")
+        for event in written:
+            event.set()
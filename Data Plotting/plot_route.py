@@ -1,222 +1,295 @@
 import sqlite3
 import os
-import sys
-import datetime
+import json
+import shutil
+import argparse
 import webbrowser
+import numpy as np
+from position_reader import read_journeys
 
-def unix_to_human_time(unix_timestamp):
-    return datetime.datetime.fromtimestamp(unix_timestamp, datetime.UTC).strftime('%Y-%m-%d %H:%M:%S')
+def load_route_path(location, tolerance=None):
+    """
+    Load a cleaned route as [lat, lon] pairs, using the coarsest level
+    of detail within the tolerance (in metres) stored by
+    simplify_route.py next to it, if any.
+    """
+    with open(location, 'r') as file:
+        path = json.load(file)
+    levels_location = f"{os.path.splitext(location)[0]}.lod.json"
+    if tolerance and os.path.exists(levels_location):
+        with open(levels_location, 'r') as file:
+            levels = json.load(file)['levels']
+        usable = [level for level in levels if float(level) <= tolerance]
+        if usable:
+            path = levels[max(usable, key=float)]
+    return [[lat, lon] for lon, lat in path]
 
-def generate_map(database_path):
+def journey_columns(columns):
+    """
+    The positions of a journey as compact columns: measured and
+    received unix times, latitudes and longitudes.
+    """
+    return {
+        't': np.round(columns['measuredTime'], 3).tolist(),
+        'r': np.round(columns['receivedTime'], 3).tolist(),
+        'lat': np.round(columns['WGS84_2'], 6).tolist(),
+        'lon': np.round(columns['WGS84_1'], 6).tolist(),
+    }
+
+def write_script(location, callback, *args):
+    """
+    Write data as a script calling the given function, so that the
+    page can load it on demand from file:// without fetch.
+    """
+    with open(location, "w", encoding="utf-8") as f:
+        f.write(f"{callback}({','.join(json.dumps(arg, separators=(',', ':')) for arg in args)});\n")
+
+def write_data(database_path, directory, route=None):
+    """
+    Write one data script per journey, and an index of the trains and
+    their journeys with point counts, to the directory. Returns the
+    index.
+    """
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
     conn = sqlite3.connect(database_path)
-    cursor = conn.cursor()
+    trains = {}
+    for train, journey, journey_data in read_journeys(conn, route):
+        write_script(os.path.join(directory, f"{train}_{journey}.js"), "loadJourney", train, journey, journey_columns(journey_data))
+        trains.setdefault(train, []).append([journey, len(journey_data['measuredTime'])])
+    conn.close()
+    write_script(os.path.join(directory, "trains.js"), "loadTrains", trains)
+    return trains
 
-    # Fetch unique train numbers
-    cursor.execute("SELECT DISTINCT operationalTrainNumber FROM timestamps ORDER BY operationalTrainNumber")
-    train_numbers = [row[0] for row in cursor.fetchall()]
+# How the page loads its data: scripts written next to it by write_data
+STATIC_LOADER = """
+            function requestTrains() {
+                loadScript("data/trains.js");
+            }
 
-    if not train_numbers:
-        print("No train data found in the database.")
-        return
+            function fetchJourney(train, journey) {
+                loadScript(`data/${train}_${journey}.js`);
+            }
+"""
 
-    # Get train data
-    cursor.execute("SELECT operationalTrainNumber, journeyNumber, receivedTime, measuredTime, WGS84_1, WGS84_2 FROM timestamps ORDER BY operationalTrainNumber, journeyNumber, receivedTime")
-    train_data = cursor.fetchall()
-    conn.close()
+def map_html(route_path, loader):
+    """
+    The map page, loading the train list and journeys with the given
+    JavaScript requestTrains and fetchJourney functions, which hand
+    their data to loadTrains and loadJourney.
+    """
+    return f"""
+    <!DOCTYPE html>
+    <html>
+    <head>
+        <title>Train Route Map</title>
+        <link rel="stylesheet" href="https://unpkg.com/leaflet@1.7.1/dist/leaflet.css" />
+        <script src="https://unpkg.com/leaflet@1.7.1/dist/leaflet.js"></script>
+        <style>
+            body, html {{ height: 100%; margin: 0; }}
+            #map {{ height: 100%; width: 100%; }}
+            #infoBox {{ position: absolute; top: 10px; left: 10px; background: white; padding: 10px; border-radius: 5px; z-index: 1000; }}
+            #controls {{ position: absolute; top: 10px; right: 10px; background: white; padding: 10px; border-radius: 5px; z-index: 1000; }}
+            #sliderContainer {{ position: absolute; bottom: 10px; left: 50%; transform: translateX(-50%); background: white; padding: 10px; border-radius: 5px; z-index: 1000; width: clamp(100px, 70% 400px); }}
+            #markerSlider {{ width: 100%; }}
+        </style>
+    </head>
+    <body>
+        <div id="map"></div>
+        <div id="infoBox">Press → to start animation</div>
+        <div id="controls">
+            <label for="trainSelect">Train:</label>
+            <select id="trainSelect" onchange="updateTrain()"></select>
+            <label for="journeySelect">Journey:</label>
+            <select id="journeySelect" onchange="updateJourney()"></select>
+        </div>
+        <div id="sliderContainer">
+            <input type="range" id="markerSlider" min="1" value="1" step="1" oninput="updateMarkerFromSlider()">
+        </div>
+        <script>
+            var map = L.map('map', {{ preferCanvas: true }}).setView([59.8, 17.7], 12);
+            L.tileLayer('https://{{s}}.tile.openstreetmap.org/{{z}}/{{x}}/{{y}}.png', {{
+                attribution: 'Map data &copy; <a href="https://www.openstreetmap.org/copyright">OpenStreetMap</a> contributors'
+            }}).addTo(map);
+            var routePath = {json.dumps(route_path or [])};
+            if (routePath.length > 0) {{
+                L.polyline(routePath, {{ color: "#3388FF", weight: 3, opacity: 0.6 }}).addTo(map);
+            }}
+            // The trail up to the current position, and the current position
+            var trail = L.polyline([], {{ color: "#FF0000", weight: 3, opacity: 0.5 }}).addTo(map);
+            var marker = L.circleMarker([0, 0], {{
+                radius: 10, fillColor: "#FFA500", fillOpacity: 1.0, color: "#CC8400", weight: 2
+            }});
+            var trains = {{}};
+            var journeys = {{}};
+            var pending = {{}};
+            var selectedTrain = null;
+            var selectedJourney = null;
+            var route = null;
+            var markerIndex = 0;
 
-    # Structure data
-    train_routes = {}
-    for train, journey, received_time, measured_time, lon, lat in train_data:
-        if train not in train_routes:
-            train_routes[train] = {}
-        if journey not in train_routes[train]:
-            train_routes[train][journey] = []
-        train_routes[train][journey].append({
-            'lat': lat,
-            'lon': lon,
-            'human_received_time': unix_to_human_time(received_time),
-            'measured_time': unix_to_human_time(measured_time),
-            'journey': journey
-        })
+            function loadScript(src) {{
+                let script = document.createElement("script");
+                script.src = src;
+                document.head.appendChild(script);
+            }}
 
-    # Generate HTML
-    html_path = "train_map.html"
-    with open(html_path, "w", encoding="utf-8") as f:
-        f.write(f"""
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <title>Train Route Map</title>
-            <link rel="stylesheet" href="https://unpkg.com/leaflet@1.7.1/dist/leaflet.css" />
-            <script src="https://unpkg.com/leaflet@1.7.1/dist/leaflet.js"></script>
-            <style>
-                body, html {{ height: 100%; margin: 0; }}
-                #map {{ height: 100%; width: 100%; }}
-                #infoBox {{ position: absolute; top: 10px; left: 10px; background: white; padding: 10px; border-radius: 5px; z-index: 1000; }}
-                #controls {{ position: absolute; top: 10px; right: 10px; background: white; padding: 10px; border-radius: 5px; z-index: 1000; }}
-                #sliderContainer {{ position: absolute; bottom: 10px; left: 50%; transform: translateX(-50%); background: white; padding: 10px; border-radius: 5px; z-index: 1000; width: clamp(100px, 70% 400px); }}
-                #markerSlider {{ width: 100%; }}
-            </style>
-        </head>
-        <body>
-            <div id="map"></div>
-            <div id="infoBox">Press → to start animation</div>
-            <div id="controls">
-                <label for="trainSelect">Train:</label>
-                <select id="trainSelect" onchange="updateTrain()">
-                    {''.join(f'<option value="{train}">{train}</option>' for train in train_routes)}
-                </select>
-                <label for="journeySelect">Journey:</label>
-                <select id="journeySelect" onchange="updateJourney()"></select>
-            </div>
-            <div id="sliderContainer">
-                <input type="range" id="markerSlider" min="1" value="1" step="1" oninput="updateMarkerFromSlider()">
-            </div>
-            <script>
-                var map = L.map('map').setView([59.8, 17.7], 12);
-                L.tileLayer('https://{{s}}.tile.openstreetmap.org/{{z}}/{{x}}/{{y}}.png', {{
-                    attribution: 'Map data &copy; <a href="https://www.openstreetmap.org/copyright">OpenStreetMap</a> contributors'
-                }}).addTo(map);
-                var markers = [];
-                var trainRoutes = {train_routes};
-                var selectedTrain = Object.keys(trainRoutes)[0];
-                var selectedJourney = null;
-                var markerIndex = 0;
-                var markerRange = [];
-
-                function updateTrain() {{
-                    selectedTrain = document.getElementById("trainSelect").value;
-                    updateJourneyList();
-                }}
+            function loadTrains(data) {{
+                trains = data;
+                let trainSelect = document.getElementById("trainSelect");
+                trainSelect.innerHTML = Object.keys(trains).map(train => `<option value="${{train}}">${{train}}</option>`).join("");
+                selectedTrain = Object.keys(trains)[0];
+                updateJourneyList();
+            }}
 
-                function updateJourneyList() {{
-                    var journeySelect = document.getElementById("journeySelect");
-                    journeySelect.innerHTML = "";
-                    Object.keys(trainRoutes[selectedTrain]).forEach(journey => {{
-                        journeySelect.innerHTML += `<option value="${{journey}}">${{journey}}</option>`;
-                    }});
-                    selectedJourney = Object.keys(trainRoutes[selectedTrain])[0];
-                    updateSliderMax()
-                    resetAnimation();
+            function loadJourney(train, journey, data) {{
+                let key = train + "_" + journey;
+                data.points = data.lat.map((lat, i) => [lat, data.lon[i]]);
+                journeys[key] = data;
+                if (pending[key]) {{
+                    pending[key](data);
+                    delete pending[key];
                 }}
+            }}
 
-                function updateJourney() {{
-                    selectedJourney = document.getElementById("journeySelect").value;
-                    updateSliderMax()
-                    resetAnimation();
+            function requestJourney(train, journey, callback) {{
+                let key = train + "_" + journey;
+                if (journeys[key]) {{
+                    callback(journeys[key]);
+                }} else {{
+                    pending[key] = callback;
+                    fetchJourney(train, journey);
                 }}
+            }}
 
-                function resetAnimation() {{
-                    markerRange = [];
-                    markerIndex = 0;
-                    clearMarkers();
-                    updateSliderValue()
-                    nextMarker();
-                }}
+            function formatTime(unix) {{
+                return new Date(unix * 1000).toISOString().slice(0, 19).replace("T", " ");
+            }}
 
-                function clearMarkers() {{
-                    markers.forEach(marker => map.removeLayer(marker));
-                    markers = [];
-                }}
+            function journeyList() {{
+                return trains[selectedTrain].map(entry => "" + entry[0]);
+            }}
 
-                function nextMarker() {{
-                    if (selectedTrain && selectedJourney) {{
-                        let route = trainRoutes[selectedTrain][selectedJourney];
-                        if (markerIndex < route.length) {{
-                            markerRange.push(route[markerIndex]);
-                            markerIndex++;
-                            updateSliderValue()
-                            updateMarkers();
-                        }} else {{
-                            // Move to next journey number
-                            let availableJourneys = Object.keys(trainRoutes[selectedTrain]).length;
-                            if (parseInt(selectedJourney) < availableJourneys) {{
-                                selectedJourney = "" + (parseInt(selectedJourney)+1)
-                                markerIndex = 0;
-                                document.getElementById("journeySelect").value = selectedJourney;
-                                updateSliderMax()
-                                nextMarker();
-                            }}
-                        }}
-                    }}
-                }}
+            function updateTrain() {{
+                selectedTrain = document.getElementById("trainSelect").value;
+                updateJourneyList();
+            }}
 
-                function previousMarker() {{
-                    if (markerRange.length > 1) {{
-                        markerRange.pop();
-                        markerIndex--;
-                        if (markerIndex < 1 && parseInt(selectedJourney) > 1) {{
-                            selectedJourney = "" + (parseInt(selectedJourney)-1)
-                            markerIndex = trainRoutes[selectedTrain][selectedJourney].length
-                            document.getElementById("journeySelect").value = selectedJourney;
-                        }}
-                        updateMarkers();
-                        updateSliderValue();
-                    }}
-                }}
+            function updateJourneyList() {{
+                let journeySelect = document.getElementById("journeySelect");
+                journeySelect.innerHTML = trains[selectedTrain].map(entry => `<option value="${{entry[0]}}">${{entry[0]}} (${{entry[1]}} points)</option>`).join("");
+                selectJourney(journeyList()[0], false);
+            }}
 
-                function updateMarkers() {{
-                    clearMarkers();
-                    for (let i = 0; i < markerRange.length; i++) {{
-                        let point = markerRange[i];
-                        let isLastMarker = (i === markerRange.length - 1);
-                        let marker = L.circleMarker([point.lat, point.lon], {{
-                            radius: isLastMarker ? 10 : 7,
-                            fillColor: isLastMarker ? "#FFA500" : "#FF0000",
-                            fillOpacity: isLastMarker ? 1.0 : 0.5,
-                            color: isLastMarker ? "#CC8400" : "transparent",
-                            weight: isLastMarker ? 2 : 0
-                        }}).addTo(map);
-                        markers.push(marker);
-                    }}
-                    if (markerRange.length > 0) {{
-                        let lastPoint = markerRange[markerRange.length - 1];
-                        document.getElementById('infoBox').innerHTML = `
-                            <b>Time:</b> ${{lastPoint.human_received_time}} <br>
-                            <b>Latitude:</b> ${{lastPoint.lat.toFixed(6)}} <br>
-                            <b>Longitude:</b> ${{lastPoint.lon.toFixed(6)}} <br>
-                            <b>Measured Time:</b> ${{lastPoint.measured_time}} <br>
-                            <b>Journey:</b> ${{lastPoint.journey}}
-                        `;
-                        map.setView([lastPoint.lat, lastPoint.lon], 14);
-                    }}
-                }}
+            function updateJourney() {{
+                selectJourney(document.getElementById("journeySelect").value, false);
+            }}
 
-                function updateSliderMax() {{
-                    document.getElementById("markerSlider").max = "" + (trainRoutes[selectedTrain][selectedJourney].length)
-                }}
+            function selectJourney(journey, atEnd) {{
+                selectedJourney = journey;
+                document.getElementById("journeySelect").value = journey;
+                let train = selectedTrain;
+                requestJourney(train, journey, data => {{
+                    if (train !== selectedTrain || journey !== selectedJourney) return;
+                    route = data;
+                    document.getElementById("markerSlider").max = "" + route.points.length;
+                    showPoints(atEnd ? route.points.length : 1);
+                    map.setView(route.points[markerIndex - 1], 14);
+                }});
+            }}
 
-                function updateSliderValue() {{
-                    document.getElementById("markerSlider").value = "" + markerIndex
+            function showPoints(count) {{
+                markerIndex = count;
+                trail.setLatLngs(route.points.slice(0, count));
+                updateMarker();
+            }}
+
+            function nextMarker() {{
+                if (!route) return;
+                if (markerIndex < route.points.length) {{
+                    markerIndex++;
+                    trail.addLatLng(route.points[markerIndex - 1]);
+                    updateMarker();
+                }} else {{
+                    // Move to next journey
+                    let list = journeyList();
+                    let next = list.indexOf(selectedJourney) + 1;
+                    if (next < list.length) selectJourney(list[next], false);
                 }}
+            }}
 
-                function updateMarkerFromSlider() {{
-                    let route = trainRoutes[selectedTrain][selectedJourney]
-                    let value = parseInt(document.getElementById("markerSlider").value)
-                    let change = value - markerIndex
-                    for (let i = 0; i < Math.abs(change); ++i) {{
-                        if (change > 0) nextMarker()
-                        if (change < 0) previousMarker()
-                    }}
-                    updateMarkers()
+            function previousMarker() {{
+                if (!route) return;
+                if (markerIndex > 1) {{
+                    markerIndex--;
+                    trail.getLatLngs().pop();
+                    trail.redraw();
+                    updateMarker();
+                }} else {{
+                    // Move to the end of the previous journey
+                    let list = journeyList();
+                    let previous = list.indexOf(selectedJourney) - 1;
+                    if (previous >= 0) selectJourney(list[previous], true);
                 }}
-                
-                document.addEventListener('keydown', (event) => {{
-                    if (event.key === 'ArrowRight') nextMarker();
-                    if (event.key === 'ArrowLeft') previousMarker();
-                }});
-                
-                updateJourneyList();
-            </script>
-        </body>
-        </html>
-        """)
+            }}
+
+            function updateMarker() {{
+                let i = markerIndex - 1;
+                let point = route.points[i];
+                marker.setLatLng(point).addTo(map);
+                document.getElementById('infoBox').innerHTML = `
+                    <b>Time:</b> ${{formatTime(route.r[i])}} <br>
+                    <b>Latitude:</b> ${{point[0].toFixed(6)}} <br>
+                    <b>Longitude:</b> ${{point[1].toFixed(6)}} <br>
+                    <b>Measured Time:</b> ${{formatTime(route.t[i])}} <br>
+                    <b>Journey:</b> ${{selectedJourney}}
+                `;
+                document.getElementById("markerSlider").value = "" + markerIndex;
+                if (!map.getBounds().contains(point)) map.panTo(point);
+            }}
+
+            function updateMarkerFromSlider() {{
+                if (!route) return;
+                showPoints(parseInt(document.getElementById("markerSlider").value));
+            }}
+
+            document.addEventListener('keydown', (event) => {{
+                if (event.key === 'ArrowRight') nextMarker();
+                if (event.key === 'ArrowLeft') previousMarker();
+            }});
+
+            {loader}
+            requestTrains();
+        </script>
+    </body>
+    </html>
+    """
+
+def generate_map(database_path, route=None, route_path=None, output="train_map"):
+    """
+    Generate the map as a directory with index.html, which loads the
+    train list and then each journey when it is selected.
+    """
+    trains = write_data(database_path, os.path.join(output, "data"), route)
+    if not trains:
+        print("No train data found in the database.")
+        return
+
+    # Generate HTML
+    html_path = os.path.join(output, "index.html")
+    with open(html_path, "w", encoding="utf-8") as f:
+        f.write(map_html(route_path, STATIC_LOADER))
     print(f"Map generated: {html_path}")
     if input("Open the map? (y/n): ").strip().lower() == 'y':
         webbrowser.open(f'file://{os.path.abspath(html_path)}')
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python script.py <database_path>")
-    else:
-        generate_map(sys.argv[1])
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Generate an animated map of collected train positions.")
+    parser.add_argument("database_path")
+    parser.add_argument("route", nargs="?", help="route to plot from a shared database (db_shared.sqlite3), e.g. Cst_U")
+    parser.add_argument("--route-file", help="cleaned route (route-*.json) to draw on the map")
+    parser.add_argument("--tolerance", type=float, help="draw the route simplified to this many metres")
+    parser.add_argument("--output", default="train_map", help="directory to write the map to (default train_map)")
+    args = parser.parse_args()
+    route_path = load_route_path(args.route_file, args.tolerance) if args.route_file else None
+    generate_map(args.database_path, args.route, route_path, args.output)
@@ -0,0 +1,262 @@
+"""
+Local HTTP server for the train map, backed by indexed queries.
+
+Serves the plot_route page and answers its requests straight from a
+collector database, which may still be written to, instead of
+exporting it first:
+
+ - /api/trains: the trains with their journeys and point counts
+ - /api/journeys?train=: the journey summaries of a train
+ - /api/journey?train=&journey=: the points of a journey
+ - /api/window?start=&end=[&bbox=minLon,minLat,maxLon,maxLat]: the
+   points measured within a time window (unix times), optionally
+   within a box
+
+Responses are cached until the database changes: the collector saves
+its changeid with every write (see checkpoint) and compact_positions
+--delete notes the day it deleted.
+
+Run with `python plot_server.py <database> [route] [--port 8000]`.
+"""
+
+import argparse
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from plot_route import journey_columns, load_route_path, map_html
+from position_reader import position_source, to_columns, COLUMNS
+
+CACHE_SIZE = 256
+MAX_WINDOW_POINTS = 100000
+SELECTED_COLUMNS = ", ".join(COLUMNS)
+
+# How the page loads its data: from the endpoints of this server
+SERVER_LOADER = """
+            function requestTrains() {
+                fetch("api/trains").then(response => response.json()).then(loadTrains);
+            }
+
+            function fetchJourney(train, journey) {
+                fetch(`api/journey?train=${train}&journey=${journey}`)
+                    .then(response => response.json())
+                    .then(data => loadJourney(train, journey, data));
+            }
+"""
+
+class MapData:
+    """
+    Answers the map queries for one database (or one route of a shared
+    database), with an LRU cache of encoded responses.
+    """
+
+    def __init__(self, database_path, route=None):
+        self.database_path = database_path
+        self.route = route
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def connect(self):
+        # Read-only, so the collector can keep writing (WAL)
+        return sqlite3.connect(f"file:{self.database_path}?mode=ro", uri=True)
+
+    def has_journeys(self, conn):
+        """
+        Whether the journeys table summarises every position. A database
+        from before the journeys table, reopened by the collector, only
+        has summaries from the rowid it continued at, so the positions
+        before that are read from the positions table instead.
+        """
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'journeys'").fetchone() is None:
+            return False
+        first_row, first_summarised = conn.execute("""SELECT (SELECT MIN(rowid) FROM timestamps),
+                                                   (SELECT MIN(firstRow) FROM journeys)""").fetchone()
+        return first_row is None or (first_summarised is not None and first_summarised <= first_row)
+
+    def version(self, conn):
+        """
+        What the cached responses depend on: the last changeid and
+        compaction saved in collectorState, which change with every
+        write including dwell time and journey updates, and the rowid
+        range, for databases from before collectorState.
+        """
+        state = ()
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'collectorState'").fetchone() is not None:
+            state = tuple(conn.execute("""SELECT key, value FROM collectorState
+                                       WHERE key IN ('lastChangeID', 'lastCompaction') ORDER BY key""").fetchall())
+        return (state, *conn.execute("SELECT MIN(rowid), MAX(rowid) FROM timestamps").fetchone())
+
+    def cached(self, key, compute):
+        """
+        Return the JSON encoded result of compute(conn), cached under
+        the key for as long as the database doesn't change.
+        """
+        conn = self.connect()
+        try:
+            version = self.version(conn)
+            with self.lock:
+                body = self.cache.get((key, version))
+                if body is not None:
+                    self.cache.move_to_end((key, version))
+                    return body
+            body = json.dumps(compute(conn), separators=(',', ':')).encode("utf-8")
+        finally:
+            conn.close()
+        with self.lock:
+            self.cache[(key, version)] = body
+            while len(self.cache) > CACHE_SIZE:
+                self.cache.popitem(last=False)
+        return body
+
+    def trains(self, conn):
+        """
+        The trains with their [journey, point count] pairs.
+        """
+        if self.route is None and self.has_journeys(conn):
+            rows = conn.execute("""SELECT operationalTrainNumber, journeyNumber, pointCount FROM journeys
+                                ORDER BY operationalTrainNumber, journeyNumber""").fetchall()
+        else:
+            source, condition, params = position_source(self.route)
+            rows = conn.execute(f"""SELECT operationalTrainNumber, journeyNumber, COUNT(*) FROM {source}
+                                WHERE {condition} GROUP BY operationalTrainNumber, journeyNumber""", params).fetchall()
+        trains = {}
+        for train, journey, count in rows:
+            trains.setdefault(train, []).append([journey, count])
+        return trains
+
+    def journeys(self, conn, train):
+        """
+        The journeys of a train with their start and end times, point
+        counts and bounding boxes.
+        """
+        names = ["journey", "startTime", "endTime", "pointCount", "minLon", "minLat", "maxLon", "maxLat"]
+        if self.route is None and self.has_journeys(conn):
+            rows = conn.execute("""SELECT journeyNumber, startTime, endTime, pointCount, minLon, minLat, maxLon, maxLat
+                                FROM journeys WHERE operationalTrainNumber = ? ORDER BY journeyNumber""", (train,)).fetchall()
+        else:
+            source, condition, params = position_source(self.route)
+            rows = conn.execute(f"""SELECT journeyNumber, MIN(measuredTime), MAX(measuredTime), COUNT(*),
+                                MIN(WGS84_1), MIN(WGS84_2), MAX(WGS84_1), MAX(WGS84_2) FROM {source}
+                                WHERE {condition} AND operationalTrainNumber = ?
+                                GROUP BY journeyNumber""", (*params, train)).fetchall()
+        return [dict(zip(names, row)) for row in rows]
+
+    def journey(self, conn, train, journey):
+        """
+        The points of a journey, in the columns of plot_route's data.
+        """
+        source, condition, params = position_source(self.route)
+        rows = conn.execute(f"""SELECT {SELECTED_COLUMNS} FROM {source}
+                            WHERE {condition} AND operationalTrainNumber = ? AND journeyNumber = ?
+                            ORDER BY measuredTime""", (*params, train, journey)).fetchall()
+        return journey_columns(to_columns(rows))
+
+    def window(self, conn, start, end, bbox=None):
+        """
+        The points measured within [start, end], and within the box if
+        given, with their train and journey. Journeys are picked from
+        the journeys table by time and box, and each is read through
+        the (train, journey, time) index.
+        """
+        source, condition, params = position_source(self.route)
+        point_condition = "measuredTime BETWEEN ? AND ?"
+        point_params = (start, end)
+        if bbox is not None:
+            point_condition += " AND WGS84_1 BETWEEN ? AND ? AND WGS84_2 BETWEEN ? AND ?"
+            point_params += (bbox[0], bbox[2], bbox[1], bbox[3])
+        if self.has_journeys(conn):
+            journey_condition = "startTime <= ? AND endTime >= ?"
+            journey_params = (end, start)
+            if bbox is not None:
+                journey_condition += " AND minLon <= ? AND maxLon >= ? AND minLat <= ? AND maxLat >= ?"
+                journey_params += (bbox[2], bbox[0], bbox[3], bbox[1])
+            keys = conn.execute(f"""SELECT operationalTrainNumber, journeyNumber FROM journeys
+                                WHERE {journey_condition}""", journey_params).fetchall()
+            rows = []
+            for train, journey in keys:
+                rows += conn.execute(f"""SELECT {SELECTED_COLUMNS} FROM {source}
+                                     WHERE {condition} AND operationalTrainNumber = ? AND journeyNumber = ?
+                                     AND {point_condition} ORDER BY measuredTime""",
+                                     (*params, train, journey, *point_params)).fetchall()
+                if len(rows) > MAX_WINDOW_POINTS:
+                    break
+        else:
+            rows = conn.execute(f"""SELECT {SELECTED_COLUMNS} FROM {source} WHERE {condition} AND {point_condition}
+                                ORDER BY operationalTrainNumber, journeyNumber, measuredTime LIMIT ?""",
+                                (*params, *point_params, MAX_WINDOW_POINTS + 1)).fetchall()
+        truncated = len(rows) > MAX_WINDOW_POINTS
+        columns = to_columns(rows[:MAX_WINDOW_POINTS])
+        result = journey_columns(columns)
+        result['train'] = columns['operationalTrainNumber'].tolist()
+        result['journey'] = columns['journeyNumber'].tolist()
+        result['truncated'] = truncated
+        return result
+
+class MapHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {name: values[0] for name, values in parse_qs(url.query).items()}
+        data = self.server.data
+        try:
+            if url.path in ("/", "/index.html"):
+                self.send_body(self.server.page, "text/html; charset=utf-8")
+            elif url.path == "/api/trains":
+                self.send_json(data.cached(("trains",), data.trains))
+            elif url.path == "/api/journeys":
+                train = int(query["train"])
+                self.send_json(data.cached(("journeys", train), lambda conn: data.journeys(conn, train)))
+            elif url.path == "/api/journey":
+                train, journey = int(query["train"]), int(query["journey"])
+                self.send_json(data.cached(("journey", train, journey), lambda conn: data.journey(conn, train, journey)))
+            elif url.path == "/api/window":
+                start, end = float(query["start"]), float(query["end"])
+                bbox = tuple(map(float, query["bbox"].split(","))) if "bbox" in query else None
+                if bbox is not None and len(bbox) != 4:
+                    raise ValueError("bbox must be minLon,minLat,maxLon,maxLat")
+                self.send_json(data.cached(("window", start, end, bbox), lambda conn: data.window(conn, start, end, bbox)))
+            else:
+                self.send_error(404)
+        except (KeyError, ValueError) as e:
+            self.send_error(400, f"Bad query: {e}")
+        except sqlite3.Error as e:
+            self.send_error(500, f"Database error: {e}")
+
+    def send_json(self, body):
+        self.send_body(body, "application/json")
+
+    def send_body(self, body, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def create_map_server(database_path, route=None, route_path=None, port=8000):
+    """
+    Create a map server for the database on localhost.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), MapHandler)
+    server.data = MapData(database_path, route)
+    server.page = map_html(route_path, SERVER_LOADER).encode("utf-8")
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve an animated map of collected train positions.")
+    parser.add_argument("database_path")
+    parser.add_argument("route", nargs="?", help="route to plot from a shared database (db_shared.sqlite3), e.g. Cst_U")
+    parser.add_argument("--route-file", help="cleaned route (route-*.json) to draw on the map")
+    parser.add_argument("--tolerance", type=float, help="draw the route simplified to this many metres")
+    parser.add_argument("--port", type=int, default=8000, help="port to listen on (default 8000)")
+    args = parser.parse_args()
+    route_path = load_route_path(args.route_file, args.tolerance) if args.route_file else None
+    server = create_map_server(args.database_path, args.route, route_path, args.port)
+    print(f"Serving {args.database_path} on http://127.0.0.1:{args.port}")
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
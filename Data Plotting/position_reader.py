@@ -0,0 +1,59 @@
+"""
+Columnar reading of collected positions.
+
+Positions are read in chunks, ordered by train, journey and measured
+time, into one NumPy array per column instead of a Python tuple per
+row, and split into journeys chunk by chunk, so that large databases
+can be plotted without building per-row objects or holding all
+positions in memory.
+"""
+
+import numpy as np
+
+CHUNK_SIZE = 100000
+COLUMNS = ["operationalTrainNumber", "journeyNumber", "receivedTime", "measuredTime", "WGS84_1", "WGS84_2"]
+INTEGER_COLUMNS = {"operationalTrainNumber", "journeyNumber"}
+
+def position_source(route):
+    """
+    The table, condition and parameters selecting the positions to
+    plot: the timestamps of a route database, or one route of a shared
+    database.
+    """
+    if route is None:
+        return "timestamps", "1", ()
+    return "routeTimestamps", "route = ?", (route,)
+
+def to_columns(rows, names=COLUMNS):
+    """
+    Convert rows of the given columns into one array per column.
+    """
+    array = np.array(rows, dtype=np.float64).reshape(-1, len(names))
+    return {name: array[:, i].astype(np.int64) if name in INTEGER_COLUMNS else array[:, i]
+            for i, name in enumerate(names)}
+
+def read_journeys(conn, route=None, chunk_size=CHUNK_SIZE):
+    """
+    Yield (train, journey, columns) for every journey, ordered by train
+    and journey, with its positions ordered by measured time. Positions
+    are read chunk_size rows at a time in that order, along the
+    timestamps index, so only about one chunk is in memory at once.
+    The last journey of a chunk may continue in the next, and is
+    carried over into it.
+    """
+    source, condition, params = position_source(route)
+    cursor = conn.execute(f"SELECT {', '.join(COLUMNS)} FROM {source} WHERE {condition} "
+                          "ORDER BY operationalTrainNumber, journeyNumber, measuredTime", params)
+    carry = np.empty((0, len(COLUMNS)))
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        chunk = np.concatenate((carry, np.array(rows, dtype=np.float64)))
+        trains, journeys = chunk[:, 0], chunk[:, 1]
+        starts = np.concatenate(([0], np.flatnonzero((np.diff(trains) != 0) | (np.diff(journeys) != 0)) + 1))
+        for start, stop in zip(starts[:-1], starts[1:]):
+            yield int(trains[start]), int(journeys[start]), to_columns(chunk[start:stop])
+        carry = chunk[starts[-1]:]
+    if len(carry) != 0:
+        yield int(carry[0, 0]), int(carry[0, 1]), to_columns(carry)